@@ -0,0 +1,163 @@
+"""
+Checks how accurately the NVR can place every tag in wall clock time for
+each clock sync policy, against the previous behaviour of a clock sync
+before two out of every three tags.
+
+Tags of a generated stream are given the wall clock time they'd be received
+at: their timestamp, on a camera clock that drifts, plus a network delay
+that jitters. The rewritten stream is then read back like the NVR does,
+placing every tag at the wall clock time of the last clock sync plus the
+difference in timestamps, and compared to when it was received.
+
+    python -m benchmarks.clock_accuracy [--jitter 20] [--drift-ppm 100]
+"""
+
+import argparse
+import random
+import time
+
+from benchmarks.flvgen import ChunkedReader, generate, parse_resolution
+from unifi import flv
+from unifi.clock_sync import DEFAULT_INTERVAL, POLICIES, ClockSync
+
+LATENCY_MS = 50
+CHUNK_SIZE = 65536
+
+
+class TwoInThree(ClockSync):
+    """
+    The previous behaviour: a clock sync before two out of every three tags.
+    """
+
+    def __init__(self):
+        super(TwoInThree, self).__init__()
+        self.count = 0
+
+    def due(self, tag):
+        i = self.count
+        self.count += 1
+        return i % 3 != 0
+
+
+def read_tags(data):
+    reader = flv.FlvReader(ChunkedReader(data, CHUNK_SIZE))
+    reader.read_header()
+    return reader
+
+
+def receive_times(data, jitter_ms, drift_ppm, seed=0):
+    """
+    The wall clock time, in seconds, each tag of `data` arrives at.
+    """
+    rng = random.Random(seed)
+    started = time.time()
+    scale = 1 - drift_ppm / 1e6
+    return [
+        started
+        + (tag.timestamp * scale + LATENCY_MS + rng.uniform(0, jitter_ms)) / 1000
+        for tag in read_tags(data)
+    ]
+
+
+def rewrite(clock_sync, data, received):
+    """
+    Returns the rewritten stream and the CPU seconds rewriting took.
+    """
+    out = [flv.FLV_HEADER]
+    cpu = time.process_time()
+    for tag, received_at in zip(read_tags(data), received):
+        # Joined right away, as the clock sync buffer is reused
+        out.append(b"".join(clock_sync.rewrite(tag, received_at)))
+    cpu = time.process_time() - cpu
+    return b"".join(out), cpu
+
+
+def placement_errors(data, received):
+    """
+    Reads a rewritten stream like the NVR and returns, for every original
+    tag after the first clock sync, how far off its wall clock time comes
+    out, in ms.
+    """
+    errors = []
+    sync = None
+    i = 0
+    for tag in read_tags(data):
+        if tag.type == flv.TAG_TYPE_SCRIPT:
+            name, value = flv.parse_script_data(tag.payload)
+            if name == "onClockSync":
+                sync = value
+                continue
+        if sync is not None:
+            placed = sync["wallClock"] + tag.timestamp - sync["streamClock"]
+            errors.append(abs(placed - 1000 * received[i]))
+        i += 1
+    return errors
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--resolution", "-r", type=parse_resolution, default="1280x720"
+    )
+    parser.add_argument("--duration", type=float, default=300, help="Stream seconds")
+    parser.add_argument("--fps", type=int, default=15)
+    parser.add_argument("--gop", type=int, default=30)
+    parser.add_argument(
+        "--interval", type=int, default=DEFAULT_INTERVAL, help="Clock sync interval"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=20, help="Network delay jitter, in ms"
+    )
+    parser.add_argument(
+        "--drift-ppm", type=float, default=100, help="Camera clock drift"
+    )
+    args = parser.parse_args()
+
+    data = generate(args.duration, args.resolution, args.fps, args.gop)
+    received = receive_times(data, args.jitter, args.drift_ppm)
+    cases = [("previous", TwoInThree())]
+    cases.extend((policy, ClockSync(policy, args.interval)) for policy in POLICIES)
+
+    print(
+        "{:<16} {:>8} {:>10} {:>10} {:>10} {:>12}".format(
+            "policy", "syncs", "mean ms", "p99 ms", "max ms", "cpu us/tag"
+        )
+    )
+    results = {}
+    for name, clock_sync in cases:
+        rewritten, cpu = rewrite(clock_sync, data, received)
+        errors = placement_errors(rewritten, received)
+        results[name] = (clock_sync.injected, max(errors))
+        print(
+            "{:<16} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.2f}".format(
+                name,
+                clock_sync.injected,
+                sum(errors) / len(errors),
+                percentile(errors, 99),
+                max(errors),
+                1e6 * cpu / len(errors),
+            )
+        )
+
+    # Tags are placed from the last clock sync, so no policy should be off by
+    # more than the jitter between the two, give or take a millisecond of
+    # drift and rounding
+    previous_syncs, _ = results["previous"]
+    for policy in POLICIES:
+        syncs, error = results[policy]
+        assert error <= args.jitter + 1, (policy, error)
+        assert previous_syncs >= 10 * syncs, (policy, syncs)
+        print(
+            "{}: {:.0f}x fewer clock syncs, at most {:.2f} ms off".format(
+                policy, previous_syncs / syncs, error
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+Benchmarks the clock sync rewrite, from reading tags off a pipe to handing
+the rewritten buffers to the socket, against generated streams.
+
+Every combination of the given resolutions, GOP sizes, audio settings and
+read chunk sizes is run as a case. For each it reports:
+
+- throughput in MB/s of input, and CPU time per tag
+- p50/p99 latency per tag
+- bytes allocated per tag (peak, with tracemalloc), and memory blocks still
+  allocated per tag afterwards, which should be 0
+
+    python -m benchmarks.clock_sync [--output results.json] [--compare old.json]
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from benchmarks.flvgen import ChunkedReader, generate, parse_resolution
+from unifi import flv
+from unifi.clock_sync import ClockSync, sync
+
+# Tags read before allocations are measured, so the read buffer has settled
+WARMUP_TAGS = 100
+
+
+def null_writev(buffers):
+    # Takes everything, like a socket with room in its send buffer
+    n = 0
+    for buf in buffers:
+        n += len(buf)
+    return n
+
+
+def sink(buffers):
+    flv.write_all(null_writev, buffers)
+
+
+def measure_throughput(data, chunk_size, repeat):
+    best_wall = best_cpu = None
+    for _ in range(repeat):
+        source = ChunkedReader(data, chunk_size)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        sync(source, sink)
+        cpu = time.process_time() - cpu
+        wall = time.perf_counter() - wall
+        best_wall = wall if best_wall is None else min(best_wall, wall)
+        best_cpu = cpu if best_cpu is None else min(best_cpu, cpu)
+    return best_wall, best_cpu
+
+
+def measure_latency(data, chunk_size):
+    """
+    Returns per tag times in ns, reading included.
+    """
+    reader = flv.FlvReader(ChunkedReader(data, chunk_size))
+    reader.read_header()
+    clock_sync = ClockSync()
+    clock = time.perf_counter_ns
+    times = []
+    while True:
+        started = clock()
+        tag = reader.read_tag()
+        if tag is None:
+            return times
+        sink(clock_sync.rewrite(tag))
+        times.append(clock() - started)
+
+
+def measure_allocations(data, chunk_size, warmup=WARMUP_TAGS):
+    """
+    Returns the peak bytes allocated per tag, on average, and the number of
+    memory blocks left allocated per tag, after the first `warmup` tags.
+    """
+    reader = flv.FlvReader(ChunkedReader(data, chunk_size))
+    reader.read_header()
+    clock_sync = ClockSync()
+    for _ in range(warmup):
+        tag = reader.read_tag()
+        if tag is None:
+            break
+        sink(clock_sync.rewrite(tag))
+
+    tags = 0
+    peak_bytes = 0
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    try:
+        while True:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            tag = reader.read_tag()
+            if tag is None:
+                break
+            sink(clock_sync.rewrite(tag))
+            peak_bytes += tracemalloc.get_traced_memory()[1] - before
+            tags += 1
+    finally:
+        tracemalloc.stop()
+    del tag
+    blocks = sys.getallocatedblocks() - blocks
+    if not tags:
+        return 0.0, 0.0
+    return peak_bytes / tags, blocks / tags
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run_case(case, args):
+    data = generate(
+        args.duration, case["resolution"], args.fps, case["gop"], case["audio"]
+    )
+    wall, cpu = measure_throughput(data, case["chunk_size"], args.repeat)
+    times = measure_latency(data, case["chunk_size"])
+    tags = len(times)
+    result = {
+        "stream_bytes": len(data),
+        "tags": tags,
+        "mb_per_sec": len(data) / wall / 1e6,
+        "cpu_us_per_tag": 1e6 * cpu / tags,
+        "p50_us": percentile(times, 50) / 1000,
+        "p99_us": percentile(times, 99) / 1000,
+    }
+    if hasattr(tracemalloc, "reset_peak"):
+        # Short streams are mostly measured rather than spent warming up
+        alloc_bytes, alloc_blocks = measure_allocations(
+            data, case["chunk_size"], min(WARMUP_TAGS, tags // 4)
+        )
+        result["alloc_bytes_per_tag"] = alloc_bytes
+        result["retained_blocks_per_tag"] = alloc_blocks
+    return result
+
+
+def case_name(case):
+    return "{}x{} gop={} audio={} chunk={}".format(
+        case["resolution"][0],
+        case["resolution"][1],
+        case["gop"],
+        "on" if case["audio"] else "off",
+        case["chunk_size"],
+    )
+
+
+def compare(results, path):
+    with open(path) as f:
+        previous = {r["name"]: r for r in json.load(f)["results"]}
+    print()
+    print("Compared to {}:".format(path))
+    for result in results:
+        old = previous.get(result["name"])
+        if old is None:
+            continue
+        print(
+            "{:<44} MB/s {:+6.1f}%  p99 {:+6.1f}%".format(
+                result["name"],
+                100 * (result["mb_per_sec"] / old["mb_per_sec"] - 1),
+                100 * (result["p99_us"] / old["p99_us"] - 1),
+            )
+        )
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--resolutions",
+        type=lambda v: [parse_resolution(r) for r in v.split(",")],
+        default="640x360,1280x720,1920x1080",
+    )
+    parser.add_argument("--gops", type=int_list, default="15,60")
+    parser.add_argument(
+        "--audio",
+        type=lambda v: [a == "on" for a in v.split(",")],
+        default="on,off",
+        help="on, off or both",
+    )
+    parser.add_argument(
+        "--chunk-sizes",
+        type=int_list,
+        default="4096,65536",
+        help="Largest read from the pipe, in bytes",
+    )
+    parser.add_argument("--duration", type=float, default=60, help="Stream seconds")
+    parser.add_argument("--fps", type=int, default=15)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", "-o", help="Write the results as JSON")
+    parser.add_argument("--compare", help="Results JSON to compare against")
+    args = parser.parse_args()
+
+    results = []
+    print(
+        "{:<44} {:>8} {:>10} {:>8} {:>8} {:>10}".format(
+            "case", "MB/s", "cpu us/tag", "p50 us", "p99 us", "alloc B/tag"
+        )
+    )
+    for resolution, gop, audio, chunk_size in itertools.product(
+        args.resolutions, args.gops, args.audio, args.chunk_sizes
+    ):
+        case = {
+            "resolution": resolution,
+            "gop": gop,
+            "audio": audio,
+            "chunk_size": chunk_size,
+        }
+        result = dict(name=case_name(case), **case)
+        result.update(run_case(case, args))
+        results.append(result)
+        print(
+            "{:<44} {:>8.1f} {:>10.2f} {:>8.2f} {:>8.2f} {:>10}".format(
+                result["name"],
+                result["mb_per_sec"],
+                result["cpu_us_per_tag"],
+                result["p50_us"],
+                result["p99_us"],
+                "{:.0f}".format(result["alloc_bytes_per_tag"])
+                if "alloc_bytes_per_tag" in result
+                else "-",
+            )
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "time": time.time(),
+                    "duration": args.duration,
+                    "fps": args.fps,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Per-message cost of building and serializing replies to the NVR.
+
+"before" builds every reply from scratch and serializes it with `json.dumps`,
+as the handlers used to. "after" renders the cached templates.
+
+    python -m benchmarks.dispatch [--iterations N]
+"""
+
+import argparse
+import json
+import logging
+import time
+
+from unifi.cams.base import UnifiCamBase
+from unifi.core import Core
+from unifi.dispatch import HANDLERS
+from unifi.templates import response
+
+
+class FakeCamera(UnifiCamBase):
+    def get_video_settings(self):
+        return {"brightness": 50, "contrast": 50, "saturation": 50}
+
+    def change_video_settings(self, options):
+        pass
+
+    def start_video_stream(self, stream_name, stream_index):
+        pass
+
+
+class BenchCore(Core):
+    def __init__(self, args, camera, logger, cached=True):
+        super(BenchCore, self).__init__(args, camera, logger)
+        self.cached = cached
+
+    async def run_blocking(self, func, *args):
+        return func(*args)
+
+    def respond(self, msg, function_name, make_payload, **values):
+        if self.cached:
+            return super(BenchCore, self).respond(
+                msg, function_name, make_payload, **values
+            )
+        values.update(messageId=self.gen_msg_id(), inResponseTo=msg["messageId"])
+        message = response(function_name, make_payload())
+        return json.dumps(message, default=lambda slot: values[slot.name])
+
+
+MESSAGES = {
+    "ubnt_avclient_paramAgreement": {},
+    "ubnt_avclient_time": {},
+    "ResetIspSettings": {},
+    "ChangeVideoSettings": {
+        "video": {
+            "video1": {
+                "avSerializer": {
+                    "destinations": ["tcp://192.168.1.10:6666?retryInterval=1"],
+                    "parameters": {"streamName": "abcdef"},
+                }
+            },
+            "video2": None,
+            "video3": None,
+        }
+    },
+    "ChangeDeviceSettings": {"region": "US"},
+    "ChangeOsdSettings": {},
+    "NetworkStatus": {},
+    "ChangeSoundLedSettings": {},
+    "ChangeIspSettings": {"brightness": 60},
+    "UpdateUsernamePassword": {},
+}
+
+
+def run_handler(core, func, msg):
+    # Nothing in the handlers suspends, so the coroutine completes on its
+    # first step
+    try:
+        func(core, msg).send(None)
+    except StopIteration as e:
+        return e.value
+
+
+def measure(core, func, msg, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        res = run_handler(core, func, msg)
+        if not isinstance(res, str):
+            res = json.dumps(res)
+        res.encode("utf-8")
+    return (time.perf_counter() - started) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", "-n", type=int, default=10000)
+    args = parser.parse_args()
+
+    core_args = argparse.Namespace(
+        host="127.0.0.1",
+        cert=None,
+        token="token",
+        mac="AABBCCDDEEFF",
+        name="bench",
+        ip="192.168.1.10",
+    )
+    logger = logging.getLogger("bench")
+    before = BenchCore(core_args, FakeCamera(core_args, logger), logger, cached=False)
+    after = BenchCore(core_args, FakeCamera(core_args, logger), logger, cached=True)
+
+    print("{:<32} {:>10} {:>10} {:>8}".format("message", "before", "after", "x"))
+    for name, payload in MESSAGES.items():
+        func = HANDLERS[name].func
+        msg = {"functionName": name, "messageId": 1, "payload": payload}
+        if name != "ubnt_avclient_time":
+            # Both must produce the same reply
+            expected = json.loads(run_handler(before, func, msg))
+            assert json.loads(run_handler(after, func, msg)) == expected, name
+        t_before = measure(before, func, msg, args.iterations)
+        t_after = measure(after, func, msg, args.iterations)
+        print(
+            "{:<32} {:>8.1f}us {:>8.1f}us {:>7.1f}x".format(
+                name, 1e6 * t_before, 1e6 * t_after, t_before / t_after
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Synthetic FLV streams shaped like a camera's: H.264 video with a fixed GOP
+and AAC audio, with payloads of realistic sizes filled with random bytes.
+The tag structure is valid, but the video can't be decoded.
+
+    python -m benchmarks.flvgen -o out.flv [--resolution 1280x720] ...
+    python -m benchmarks.flvgen -o - --realtime --stream-name abc | ...
+"""
+
+import argparse
+import itertools
+import random
+import sys
+import time
+
+from unifi import flv
+
+# Encoded bits per pixel per frame, roughly what cameras use for H.264
+BITS_PER_PIXEL = 0.07
+KEYFRAME_RATIO = 8
+AAC_FRAME_SIZE = 1024
+AAC_SAMPLE_RATE = 44100
+AUDIO_BITRATE = 64000
+
+AVC_CONFIG = bytes.fromhex(
+    "01640028ffe1001967640028acd940780227e5c0440000030004000003"
+)
+AAC_CONFIG = bytes.fromhex("1210")
+
+
+def parse_resolution(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+class ChunkedReader(object):
+    """
+    Reads `data` at most `chunk_size` bytes at a time, like a pipe would.
+    """
+
+    def __init__(self, data, chunk_size):
+        self.view = memoryview(data)
+        self.chunk_size = chunk_size
+        self.pos = 0
+
+    def readinto(self, buf):
+        n = min(len(buf), self.chunk_size, len(self.view) - self.pos)
+        buf[:n] = self.view[self.pos : self.pos + n]
+        self.pos += n
+        return n
+
+
+def video_payload(keyframe, data):
+    # Frame type and codec, NALU packet type, composition time of 0
+    frame_type = 1 if keyframe else 2
+    return bytes((frame_type << 4 | flv.VIDEO_CODEC_AVC, 1, 0, 0, 0)) + data
+
+
+def generate_tags(
+    duration=60,
+    resolution=(1280, 720),
+    fps=15,
+    gop=30,
+    audio=True,
+    seed=0,
+    stream_name=None,
+):
+    """
+    Returns the metadata and sequence header tags, and the media tags for
+    `duration` seconds, each tag as (type, timestamp, payload).
+    """
+    rng = random.Random(seed)
+    width, height = resolution
+    frame_bits = width * height * BITS_PER_PIXEL
+    # Keyframes are KEYFRAME_RATIO times larger than the other frames
+    inter_size = int(frame_bits * gop / (gop - 1 + KEYFRAME_RATIO) / 8)
+    key_size = inter_size * KEYFRAME_RATIO
+    audio_size = int(AUDIO_BITRATE * AAC_FRAME_SIZE / AAC_SAMPLE_RATE / 8)
+    # Payloads are slices of one block of noise
+    noise_size = 2 * key_size + 4096
+    noise = rng.getrandbits(8 * noise_size).to_bytes(noise_size, "little")
+
+    metadata = flv.EcmaArray(
+        width=width,
+        height=height,
+        framerate=fps,
+        videocodecid=flv.VIDEO_CODEC_AVC,
+        audiocodecid=flv.SOUND_FORMAT_AAC if audio else 0,
+    )
+    if stream_name is not None:
+        metadata["streamname"] = stream_name
+    headers = [
+        (flv.TAG_TYPE_SCRIPT, 0, flv.encode_script_data("onMetaData", metadata)),
+        (flv.TAG_TYPE_VIDEO, 0, bytes((0x17, 0, 0, 0, 0)) + AVC_CONFIG),
+    ]
+    if audio:
+        headers.append((flv.TAG_TYPE_AUDIO, 0, bytes((0xAF, 0)) + AAC_CONFIG))
+
+    tags = []
+    for i in range(int(duration * fps)):
+        timestamp = int(i * 1000 / fps)
+        keyframe = i % gop == 0
+        size = int((key_size if keyframe else inter_size) * rng.uniform(0.8, 1.2))
+        offset = rng.randrange(len(noise) - size)
+        tags.append(
+            (
+                flv.TAG_TYPE_VIDEO,
+                timestamp,
+                video_payload(keyframe, noise[offset : offset + size]),
+            )
+        )
+
+    if audio:
+        for i in range(int(duration * AAC_SAMPLE_RATE / AAC_FRAME_SIZE)):
+            timestamp = int(i * AAC_FRAME_SIZE * 1000 / AAC_SAMPLE_RATE)
+            offset = rng.randrange(len(noise) - audio_size)
+            tags.append(
+                (
+                    flv.TAG_TYPE_AUDIO,
+                    timestamp,
+                    bytes((0xAF, 1)) + noise[offset : offset + audio_size],
+                )
+            )
+
+    # Interleave by timestamp
+    tags.sort(key=lambda tag: tag[1])
+    return headers, tags
+
+
+def serialize(tags):
+    out = []
+    prev_tag_size = 0
+    for type, timestamp, payload in tags:
+        out.append(flv.pack_header(prev_tag_size, type, len(payload), timestamp))
+        out.append(payload)
+        prev_tag_size = flv.TAG_HEADER_SIZE - 4 + len(payload)
+    return out, prev_tag_size
+
+
+def generate(*args, **kwargs):
+    """
+    Returns a complete FLV stream as bytes, taking the same arguments as
+    `generate_tags`.
+    """
+    headers, tags = generate_tags(*args, **kwargs)
+    out, prev_tag_size = serialize(headers + tags)
+    out.insert(0, flv.FLV_HEADER)
+    out.append(prev_tag_size.to_bytes(4, "big"))
+    return b"".join(out)
+
+
+def stream(out, duration, **kwargs):
+    """
+    Writes a live stream to the file object `out`, in real time and
+    forever, by looping over `duration` seconds of generated tags.
+    """
+    headers, tags = generate_tags(duration, **kwargs)
+    out.write(flv.FLV_HEADER)
+    prev_tag_size = 0
+    for type, _, payload in headers:
+        out.write(flv.pack_header(prev_tag_size, type, len(payload), 0) + payload)
+        prev_tag_size = flv.TAG_HEADER_SIZE - 4 + len(payload)
+
+    started = time.monotonic()
+    loop_ms = int(duration * 1000)
+    for loop in itertools.count():
+        for type, timestamp, payload in tags:
+            timestamp += loop * loop_ms
+            delay = started + timestamp / 1000 - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            out.write(
+                flv.pack_header(prev_tag_size, type, len(payload), timestamp) + payload
+            )
+            prev_tag_size = flv.TAG_HEADER_SIZE - 4 + len(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--output", "-o", required=True, help="FLV file to write, or - for stdout"
+    )
+    parser.add_argument("--duration", "-d", type=float, default=60)
+    parser.add_argument(
+        "--resolution", "-r", type=parse_resolution, default="1280x720"
+    )
+    parser.add_argument("--fps", type=int, default=15)
+    parser.add_argument("--gop", type=int, default=30, help="Frames per keyframe")
+    parser.add_argument("--no-audio", dest="audio", action="store_false")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stream-name", help="streamname to put in the metadata")
+    parser.add_argument(
+        "--realtime",
+        action="store_true",
+        help="Write a live stream forever, looping over --duration seconds",
+    )
+    args = parser.parse_args()
+
+    options = dict(
+        resolution=args.resolution,
+        fps=args.fps,
+        gop=args.gop,
+        audio=args.audio,
+        seed=args.seed,
+        stream_name=args.stream_name,
+    )
+    if args.output == "-":
+        out = sys.stdout.buffer
+    else:
+        out = open(args.output, "wb")
+    with out:
+        if args.realtime:
+            try:
+                stream(out, args.duration, **options)
+            except (BrokenPipeError, KeyboardInterrupt):
+                pass
+        else:
+            out.write(generate(args.duration, **options))
+
+
+if __name__ == "__main__":
+    main()
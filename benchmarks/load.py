@@ -0,0 +1,263 @@
+"""
+Starts N simulated cameras against the local NVR stand-in and reports,
+per camera, how long adoption, the first video bytes and snapshot uploads
+took, and the CPU and memory they cost.
+
+The cameras run in this process, on one event loop like a fleet worker,
+each streaming a generated FLV through the regular forwarder. The NVR
+runs in a separate process.
+
+    python -m benchmarks.load --cert client.pem --cameras 20 --duration 60
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+from benchmarks import nvr
+from unifi import clock_sync
+from unifi.cams.base import UnifiCamBase
+from unifi.core import Core
+from unifi.supervisor import get_supervisor
+
+# Smallest thing that passes for a JPEG
+SNAPSHOT = b"\xff\xd8\xff\xe0" + bytes(1024) + b"\xff\xd9"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+class SimulatedCam(UnifiCamBase):
+    @classmethod
+    def add_parser(self, parser):
+        pass
+
+    def __init__(self, args, logger=None):
+        super(SimulatedCam, self).__init__(args, logger)
+        self.streams = {}
+
+    def get_snapshot(self):
+        return SNAPSHOT
+
+    def start_video_stream(self, stream_name, options):
+        cmd = "{} -m benchmarks.flvgen -o - --realtime -d 10 -r {} --stream-name {}"
+        cmd = cmd.format(sys.executable, self.args.resolution, stream_name)
+        self.start_forwarder(stream_name, cmd)
+
+
+def process_usage(pid):
+    """
+    Returns (cpu seconds, RSS bytes) of `pid`, from /proc.
+    """
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/{}/statm".format(pid)) as f:
+            rss_pages = int(f.read().split()[1])
+    except OSError:
+        return 0.0, 0
+    # utime and stime are fields 14 and 15
+    cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    return cpu, rss_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def self_usage():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in KiB on Linux
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss * 1024
+
+
+def camera_args(args, i):
+    return argparse.Namespace(
+        host=args.host,
+        cert=args.cert,
+        token="simulated",
+        mac="AABBCC{:06X}".format(i),
+        name="sim{}".format(i),
+        ip="127.0.0.1",
+        verbose=False,
+        clock_sync=args.clock_sync,
+        clock_sync_interval=args.clock_sync_interval,
+        resolution=args.resolution,
+    )
+
+
+async def run_cameras(args):
+    cores = []
+    started = {}
+    tasks = []
+    for i in range(args.cameras):
+        cam_args = camera_args(args, i)
+        logger = logging.getLogger("sim{}".format(i))
+        core = Core(cam_args, SimulatedCam(cam_args, logger), logger)
+        cores.append(core)
+        started[cam_args.mac] = time.time()
+        tasks.append(asyncio.ensure_future(core.run()))
+        if args.ramp:
+            await asyncio.sleep(args.ramp)
+
+    await asyncio.sleep(args.duration)
+    usage = {}
+    for core in cores:
+        cpu, rss = 0.0, 0
+        for stream in core.cam.streams.values():
+            stream_cpu, stream_rss = process_usage(stream.proc.pid)
+            cpu += stream_cpu
+            rss += stream_rss
+        usage[core.mac] = (cpu, rss)
+    for task in tasks:
+        task.cancel()
+    # Stop the streams for good, rather than have the supervisor restart them
+    supervisor = get_supervisor()
+    for core in cores:
+        for name, stream in core.cam.streams.items():
+            supervisor.unwatch(core.cam.pipeline_name(name))
+            stream.stop()
+    return started, usage
+
+
+def summarize(values):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    return {
+        "avg": sum(values) / len(values),
+        "p50": values[len(values) // 2],
+        "p99": values[min(len(values) - 1, int(len(values) * 0.99))],
+        "max": values[-1],
+    }
+
+
+def build_report(args, started, usage, sessions, cpu_load, rss):
+    """
+    `cpu_load` is the proxy process' CPU seconds per second.
+    """
+    cameras = {}
+    for mac, started_at in started.items():
+        session = sessions.get(mac, {})
+        video_requested_at = session.get("video_requested_at")
+        first_byte_at = session.get("first_byte_at")
+        cameras[mac] = {
+            "adoption": session["hello_at"] - started_at
+            if session.get("hello_at")
+            else None,
+            "stream_start": first_byte_at - video_requested_at
+            if first_byte_at and video_requested_at
+            else None,
+            "snapshots": session.get("snapshot_latencies", []),
+            "bytes": session.get("bytes", 0),
+            "clock_syncs": session.get("clock_syncs", 0),
+            "clock_sync_errors": session.get("clock_sync_errors", 0),
+            "pulses": session.get("pulses", 0),
+            "forwarder_cpu": usage[mac][0],
+            "forwarder_rss": usage[mac][1],
+        }
+
+    n = len(cameras)
+    return {
+        "cameras": n,
+        "duration": args.duration,
+        "resolution": args.resolution,
+        "adoption": summarize(c["adoption"] for c in cameras.values()),
+        "stream_start": summarize(c["stream_start"] for c in cameras.values()),
+        "snapshot": summarize(s for c in cameras.values() for s in c["snapshots"]),
+        "clock_sync_errors": sum(c["clock_sync_errors"] for c in cameras.values()),
+        # The proxy process is shared by every camera, the forwarders'
+        # ffmpeg stand-ins aren't
+        "proxy_cpu_percent_per_camera": 100 * cpu_load / n,
+        "proxy_rss_per_camera": rss / n,
+        "forwarder_cpu_percent_per_camera": 100
+        * sum(c["forwarder_cpu"] for c in cameras.values())
+        / args.duration
+        / n,
+        "forwarder_rss_per_camera": sum(c["forwarder_rss"] for c in cameras.values())
+        / n,
+        "per_camera": cameras,
+    }
+
+
+def print_report(report):
+    print("{} cameras for {}s".format(report["cameras"], report["duration"]))
+    for key in ("adoption", "stream_start", "snapshot"):
+        stats = report[key]
+        if stats is None:
+            print("{:<14} -".format(key))
+            continue
+        print(
+            "{:<14} avg {:7.1f}ms  p50 {:7.1f}ms  p99 {:7.1f}ms  max {:7.1f}ms".format(
+                key,
+                1000 * stats["avg"],
+                1000 * stats["p50"],
+                1000 * stats["p99"],
+                1000 * stats["max"],
+            )
+        )
+    print("clock sync errors: {}".format(report["clock_sync_errors"]))
+    print(
+        "per camera: proxy {:.1f}% CPU, {:.1f} MiB; "
+        "forwarder {:.1f}% CPU, {:.1f} MiB".format(
+            report["proxy_cpu_percent_per_camera"],
+            report["proxy_rss_per_camera"] / 2 ** 20,
+            report["forwarder_cpu_percent_per_camera"],
+            report["forwarder_rss_per_camera"] / 2 ** 20,
+        )
+    )
+
+
+def main():
+    parser = nvr.build_parser()
+    parser.description = __doc__.splitlines()[1]
+    parser.add_argument("--cameras", "-n", type=int, default=10)
+    parser.add_argument("--duration", "-d", type=float, default=60)
+    parser.add_argument(
+        "--ramp", type=float, default=0.1, help="Seconds between camera starts"
+    )
+    parser.add_argument("--resolution", "-r", default="1280x720")
+    parser.add_argument(
+        "--clock-sync", choices=clock_sync.POLICIES, default=clock_sync.DEFAULT_POLICY
+    )
+    parser.add_argument(
+        "--clock-sync-interval", type=int, default=clock_sync.DEFAULT_INTERVAL
+    )
+    parser.add_argument("--output", "-o", help="Write the report as JSON")
+    parser.add_argument("--verbose", "-v", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    report_path = "nvr-report-{}.json".format(os.getpid())
+    ready = multiprocessing.Event()
+    # Outlive the cameras, so they're torn down before the NVR goes away
+    simulator = multiprocessing.Process(
+        target=nvr.run,
+        args=(args, ready, args.duration + args.ramp * args.cameras + 5, report_path),
+    )
+    simulator.start()
+    if not ready.wait(10):
+        sys.exit("NVR simulator failed to start")
+
+    cpu_before, _ = self_usage()
+    wall = time.monotonic()
+    started, usage = asyncio.run(run_cameras(args))
+    wall = time.monotonic() - wall
+    cpu_after, rss = self_usage()
+
+    simulator.join()
+    with open(report_path) as f:
+        sessions = json.load(f)
+    os.remove(report_path)
+
+    report = build_report(
+        args, started, usage, sessions, (cpu_after - cpu_before) / wall, rss
+    )
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Benchmarks motion detection on generated grayscale frames: a noisy static
+scene an object moves across for a while.
+
+Reports the CPU time per frame, and what that comes to in percent of a core
+per camera at the given frame rate, and checks that motion starts and stops
+around the object, and not at all when it's masked out.
+
+Also reports the CPU ffmpeg takes to decode H.264 into those frames, for each
+of the `--decode` source resolutions, if ffmpeg is installed. That's usually
+most of the cost, and why the detector uses video3 when it's transcoded.
+
+    python -m benchmarks.motion [--resolution 320x180] [--fps 5]
+        [--decode 1920x1080,640x360]
+"""
+
+import argparse
+import resource
+import shlex
+import shutil
+import subprocess
+import time
+
+import numpy as np
+
+from benchmarks.flvgen import parse_resolution
+from unifi.motion import MotionDetector, decoder_cmd
+
+# Sensor noise, out of 255
+NOISE = 6
+# Stopping can take up to 10 seconds after the object leaves, which has to
+# fit in the last third of the run
+MIN_SECONDS = 30
+SOURCE_FPS = 15
+SOURCE_GOP = 30
+DECODE_SECONDS = 20
+
+
+def encode_source(width, height, seconds=DECODE_SECONDS):
+    """
+    Returns `seconds` of a moving test pattern at `width`x`height`, as H.264
+    in FLV like a camera sends.
+    """
+    cmd = (
+        "ffmpeg -loglevel error -f lavfi -i testsrc2=size={}x{}:rate={} -t {} "
+        "-c:v libx264 -preset ultrafast -g {} -f flv pipe:1".format(
+            width, height, SOURCE_FPS, seconds, SOURCE_GOP
+        )
+    )
+    return subprocess.run(shlex.split(cmd), stdout=subprocess.PIPE, check=True).stdout
+
+
+def decoder_cpu(data, fps, width, height):
+    """
+    Runs the detector's decoder over `data`, returning its CPU time and the
+    number of frames it output.
+    """
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    proc = subprocess.run(
+        shlex.split(decoder_cmd(fps, width, height)),
+        input=data,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return cpu, len(proc.stdout) // (width * height)
+
+
+def generate_frames(width, height, frames, moving, seed=0):
+    """
+    Returns `frames` frames as bytes. An object a tenth of the picture wide
+    crosses the lower half during the frames in the `moving` range.
+    """
+    rng = np.random.default_rng(seed)
+    scene = rng.integers(40, 200, size=(height, width), dtype=np.int16)
+    size = max(1, width // 10)
+    top = height // 2
+    out = []
+    for i in range(frames):
+        frame = scene + rng.integers(-NOISE, NOISE + 1, size=scene.shape)
+        if i in moving:
+            x = (i - moving.start) * (width - size) // len(moving)
+            frame[top : top + size, x : x + size] = 250
+        out.append(np.clip(frame, 0, 255).astype(np.uint8).tobytes())
+    return out
+
+
+def run(detector, frames):
+    events = []
+    cpu = time.process_time()
+    for i, frame in enumerate(frames):
+        event = detector.feed(frame)
+        if event is not None:
+            events.append((i, event))
+    return time.process_time() - cpu, events
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--resolution", "-r", type=parse_resolution, default="320x180"
+    )
+    parser.add_argument("--fps", type=int, default=5)
+    parser.add_argument("--seconds", type=int, default=120, help="Stream seconds")
+    parser.add_argument(
+        "--decode",
+        type=lambda value: [parse_resolution(r) for r in value.split(",")],
+        default="1920x1080,640x360",
+        help="Source resolutions to measure the decoder with",
+    )
+    args = parser.parse_args()
+    if args.seconds < MIN_SECONDS:
+        parser.error("--seconds must be at least {}".format(MIN_SECONDS))
+
+    width, height = args.resolution
+    frames = args.seconds * args.fps
+    # Motion through the middle third
+    moving = range(frames // 3, 2 * frames // 3)
+    data = generate_frames(width, height, frames, moving)
+
+    detector = MotionDetector(width, height, args.fps)
+    cpu, events = run(detector, data)
+    per_frame = cpu / frames
+    print(
+        "{}x{}: {:.1f} us per frame, {:.2f}% of a core at {} fps".format(
+            width, height, 1e6 * per_frame, 100 * per_frame * args.fps, args.fps
+        )
+    )
+    for i, event in events:
+        print(
+            "  frame {:>5}: {} (level {}{})".format(
+                i,
+                event.edge,
+                event.level,
+                ", {} byte heatmap".format(len(event.heatmap))
+                if event.heatmap
+                else "",
+            )
+        )
+    edges = [event.edge for _, event in events]
+    assert edges == ["start", "stop"], edges
+    assert moving.start <= events[0][0] < moving.start + args.fps
+    # Where the object lingered has to fade from the background first
+    assert moving.stop <= events[1][0] < moving.stop + 10 * args.fps
+
+    # The object only crosses the lower half
+    masked = MotionDetector(width, height, args.fps, masks=[(0, 0.5, 1, 0.5)])
+    _, events = run(masked, data)
+    assert events == [], events
+    print("no events with the object masked out")
+
+    if shutil.which("ffmpeg") is None:
+        print("ffmpeg not found, skipping the decoder")
+        return
+    for source_width, source_height in args.decode:
+        data = encode_source(source_width, source_height)
+        cpu, decoded = decoder_cpu(data, args.fps, width, height)
+        assert decoded == DECODE_SECONDS * args.fps, decoded
+        print(
+            "decoding {}x{}: {:.2f}% of a core".format(
+                source_width, source_height, 100 * cpu / DECODE_SECONDS
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""
+A stand-in for the UniFi Video NVR, for testing cameras without one.
+
+- Serves the camera websocket on wss://<host>:7442 and walks every camera
+  that connects through adoption, video settings, analytics settings and
+  snapshot requests.
+- Accepts the video streams on TCP 6666, checking the onClockSync tags.
+- Accepts snapshot uploads over HTTPS.
+
+The certificate (and key) it serves is the same kind of PEM file the
+cameras use as client certificate.
+
+    python -m benchmarks.nvr --cert client.pem [--host 127.0.0.1]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import re
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import websockets
+
+from unifi import flv
+from unifi.ingest import NVR_STREAM_PORT
+
+WS_PORT = 7442
+UPLOAD_PORT = 7443
+REPLY_TIMEOUT = 30
+# How far an onClockSync wall clock may be from ours
+CLOCK_TOLERANCE_MS = 5000
+
+logger = logging.getLogger("nvr")
+
+
+class CameraSession(object):
+    """
+    What the NVR saw from one camera, with times from `time.time()`.
+    """
+
+    def __init__(self, mac):
+        self.mac = mac
+        self.stream_name = "sim-{}".format(mac.replace(":", "").lower())
+        self.connected_at = None
+        self.hello_at = None
+        self.adopted_at = None
+        self.video_requested_at = None
+        self.first_byte_at = None
+        self.bytes = 0
+        self.tags = 0
+        self.clock_syncs = 0
+        self.clock_sync_errors = 0
+        self.snapshot_latencies = []
+        self.pulses = 0
+        self.uploads = {}
+
+    def as_dict(self):
+        return {key: value for key, value in vars(self).items() if key != "uploads"}
+
+
+class UploadHandler(BaseHTTPRequestHandler):
+    simulator = None
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        match = re.search(rb'filename="([^"]+)"', body)
+        ok = match is not None and is_jpeg(body)
+        self.send_response(200 if ok else 400)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        if ok:
+            self.simulator.uploaded(match.group(1).decode(), time.time())
+
+    def log_message(self, format, *args):
+        pass
+
+
+def is_jpeg(body):
+    start = body.find(b"\xff\xd8")
+    return start >= 0 and body.find(b"\xff\xd9", start) > start
+
+
+class NvrSimulator(object):
+    def __init__(
+        self,
+        host,
+        cert,
+        snapshots=3,
+        pulse_interval=5,
+        upload_port=UPLOAD_PORT,
+    ):
+        self.host = host
+        self.cert = cert
+        self.snapshots = snapshots
+        self.pulse_interval = pulse_interval
+        self.upload_port = upload_port
+        self.sessions = {}
+        self.streams = {}
+        self.loop = None
+        self._msg_id = 0
+
+    def ssl_context(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.cert)
+        return context
+
+    async def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.ws_server = await websockets.serve(
+            self.handle_camera,
+            self.host,
+            WS_PORT,
+            ssl=self.ssl_context(),
+            compression=None,
+        )
+        self.stream_server = await asyncio.start_server(
+            self.handle_stream, self.host, NVR_STREAM_PORT
+        )
+
+        handler = type("Handler", (UploadHandler,), {"simulator": self})
+        self.upload_server = ThreadingHTTPServer(
+            (self.host, self.upload_port), handler
+        )
+        self.upload_server.socket = self.ssl_context().wrap_socket(
+            self.upload_server.socket, server_side=True
+        )
+        self.upload_server.daemon_threads = True
+        thread = threading.Thread(target=self.upload_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logger.info(
+            "Listening on %s:%s, %s and %s",
+            self.host,
+            WS_PORT,
+            NVR_STREAM_PORT,
+            self.upload_port,
+        )
+
+    def stop(self):
+        self.ws_server.close()
+        self.stream_server.close()
+        self.upload_server.shutdown()
+
+    def gen_msg_id(self):
+        self._msg_id += 1
+        return self._msg_id
+
+    def uploaded(self, filename, at):
+        self.loop.call_soon_threadsafe(self._uploaded, filename, at)
+
+    def _uploaded(self, filename, at):
+        mac = filename.split("-")[0]
+        session = self.sessions.get(mac)
+        if session is not None and filename in session.uploads:
+            session.uploads.pop(filename).set_result(at)
+
+    async def handle_camera(self, ws, path=None):
+        mac = ws.request_headers.get("camera-mac", "unknown")
+        session = self.sessions.setdefault(mac, CameraSession(mac))
+        session.connected_at = time.time()
+        self.streams[session.stream_name] = session
+        pending = {}
+        hello = asyncio.get_event_loop().create_future()
+
+        async def receive():
+            async for data in ws:
+                msg = json.loads(data)
+                if msg["functionName"] == "ubnt_avclient_hello":
+                    session.hello_at = time.time()
+                    if not hello.done():
+                        hello.set_result(msg)
+                elif msg["functionName"] == "EventAnalytics":
+                    session.pulses += 1
+                elif msg.get("inResponseTo") in pending:
+                    pending.pop(msg["inResponseTo"]).set_result(msg)
+
+        async def request(function_name, payload, response_expected=True):
+            msg_id = self.gen_msg_id()
+            if response_expected:
+                pending[msg_id] = asyncio.get_event_loop().create_future()
+            await ws.send(
+                json.dumps(
+                    {
+                        "from": "UniFiVideo",
+                        "to": "ubnt_avclient",
+                        "functionName": function_name,
+                        "messageId": msg_id,
+                        "inResponseTo": 0,
+                        "responseExpected": response_expected,
+                        "payload": payload,
+                    }
+                )
+            )
+            if response_expected:
+                return await asyncio.wait_for(pending[msg_id], REPLY_TIMEOUT)
+
+        receiver = asyncio.ensure_future(receive())
+        try:
+            await asyncio.wait_for(hello, REPLY_TIMEOUT)
+            await request("ubnt_avclient_paramAgreement", {})
+            session.adopted_at = time.time()
+
+            session.video_requested_at = time.time()
+            await request(
+                "ChangeVideoSettings",
+                {
+                    "video": {
+                        "video1": {
+                            "avSerializer": {
+                                "destinations": [
+                                    "tcp://{}:{}?retryInterval=1".format(
+                                        self.host, NVR_STREAM_PORT
+                                    )
+                                ],
+                                "parameters": {"streamName": session.stream_name},
+                            }
+                        },
+                        "video2": None,
+                        "video3": None,
+                    }
+                },
+            )
+            await request(
+                "ChangeAnalyticsSettings",
+                {"sendPulse": 1, "pulsePeriodSec": self.pulse_interval},
+            )
+
+            for i in range(self.snapshots):
+                filename = "{}-{}.jpg".format(mac, i)
+                uploaded = asyncio.get_event_loop().create_future()
+                session.uploads[filename] = uploaded
+                requested_at = time.time()
+                await request(
+                    "GetRequest",
+                    {
+                        "what": "snapshot",
+                        "uri": "https://{}:{}/snapshot".format(
+                            self.host, self.upload_port
+                        ),
+                        "filename": filename,
+                        "formFields": {"camera": mac},
+                    },
+                    response_expected=False,
+                )
+                try:
+                    at = await asyncio.wait_for(uploaded, REPLY_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logger.warning("%s: no snapshot upload", mac)
+                    continue
+                session.snapshot_latencies.append(at - requested_at)
+
+            await receiver
+        except (asyncio.TimeoutError, websockets.ConnectionClosed) as e:
+            logger.warning("%s: %r", mac, e)
+        finally:
+            receiver.cancel()
+
+    async def handle_stream(self, reader, writer):
+        session = None
+        expect_clock = None
+        try:
+            header = await reader.readexactly(flv.FLV_HEADER_SIZE)
+            if header[:3] != flv.FLV_SIGNATURE:
+                raise ValueError("Not a valid FLV stream")
+            while True:
+                head = await reader.readexactly(flv.TAG_HEADER_SIZE)
+                _, type, size, timestamp = flv.unpack_header(head)
+                payload = await reader.readexactly(size)
+                if session is not None:
+                    session.bytes += flv.TAG_HEADER_SIZE + size
+                    session.tags += 1
+
+                if type == flv.TAG_TYPE_SCRIPT:
+                    name, value = flv.parse_script_data(payload)
+                    if name == "onMetaData" and session is None:
+                        session = self.streams.get(value.get("streamname"))
+                        if session is None:
+                            raise ValueError(
+                                "Unknown stream {!r}".format(value.get("streamname"))
+                            )
+                        if session.first_byte_at is None:
+                            session.first_byte_at = time.time()
+                    elif name == "onClockSync" and session is not None:
+                        session.clock_syncs += 1
+                        expect_clock = value
+                        wall = value.get("wallClock", 0)
+                        if abs(wall - time.time() * 1000) > CLOCK_TOLERANCE_MS:
+                            session.clock_sync_errors += 1
+                    continue
+
+                if expect_clock is not None:
+                    # The clock sync describes the tag right after it
+                    if expect_clock.get("streamClock") != timestamp:
+                        session.clock_sync_errors += 1
+                    expect_clock = None
+        except asyncio.IncompleteReadError:
+            pass
+        except ValueError as e:
+            logger.warning("Bad stream: %s", e)
+        finally:
+            writer.close()
+
+    def report(self):
+        return {mac: session.as_dict() for mac, session in self.sessions.items()}
+
+
+async def serve(args, ready=None, duration=None):
+    simulator = NvrSimulator(
+        args.host, args.cert, args.snapshots, args.pulse_interval, args.upload_port
+    )
+    await simulator.start()
+    if ready is not None:
+        ready.set()
+    try:
+        if duration is None:
+            await asyncio.Event().wait()
+        else:
+            await asyncio.sleep(duration)
+    finally:
+        simulator.stop()
+    return simulator.report()
+
+
+def run(args, ready=None, duration=None, report_path=None):
+    """
+    Runs the simulator for `duration` seconds, or until interrupted, then
+    writes its report as JSON to `report_path`, or stdout.
+    """
+    report = {}
+
+    async def main():
+        report.update(await serve(args, ready, duration))
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    if report_path is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(report_path, "w") as f:
+            json.dump(report, f)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--cert", "-c", required=True, help="Server certificate and key"
+    )
+    parser.add_argument(
+        "--host", "-H", default="127.0.0.1", help="Address to listen on"
+    )
+    parser.add_argument("--upload-port", type=int, default=UPLOAD_PORT)
+    parser.add_argument(
+        "--snapshots", type=int, default=3, help="Snapshots to request per camera"
+    )
+    parser.add_argument("--pulse-interval", type=int, default=5)
+    return parser
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    run(build_parser().parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+A stand-in for an ONVIF camera, for testing the onvif backend without one.
+
+Answers the device and media service calls the backend makes, checking the
+WS-Security UsernameToken of every authenticated one, and serves a JPEG at
+the snapshot URI. Stream URIs are whatever ffmpeg should read the main and
+sub streams from, e.g. a file or another camera's RTSP URL.
+
+Logs every call and counts HTTP connections, which should stay at one per
+session.
+
+    python -m benchmarks.onvif --main-uri main.mp4 --sub-uri sub.mp4
+    unifi-cam-proxy ... --ip 127.0.0.1 onvif -u admin -p secret --onvif-port 8080
+"""
+
+import argparse
+import base64
+import collections
+import datetime
+import logging
+import threading
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from unifi.cams.onvif import NS_SOAP, password_digest
+
+PORT = 8080
+# Smallest thing that passes for a JPEG
+SNAPSHOT = b"\xff\xd8\xff\xe0" + bytes(1024) + b"\xff\xd9"
+
+logger = logging.getLogger("onvif")
+
+RESPONSE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<env:Envelope xmlns:env="{}" '
+    'xmlns:tds="http://www.onvif.org/ver10/device/wsdl" '
+    'xmlns:trt="http://www.onvif.org/ver10/media/wsdl" '
+    'xmlns:tt="http://www.onvif.org/ver10/schema">'
+    "<env:Body>{{}}</env:Body></env:Envelope>"
+).format(NS_SOAP)
+FAULT = (
+    "<env:Fault><env:Code><env:Value>env:Sender</env:Value></env:Code>"
+    '<env:Reason><env:Text xml:lang="en">{}</env:Text></env:Reason></env:Fault>'
+)
+PROFILE = (
+    '<trt:Profiles token="{token}" fixed="true"><tt:Name>{token}</tt:Name>'
+    '<tt:VideoEncoderConfiguration token="enc_{token}">'
+    "<tt:Name>enc_{token}</tt:Name><tt:Encoding>{encoding}</tt:Encoding>"
+    "<tt:Resolution><tt:Width>{width}</tt:Width>"
+    "<tt:Height>{height}</tt:Height></tt:Resolution>"
+    "<tt:RateControl><tt:FrameRateLimit>{fps}</tt:FrameRateLimit>"
+    "<tt:EncodingInterval>1</tt:EncodingInterval>"
+    "<tt:BitrateLimit>{bitrate}</tt:BitrateLimit></tt:RateControl>"
+    "<tt:H264><tt:GovLength>{gop}</tt:GovLength></tt:H264>"
+    "</tt:VideoEncoderConfiguration></trt:Profiles>"
+)
+
+
+def _local(tag):
+    return tag.rpartition("}")[2]
+
+
+def _child_text(element, name):
+    for e in element.iter():
+        if _local(e.tag) == name:
+            return e.text
+    return None
+
+
+class OnvifHandler(BaseHTTPRequestHandler):
+    # Keeps connections alive, so session reuse shows in the counts
+    protocol_version = "HTTP/1.1"
+    simulator = None
+
+    def setup(self):
+        super(OnvifHandler, self).setup()
+        self.simulator.connected(self.client_address)
+
+    def do_POST(self):
+        envelope = ET.fromstring(self.rfile.read(int(self.headers["Content-Length"])))
+        body = next(e for e in envelope if _local(e.tag) == "Body")
+        request = body[0]
+        action = _local(request.tag)
+        self.simulator.calls[action] += 1
+        logger.info("%s from %s:%s", action, *self.client_address)
+
+        if action != "GetSystemDateAndTime" and not self.simulator.authorized(
+            envelope
+        ):
+            return self.reply(FAULT.format("Sender not authorized"), 400)
+        handler = getattr(self.simulator, action, None)
+        if handler is None:
+            return self.reply(FAULT.format("Action not supported"), 400)
+        self.reply(handler(request))
+
+    def do_GET(self):
+        self.simulator.calls["snapshot"] += 1
+        if self.path != "/onvif/snapshot.jpg":
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(SNAPSHOT)))
+        self.end_headers()
+        self.wfile.write(SNAPSHOT)
+
+    def reply(self, body, status=200):
+        data = RESPONSE.format(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/soap+xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OnvifSimulator(object):
+    def __init__(self, host, port, username, password, main_uri, sub_uri):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        # Bitrates in kbit/s
+        self.profiles = [
+            dict(token="main", encoding="H264", width=1920, height=1080, bitrate=4096),
+            dict(token="sub", encoding="H264", width=640, height=360, bitrate=512),
+            # Left out by the backend, as it can't go in FLV
+            dict(token="mjpeg", encoding="JPEG", width=640, height=360, bitrate=2048),
+        ]
+        self.uris = {"main": main_uri, "sub": sub_uri, "mjpeg": sub_uri}
+        self.calls = collections.Counter()
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        handler = type("Handler", (OnvifHandler,), {"simulator": self})
+        self.server = ThreadingHTTPServer((self.host, self.port), handler)
+        self.server.daemon_threads = True
+        # Whichever was picked, with port 0
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logger.info("Listening on %s:%s", self.host, self.port)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def connected(self, address):
+        with self.lock:
+            self.connections += 1
+
+    def authorized(self, envelope):
+        nonce = _child_text(envelope, "Nonce")
+        created = _child_text(envelope, "Created")
+        if (
+            _child_text(envelope, "Username") != self.username
+            or nonce is None
+            or created is None
+        ):
+            return False
+        expected = password_digest(self.password, base64.b64decode(nonce), created)
+        return _child_text(envelope, "Password") == expected
+
+    def url(self, path):
+        return "http://{}:{}{}".format(self.host, self.port, path)
+
+    def GetSystemDateAndTime(self, request):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return (
+            "<tds:GetSystemDateAndTimeResponse><tds:SystemDateAndTime>"
+            "<tt:UTCDateTime><tt:Time><tt:Hour>{}</tt:Hour>"
+            "<tt:Minute>{}</tt:Minute><tt:Second>{}</tt:Second></tt:Time>"
+            "<tt:Date><tt:Year>{}</tt:Year><tt:Month>{}</tt:Month>"
+            "<tt:Day>{}</tt:Day></tt:Date></tt:UTCDateTime>"
+            "</tds:SystemDateAndTime></tds:GetSystemDateAndTimeResponse>".format(
+                now.hour, now.minute, now.second, now.year, now.month, now.day
+            )
+        )
+
+    def GetCapabilities(self, request):
+        return (
+            "<tds:GetCapabilitiesResponse><tds:Capabilities><tt:Media>"
+            "<tt:XAddr>{}</tt:XAddr></tt:Media></tds:Capabilities>"
+            "</tds:GetCapabilitiesResponse>".format(self.url("/onvif/media_service"))
+        )
+
+    def GetProfiles(self, request):
+        return "<trt:GetProfilesResponse>{}</trt:GetProfilesResponse>".format(
+            "".join(PROFILE.format(fps=15, gop=30, **p) for p in self.profiles)
+        )
+
+    def GetStreamUri(self, request):
+        return (
+            "<trt:GetStreamUriResponse><trt:MediaUri><tt:Uri>{}</tt:Uri>"
+            "</trt:MediaUri></trt:GetStreamUriResponse>".format(
+                self.uris[_child_text(request, "ProfileToken")]
+            )
+        )
+
+    def GetSnapshotUri(self, request):
+        return (
+            "<trt:GetSnapshotUriResponse><trt:MediaUri><tt:Uri>{}</tt:Uri>"
+            "</trt:MediaUri></trt:GetSnapshotUriResponse>".format(
+                self.url("/onvif/snapshot.jpg")
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", "-H", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--username", "-u", default="admin")
+    parser.add_argument("--password", "-p", default="secret")
+    parser.add_argument("--main-uri", required=True, help="Main stream source")
+    parser.add_argument("--sub-uri", required=True, help="Sub stream source")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    simulator = OnvifSimulator(
+        args.host, args.port, args.username, args.password, args.main_uri, args.sub_uri
+    )
+    simulator.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+        print(
+            "{} connections, calls: {}".format(
+                simulator.connections,
+                ", ".join(
+                    "{} {}".format(name, count)
+                    for name, count in sorted(simulator.calls.items())
+                ),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
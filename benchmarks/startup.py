@@ -0,0 +1,123 @@
+"""
+Measures how long `unifi-cam-proxy` takes from being started to saying
+hello to the NVR, and how much memory it holds by then.
+
+Starts the proxy as a fresh process against the local NVR stand-in a number
+of times and reports the median time to the hello and resident set size
+when it arrived, which is what a camera costs before it streams anything.
+
+    python -m benchmarks.startup --cert client.pem [--runs 10] [-- rtsp -s SRC]
+"""
+
+import argparse
+import asyncio
+import logging
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks import nvr
+
+HELLO_TIMEOUT = 30
+
+
+def rss_kb(pid):
+    """
+    The resident set size of `pid` in KiB, or None where /proc isn't there.
+    """
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+async def start_once(simulator, args, run):
+    mac = "AABBCC{:06X}".format(run)
+    cmd = [
+        sys.executable,
+        "-m",
+        "unifi.main",
+        "--host",
+        args.host,
+        "--cert",
+        args.cert,
+        "--token",
+        "startup",
+        "--mac",
+        mac,
+    ] + args.camera
+    started = time.time()
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while True:
+            session = simulator.sessions.get(mac)
+            if session is not None and session.hello_at is not None:
+                return session.hello_at - started, rss_kb(proc.pid)
+            if proc.poll() is not None:
+                raise RuntimeError("{} exited with {}".format(cmd, proc.returncode))
+            if time.time() - started > HELLO_TIMEOUT:
+                raise RuntimeError("No hello within {}s".format(HELLO_TIMEOUT))
+            await asyncio.sleep(0.001)
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+async def measure(args):
+    simulator = nvr.NvrSimulator(args.host, args.cert, snapshots=0)
+    await simulator.start()
+    try:
+        results = []
+        for run in range(args.runs):
+            results.append(await start_once(simulator, args, run))
+        return results
+    finally:
+        simulator.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--cert", "-c", required=True, help="Certificate for both sides"
+    )
+    parser.add_argument("--host", "-H", default="127.0.0.1")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "camera",
+        nargs=argparse.REMAINDER,
+        help="Camera implementation and its arguments (default: rtsp)",
+    )
+    args = parser.parse_args()
+    if args.camera[:1] == ["--"]:
+        args.camera = args.camera[1:]
+    if not args.camera:
+        args.camera = ["rtsp", "--source", "rtsp://127.0.0.1/startup"]
+
+    # The NVR complains about every camera killed after its hello
+    logging.basicConfig(level=logging.ERROR)
+    results = asyncio.run(measure(args))
+    hello = [seconds for seconds, _ in results]
+    rss = [kb for _, kb in results if kb is not None]
+    print(
+        "{}: hello after {:.0f} ms (min {:.0f}, max {:.0f}), {} over {} runs".format(
+            " ".join(args.camera[:1]),
+            1000 * statistics.median(hello),
+            1000 * min(hello),
+            1000 * max(hello),
+            "RSS {:.1f} MiB".format(statistics.median(rss) / 1024)
+            if rss
+            else "RSS unknown",
+            args.runs,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import io
+import random
+
+import pytest
+
+from tests.test_flv import make_stream
+from unifi import flv
+from unifi.clock_sync import POLICIES, ClockSync
+
+FPS = 15
+GOP = 30
+AUDIO_INTERVAL_MS = 23
+LATENCY_MS = 50
+JITTER_MS = 20
+DRIFT_PPM = 100
+# How much worse than the previous behaviour placement may get. With fewer
+# syncs, more tags are placed from one that jittered the other way, which
+# costs the p99 about 2 ms
+TOLERANCE_MS = JITTER_MS // 5
+
+
+class TwoInThree(ClockSync):
+    """
+    The previous behaviour: a clock sync before two out of every three tags.
+    """
+
+    def __init__(self):
+        super(TwoInThree, self).__init__()
+        self.count = 0
+
+    def due(self, tag):
+        i = self.count
+        self.count += 1
+        return i % 3 != 0
+
+
+def camera_tags(seconds=30):
+    """
+    Video at `FPS` with a keyframe every `GOP` frames, and AAC audio, as
+    (type, timestamp, payload) in stream order.
+    """
+    tags = []
+    for i in range(seconds * FPS):
+        frame_type = 1 if i % GOP == 0 else 2
+        header = bytes((frame_type << 4 | flv.VIDEO_CODEC_AVC, 1, 0, 0, 0))
+        tags.append((flv.TAG_TYPE_VIDEO, i * 1000 // FPS, header + bytes(200)))
+    for timestamp in range(0, seconds * 1000, AUDIO_INTERVAL_MS):
+        tags.append((flv.TAG_TYPE_AUDIO, timestamp, b"\xaf\x01" + bytes(20)))
+    tags.sort(key=lambda tag: tag[1])
+    return tags
+
+
+def read_tags(data):
+    reader = flv.FlvReader(io.BytesIO(data))
+    reader.read_header()
+    return reader
+
+
+def rewrite(clock_sync, data, received):
+    out = [flv.FLV_HEADER]
+    for tag, received_at in zip(read_tags(data), received):
+        out.append(b"".join(clock_sync.rewrite(tag, received_at)))
+    return b"".join(out)
+
+
+def placement_errors(data, received):
+    """
+    Reads a rewritten stream like the NVR, placing every tag after the first
+    clock sync at the wall clock time of the last one plus the difference in
+    timestamps, and returns how far off each comes out, in ms.
+    """
+    errors = []
+    sync = None
+    i = 0
+    for tag in read_tags(data):
+        if tag.type == flv.TAG_TYPE_SCRIPT:
+            name, value = flv.parse_script_data(tag.payload)
+            if name == "onClockSync":
+                sync = value
+                continue
+        if sync is not None:
+            placed = sync["wallClock"] + tag.timestamp - sync["streamClock"]
+            errors.append(abs(placed - 1000 * received[i]))
+        i += 1
+    return errors
+
+
+@pytest.fixture(scope="module")
+def stream():
+    data = make_stream(camera_tags())
+    # Received on a camera clock that drifts, over a network that jitters
+    rng = random.Random(0)
+    scale = 1 - DRIFT_PPM / 1e6
+    received = [
+        1.6e9 + (tag.timestamp * scale + LATENCY_MS + rng.uniform(0, JITTER_MS)) / 1000
+        for tag in read_tags(data)
+    ]
+    return data, received
+
+
+def p99(errors):
+    return sorted(errors)[int(0.99 * (len(errors) - 1))]
+
+
+@pytest.mark.parametrize("policy", POLICIES)
+def test_policy_accuracy(stream, policy):
+    data, received = stream
+    previous = TwoInThree()
+    previous_errors = placement_errors(rewrite(previous, data, received), received)
+
+    clock_sync = ClockSync(policy)
+    errors = placement_errors(rewrite(clock_sync, data, received), received)
+    assert len(errors) == len(received)
+    # Tags are placed from the last clock sync, so can't be off by more than
+    # the jitter between the two, give or take drift and rounding
+    assert max(errors) <= JITTER_MS + 1
+    # Nor much further off than with a sync before almost every tag
+    assert max(errors) <= max(previous_errors) + TOLERANCE_MS
+    assert p99(errors) <= p99(previous_errors) + TOLERANCE_MS
+    assert previous.injected >= 10 * clock_sync.injected
+
+
+def test_keyframe_policy_syncs_every_keyframe(stream):
+    data, received = stream
+    clock_sync = ClockSync("keyframe")
+    rewrite(clock_sync, data, received)
+    assert clock_sync.injected == sum(tag.is_keyframe for tag in read_tags(data))
+
+
+@pytest.mark.parametrize("interval", [500, 1000, 5000])
+def test_interval_policy(stream, interval):
+    data, received = stream
+    clock_sync = ClockSync("interval", interval)
+    rewritten = rewrite(clock_sync, data, received)
+    syncs = [
+        tag.timestamp
+        for tag in read_tags(rewritten)
+        if tag.type == flv.TAG_TYPE_SCRIPT
+    ]
+    assert syncs[0] == 0
+    # Each comes with the first tag at least `interval` after the last
+    gaps = [b - a for a, b in zip(syncs, syncs[1:])]
+    assert min(gaps) >= interval
+    assert max(gaps) < interval + 1000 // FPS
+
+
+def test_reset_starts_with_a_sync():
+    clock_sync = ClockSync("keyframe")
+    data = make_stream([(flv.TAG_TYPE_AUDIO, 500, b"\xaf\x01")])
+    tag = next(iter(read_tags(data)))
+    assert len(clock_sync.rewrite(tag, 1.0)) == 3
+    assert len(clock_sync.rewrite(tag, 1.0)) == 2
+    clock_sync.reset()
+    assert len(clock_sync.rewrite(tag, 1.0)) == 3
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        ClockSync("sometimes")
@@ -0,0 +1,204 @@
+import io
+import struct
+
+import pytest
+
+from unifi import flv
+
+
+class ChunkedSource(object):
+    """
+    Reads `data` in chunks of the given sizes, cycling through them, like a
+    pipe returning whatever has been written to it so far.
+    """
+
+    def __init__(self, data, *chunk_sizes):
+        self.data = data
+        self.pos = 0
+        self.chunk_sizes = chunk_sizes
+        self.reads = 0
+
+    def readinto(self, buf):
+        size = self.chunk_sizes[self.reads % len(self.chunk_sizes)]
+        self.reads += 1
+        n = min(len(buf), size, len(self.data) - self.pos)
+        buf[:n] = self.data[self.pos : self.pos + n]
+        self.pos += n
+        return n
+
+
+def make_stream(tags):
+    """
+    Builds an FLV stream out of (type, timestamp, payload) tuples.
+    """
+    out = [flv.FLV_HEADER]
+    prev_tag_size = 0
+    for type, timestamp, payload in tags:
+        out.append(flv.pack_header(prev_tag_size, type, len(payload), timestamp))
+        out.append(payload)
+        prev_tag_size = 11 + len(payload)
+    out.append(struct.pack(">I", prev_tag_size))
+    return b"".join(out)
+
+
+TAGS = [
+    (flv.TAG_TYPE_SCRIPT, 0, flv.encode_script_data("onMetaData", {"width": 1280})),
+    (flv.TAG_TYPE_VIDEO, 0, bytes((0x17, 0, 0, 0, 0)) + bytes(range(40))),
+    (flv.TAG_TYPE_AUDIO, 23, bytes((0xAF, 1)) + b"a" * 17),
+    (flv.TAG_TYPE_VIDEO, 66, bytes((0x27, 1, 0, 0, 0)) + b"p" * 300),
+    # Timestamp using the extension byte
+    (flv.TAG_TYPE_VIDEO, 0x01020304, bytes((0x27, 1, 0, 0, 0))),
+    (flv.TAG_TYPE_AUDIO, 0x01020305, b""),
+]
+
+
+def read_all(reader):
+    assert bytes(reader.read_header()) == flv.FLV_HEADER
+    return [(tag.type, tag.timestamp, bytes(tag.payload)) for tag in reader]
+
+
+@pytest.mark.parametrize("chunk_sizes", [(1,), (7,), (3, 11, 2), (4096,)])
+def test_reader_chunked(chunk_sizes):
+    source = ChunkedSource(make_stream(TAGS), *chunk_sizes)
+    assert read_all(flv.FlvReader(source, chunk_size=64)) == TAGS
+
+
+def test_reader_grows_buffer():
+    tags = [(flv.TAG_TYPE_VIDEO, 0, bytes((0x17,)) + bytes(1000))] + TAGS
+    source = ChunkedSource(make_stream(tags), 5, 100)
+    reader = flv.FlvReader(source, chunk_size=32)
+    assert read_all(reader) == tags
+    assert len(reader._buf) >= flv.TAG_HEADER_SIZE + 1001
+
+
+def test_reader_tag_properties():
+    reader = flv.FlvReader(io.BytesIO(make_stream(TAGS)))
+    reader.read_header()
+    tags = list((tag.is_keyframe, tag.is_sequence_header) for tag in reader)
+    assert tags == [
+        (False, False),
+        (True, True),
+        (False, False),
+        (False, False),
+        (False, False),
+        (False, False),
+    ]
+
+
+def test_reader_rejects_other_formats():
+    with pytest.raises(ValueError):
+        flv.FlvReader(io.BytesIO(b"GIF89a" + bytes(20))).read_header()
+    with pytest.raises(EOFError):
+        flv.FlvReader(io.BytesIO(b"FLV")).read_header()
+
+
+def test_reader_truncated_tag():
+    data = make_stream(TAGS[:2])
+    reader = flv.FlvReader(io.BytesIO(data[:-10]))
+    reader.read_header()
+    assert reader.read_tag().type == flv.TAG_TYPE_SCRIPT
+    assert reader.read_tag() is None
+
+
+def test_header_round_trip():
+    header = flv.pack_header(1234, flv.TAG_TYPE_VIDEO, 0x123456, 0x7F654321)
+    assert len(header) == flv.TAG_HEADER_SIZE
+    assert flv.unpack_header(header) == (1234, flv.TAG_TYPE_VIDEO, 0x123456, 0x7F654321)
+    assert flv.pack_tag_header(flv.TAG_TYPE_VIDEO, 0x123456, 0x7F654321) == header[4:]
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        0,
+        -1.5,
+        True,
+        False,
+        "",
+        "streamname",
+        "x" * 0x10000,
+        None,
+        [1, "two", None],
+        {"width": 1920, "name": "video1", "nested": {"ok": True}},
+        flv.EcmaArray(duration=0, encoder="Lavf", flags=[1, 2]),
+        flv.EcmaArray(),
+    ],
+)
+def test_amf_round_trip(value):
+    data = flv.amf_encode(value)
+    decoded, offset = flv.amf_decode(data)
+    assert decoded == value
+    assert type(decoded) is type(value) or isinstance(value, (int, float))
+    assert offset == len(data)
+
+
+def test_amf_decode_at_offset():
+    data = b"junk" + flv.amf_encode("name") + flv.amf_encode(flv.EcmaArray(a=1))
+    name, offset = flv.amf_decode(data, 4)
+    value, offset = flv.amf_decode(data, offset)
+    assert (name, value, offset) == ("name", {"a": 1}, len(data))
+    assert isinstance(value, flv.EcmaArray)
+
+
+def test_amf_encode_unsupported():
+    with pytest.raises(TypeError):
+        flv.amf_encode(object())
+
+
+def test_script_data_round_trip():
+    payload = flv.encode_script_data("onMetaData", flv.EcmaArray(fps=15))
+    assert flv.parse_script_data(payload) == ("onMetaData", {"fps": 15})
+    assert flv.parse_script_data(flv.amf_encode("onCuePoint")) == ("onCuePoint", None)
+
+
+def test_make_script_tag():
+    value = {"streamClock": 0.0, "wallClock": 1.5}
+    data = flv.encode_script_data("onClockSync", value)
+    tag = flv.make_script_tag("onClockSync", value, timestamp=0x01000002)
+
+    assert len(tag) == 11 + len(data) + 4
+    assert struct.unpack(">I", tag[-4:])[0] == 11 + len(data)
+    _, type, size, timestamp = flv.unpack_header(bytes(4) + tag)
+    assert (type, size, timestamp) == (flv.TAG_TYPE_SCRIPT, len(data), 0x01000002)
+    assert tag[11:-4] == data
+
+
+class PartialWriter(object):
+    """
+    Vectored writer accepting at most `limit` bytes per call.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.out = bytearray()
+        self.calls = 0
+
+    def __call__(self, buffers):
+        self.calls += 1
+        data = b"".join(bytes(b) for b in buffers)[: self.limit]
+        self.out += data
+        return len(data)
+
+
+@pytest.mark.parametrize("limit", [1, 3, 5, 100])
+def test_write_all_partial_writes(limit):
+    buffers = [b"abc", memoryview(b"defgh"), b"", bytearray(b"ij")]
+    writer = PartialWriter(limit)
+    flv.write_all(writer, buffers)
+    assert bytes(writer.out) == b"abcdefghij"
+    assert writer.calls == -(-10 // limit)
+
+
+@pytest.mark.parametrize(
+    "num_bytes, expected",
+    [
+        (0, [b"abc", b"def"]),
+        (2, [b"c", b"def"]),
+        (3, [b"def"]),
+        (4, [b"ef"]),
+        (6, []),
+    ],
+)
+def test_advance(num_bytes, expected):
+    assert [bytes(b) for b in flv._advance([b"abc", b"def"], num_bytes)] == expected
+
@@ -0,0 +1,128 @@
+import io
+import threading
+
+import pytest
+
+from unifi import flv
+from unifi.ingest import FlvOutput, TagSource
+
+QUEUE_LIMIT = 1000
+
+
+class HeldOutput(FlvOutput):
+    """
+    Collects what it writes, but only starts writing once released, so
+    everything fed before then stays queued.
+    """
+
+    def __init__(self, queue_limit=QUEUE_LIMIT):
+        super(HeldOutput, self).__init__(queue_limit=queue_limit)
+        self.released = threading.Event()
+        self.out = bytearray()
+
+    def open(self):
+        self.released.wait()
+
+    def write(self, buffers):
+        for buf in buffers:
+            self.out += buf
+
+    def drain(self):
+        """
+        Writes out everything queued, returning the (type, payload) of every
+        tag written after the preamble.
+        """
+        self.released.set()
+        self.stop()
+        self.thread.join(5)
+        assert not self.thread.is_alive()
+        reader = flv.FlvReader(io.BytesIO(bytes(self.out)))
+        reader.read_header()
+        return [
+            (tag.type, bytes(tag.payload))
+            for tag in reader
+            if tag.type != flv.TAG_TYPE_SCRIPT
+        ]
+
+
+def keyframe(size):
+    return flv.TAG_TYPE_VIDEO, bytes((0x17, 1, 0, 0, 0)) + bytes(size - 5)
+
+
+def interframe(size):
+    return flv.TAG_TYPE_VIDEO, bytes((0x27, 1, 0, 0, 0)) + bytes(size - 5)
+
+
+def audio(size):
+    return flv.TAG_TYPE_AUDIO, b"\xaf\x01" + bytes(size - 2)
+
+
+VIDEO_CONFIG = (flv.TAG_TYPE_VIDEO, bytes((0x17, 0, 0, 0, 0)) + bytes(30))
+AUDIO_CONFIG = (flv.TAG_TYPE_AUDIO, b"\xaf\x00\x12\x10")
+
+
+@pytest.fixture
+def output():
+    output = HeldOutput()
+    TagSource().add_output(output)
+    yield output
+    output.released.set()
+    output.stop()
+
+
+def feed(output, tags):
+    for i, (type, payload) in enumerate(tags):
+        header = flv.pack_header(0, type, len(payload), i)
+        tag = flv.Tag(type, len(payload), i, header, payload)
+        output.feed(tag, (type, i, payload, 1.6e9))
+
+
+def test_video_dropped_until_next_keyframe_that_fits(output):
+    tags = [
+        keyframe(400),
+        interframe(400),
+        # Doesn't fit, and nothing after it decodes until a keyframe
+        interframe(400),
+        interframe(10),
+        keyframe(400),
+        # Fits, and ends the drop
+        keyframe(100),
+        interframe(50),
+    ]
+    feed(output, tags)
+    assert output.stats.queued_bytes == 950
+    assert output.stats.dropped_tags == 3
+    assert output.stats.dropped_bytes == 810
+
+    assert output.drain() == [tags[i] for i in (0, 1, 5, 6)]
+    assert output.stats.queued_bytes == 0
+
+
+def test_audio_dropped_only_when_it_does_not_fit(output):
+    tags = [keyframe(900), audio(200), audio(50), interframe(40), audio(10)]
+    feed(output, tags)
+    assert output.stats.dropped_tags == 1
+    assert not output.dropping
+
+    assert output.drain() == [tags[i] for i in (0, 2, 3, 4)]
+    assert output.stats.queued_bytes == 0
+
+
+def test_sequence_headers_never_dropped(output):
+    tags = [keyframe(QUEUE_LIMIT), VIDEO_CONFIG, interframe(10), AUDIO_CONFIG]
+    feed(output, tags)
+    assert output.dropping
+    assert output.stats.dropped_tags == 1
+    assert output.stats.queued_bytes > QUEUE_LIMIT
+
+    assert output.drain() == [tags[i] for i in (0, 1, 3)]
+    assert output.stats.queued_bytes == 0
+
+
+def test_waits_for_a_keyframe(output):
+    tags = [VIDEO_CONFIG, interframe(10), audio(10), keyframe(20), audio(10)]
+    feed(output, tags)
+    assert output.stats.dropped_tags == 0
+
+    assert output.drain() == tags[3:]
+    assert output.stats.queued_bytes == 0
@@ -0,0 +1,116 @@
+import argparse
+import logging
+
+import pytest
+
+from benchmarks.onvif import SNAPSHOT, OnvifSimulator
+from unifi.cams.onvif import OnvifCam, OnvifClient, OnvifError, with_credentials
+
+USERNAME = "admin"
+PASSWORD = "p@ss:w/rd"
+MAIN_URI = "rtsp://127.0.0.1/main"
+SUB_URI = "rtsp://127.0.0.1/sub"
+CREDENTIALS = "admin:p%40ss%3Aw%2Frd@"
+
+
+@pytest.fixture
+def simulator():
+    simulator = OnvifSimulator("127.0.0.1", 0, USERNAME, PASSWORD, MAIN_URI, SUB_URI)
+    simulator.start()
+    yield simulator
+    simulator.stop()
+
+
+def make_cam(simulator):
+    parser = argparse.ArgumentParser()
+    OnvifCam.add_parser(parser)
+    args = parser.parse_args(
+        ["-u", USERNAME, "-p", PASSWORD, "--onvif-port", str(simulator.port)]
+    )
+    args.ip = simulator.host
+    args.name = "onvif"
+    args.host = "127.0.0.1"
+    return OnvifCam(args, logging.getLogger("onvif"))
+
+
+def make_client(simulator, password=PASSWORD):
+    client = OnvifClient(simulator.host, simulator.port, USERNAME, password)
+    client.connect()
+    return client
+
+
+def test_profiles_largest_first_without_jpeg(simulator):
+    simulator.profiles.insert(
+        0, dict(token="mid", encoding="H264", width=1280, height=720, bitrate=1024)
+    )
+    simulator.uris["mid"] = "rtsp://127.0.0.1/mid"
+
+    profiles = make_client(simulator).get_profiles()
+    assert [p["token"] for p in profiles] == ["main", "mid", "sub"]
+    assert profiles[0]["width"] == 1920
+    assert profiles[0]["fps"] == 15
+    assert profiles[0]["bitrate"] == 4096
+
+    profiles = make_cam(simulator).get_profiles()
+    assert {name: p["token"] for name, p in profiles.items()} == {
+        "video1": "main",
+        "video2": "mid",
+        "video3": "sub",
+    }
+    assert profiles["video3"]["uri"] == "rtsp://{}127.0.0.1/sub".format(CREDENTIALS)
+
+
+def test_single_profile(simulator):
+    simulator.profiles = [p for p in simulator.profiles if p["token"] != "sub"]
+
+    cam = make_cam(simulator)
+    profiles = cam.get_profiles()
+    assert [p["token"] for _, p in sorted(profiles.items())] == ["main"] * 3
+    # Looked up once, and shared
+    assert simulator.calls["GetStreamUri"] == 1
+    assert cam.get_video_profiles()["video3"]["width"] == 1920
+
+
+@pytest.mark.parametrize(
+    "uri, expected",
+    [
+        ("rtsp://cam:554/live", "rtsp://{}cam:554/live".format(CREDENTIALS)),
+        ("rtsps://cam/live?a=1", "rtsps://{}cam/live?a=1".format(CREDENTIALS)),
+        # Credentials the camera gave are kept
+        ("rtsp://other:pw@cam/live", "rtsp://other:pw@cam/live"),
+        ("http://cam/live", "http://cam/live"),
+    ],
+)
+def test_with_credentials(uri, expected):
+    assert with_credentials(uri, USERNAME, PASSWORD) == expected
+
+
+def test_bad_password(simulator):
+    with pytest.raises(OnvifError, match="not authorized"):
+        make_client(simulator, password="wrong")
+
+
+def test_snapshots_reuse_connection(simulator):
+    cam = make_cam(simulator)
+    for _ in range(3):
+        assert cam.get_snapshot() == SNAPSHOT
+    assert simulator.calls["snapshot"] == 3
+    assert simulator.connections == 1
+
+
+def test_missing_stream_uri(simulator):
+    simulator.GetStreamUri = lambda request: "<trt:GetStreamUriResponse/>"
+    with pytest.raises(OnvifError, match="no stream URI"):
+        make_client(simulator).get_stream_uri("main")
+    with pytest.raises(OnvifError):
+        make_cam(simulator).get_profiles()
+
+
+def test_missing_resolution(simulator):
+    simulator.GetProfiles = lambda request: (
+        '<trt:GetProfilesResponse><trt:Profiles token="main">'
+        "<tt:VideoEncoderConfiguration><tt:Encoding>H264</tt:Encoding>"
+        "</tt:VideoEncoderConfiguration></trt:Profiles></trt:GetProfilesResponse>"
+    )
+    with pytest.raises(OnvifError, match="no resolution"):
+        make_client(simulator).get_profiles()
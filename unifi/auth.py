@@ -0,0 +1,140 @@
+import functools
+import hashlib
+import os
+import re
+import threading
+import time
+from urllib.parse import urlparse
+
+from requests.auth import AuthBase
+from requests.utils import parse_dict_header
+
+_HASHES = {
+    "MD5": hashlib.md5,
+    "MD5-SESS": hashlib.md5,
+    "SHA": hashlib.sha1,
+    "SHA-256": hashlib.sha256,
+    "SHA-512": hashlib.sha512,
+}
+_DIGEST = re.compile(r"digest ", flags=re.IGNORECASE)
+
+
+class SharedDigestAuth(AuthBase):
+    """
+    HTTP digest auth that shares the server's challenge between threads, so
+    only the first request on a session has to go through the 401, rather
+    than the first request from each executor thread.
+
+    The challenge and nonce count are shared, under a lock. Whether a
+    request has been retried yet is kept with the request itself, so a
+    stale nonce is retried on whichever thread it was sent from.
+    """
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.lock = threading.Lock()
+        self.chal = {}
+        self.last_nonce = ""
+        self.nonce_count = 0
+
+    def build_digest_header(self, method, url):
+        with self.lock:
+            chal = self.chal
+            nonce = chal["nonce"]
+            if nonce == self.last_nonce:
+                self.nonce_count += 1
+            else:
+                self.last_nonce = nonce
+                self.nonce_count = 1
+            nonce_count = self.nonce_count
+
+        realm = chal["realm"]
+        qop = chal.get("qop")
+        algorithm = chal.get("algorithm")
+        opaque = chal.get("opaque")
+        hash_func = _HASHES.get((algorithm or "MD5").upper())
+        if hash_func is None:
+            return None
+
+        def digest(value):
+            return hash_func(value.encode("utf-8")).hexdigest()
+
+        parts = urlparse(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        ncvalue = "{:08x}".format(nonce_count)
+        cnonce = hashlib.sha1(
+            str(nonce_count).encode("utf-8")
+            + nonce.encode("utf-8")
+            + time.ctime().encode("utf-8")
+            + os.urandom(8)
+        ).hexdigest()[:16]
+
+        ha1 = digest("{}:{}:{}".format(self.username, realm, self.password))
+        if (algorithm or "").upper() == "MD5-SESS":
+            ha1 = digest("{}:{}:{}".format(ha1, nonce, cnonce))
+        ha2 = digest("{}:{}".format(method, path))
+        if not qop:
+            response = digest("{}:{}:{}".format(ha1, nonce, ha2))
+        elif "auth" in qop.split(","):
+            response = digest(
+                "{}:{}:{}:{}:auth:{}".format(ha1, nonce, ncvalue, cnonce, ha2)
+            )
+        else:
+            # auth-int isn't supported
+            return None
+
+        header = 'username="{}", realm="{}", nonce="{}", uri="{}", '.format(
+            self.username, realm, nonce, path
+        )
+        header += 'response="{}"'.format(response)
+        if opaque:
+            header += ', opaque="{}"'.format(opaque)
+        if algorithm:
+            header += ', algorithm="{}"'.format(algorithm)
+        if qop:
+            header += ', qop="auth", nc={}, cnonce="{}"'.format(ncvalue, cnonce)
+        return "Digest " + header
+
+    def handle_401(self, r, pos=None, **kwargs):
+        """
+        Retries a request that was challenged once, answering the challenge,
+        which becomes the one shared by later requests.
+        """
+        challenge = r.headers.get("www-authenticate", "")
+        if not 400 <= r.status_code < 500 or "digest" not in challenge.lower():
+            return r
+        if pos is not None:
+            r.request.body.seek(pos)
+        with self.lock:
+            self.chal = parse_dict_header(_DIGEST.sub("", challenge, count=1))
+
+        # Consume the response, so the retry can reuse its connection
+        r.content
+        r.close()
+        prep = r.request.copy()
+        auth = self.build_digest_header(prep.method, prep.url)
+        if auth:
+            prep.headers["Authorization"] = auth
+        retry = r.connection.send(prep, **kwargs)
+        retry.history.append(r)
+        retry.request = prep
+        return retry
+
+    def __call__(self, r):
+        with self.lock:
+            challenged = bool(self.chal)
+        # Skip the 401 once there's a challenge to answer
+        if challenged:
+            auth = self.build_digest_header(r.method, r.url)
+            if auth:
+                r.headers["Authorization"] = auth
+        tell = getattr(r.body, "tell", None)
+        r.register_hook(
+            "response",
+            functools.partial(self.handle_401, pos=tell() if tell else None),
+        )
+        return r
@@ -0,0 +1,59 @@
+"""
+Camera implementations, by the name they're selected with on the command
+line. Each is only imported once selected, so the dependencies of the
+others are never loaded.
+
+Other packages can provide implementations through entry points in the
+`unifi_cam_proxy.cams` group, pointing at a `UnifiCamBase` subclass.
+"""
+
+import importlib
+
+ENTRY_POINT_GROUP = "unifi_cam_proxy.cams"
+
+CAMS = {
+    "hikvision": "unifi.cams.hikvision:HikvisionCam",
+    "onvif": "unifi.cams.onvif:OnvifCam",
+    "rtsp": "unifi.cams.rtsp:RTSPCam",
+}
+
+_plugins = None
+
+
+def _entry_points():
+    global _plugins
+    if _plugins is None:
+        _plugins = {}
+        try:
+            from importlib.metadata import entry_points
+        except ImportError:
+            # Python 3.7
+            return _plugins
+        eps = entry_points()
+        if hasattr(eps, "select"):
+            eps = eps.select(group=ENTRY_POINT_GROUP)
+        else:
+            eps = eps.get(ENTRY_POINT_GROUP, [])
+        for ep in eps:
+            _plugins.setdefault(ep.name, ep.value)
+    return _plugins
+
+
+def available():
+    """
+    Returns the names of every camera implementation, built in ones first.
+    """
+    names = list(CAMS)
+    names.extend(name for name in _entry_points() if name not in CAMS)
+    return names
+
+
+def load(name):
+    """
+    Imports and returns the camera implementation called `name`.
+    """
+    target = CAMS.get(name) or _entry_points().get(name)
+    if target is None:
+        raise KeyError("Unknown camera implementation: {}".format(name))
+    module, _, attr = target.partition(":")
+    return getattr(importlib.import_module(module), attr)
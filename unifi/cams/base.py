@@ -1,5 +1,10 @@
 import logging
 
+from unifi.clock_sync import ClockSync
+from unifi.ingest import FlvForwarder
+from unifi.supervisor import get_supervisor
+from unifi.transcode import PROFILES
+
 
 class UnifiCamBase(object):
     def __init__(self, args, logger=None):
@@ -10,8 +15,32 @@ class UnifiCamBase(object):
             self.logger = logger
 
     def get_snapshot(self):
+        """
+        Returns the camera's current picture as JPEG bytes, or None.
+        """
         raise NotImplementedError("You need to write this!")
 
+    def start_motion_detection(self, on_event):
+        """
+        Starts calling `on_event` with every `unifi.motion.MotionEvent`, from
+        a background thread, for cameras that detect motion.
+        """
+        pass
+
+    def get_motion_level(self):
+        """
+        Returns the share of the picture currently moving, in percent.
+        """
+        return 0
+
+    def get_video_profiles(self):
+        """
+        Returns the resolution, fps, GOP length and bitrates advertised to the
+        NVR for each of video1, video2 and video3, which should match what
+        `start_video_stream` sends.
+        """
+        return PROFILES
+
     def get_video_settings(self):
         return {}
 
@@ -20,3 +49,45 @@ class UnifiCamBase(object):
 
     def start_video_stream(self, stream_name, options):
         raise NotImplementedError("You need to write this!")
+
+    def stop_video_stream(self, stream_name):
+        """
+        Stops sending `stream_name` to the NVR, once it has asked for the
+        stream under another name, and stops the supervisor restarting it.
+        """
+        stream = self.streams.pop(stream_name, None)
+        if stream is None:
+            return
+        self.logger.info("Stopping stream (%s)", stream_name)
+        get_supervisor().unwatch(self.pipeline_name(stream_name))
+        stream.stop()
+
+    def start_forwarder(self, stream_name, cmd):
+        """
+        Start forwarding the FLV output of `cmd` to the NVR as `stream_name`,
+        unless a forwarder for that stream is already running. Once started,
+        the forwarder is restarted by the supervisor whenever it stalls.
+        """
+        if stream_name in self.streams and self.streams[stream_name].poll() is None:
+            return
+        self.logger.info("Spawning ffmpeg (%s): %s", stream_name, cmd)
+        forwarder = FlvForwarder(
+            stream_name,
+            cmd,
+            self.args.host,
+            logger=self.logger,
+            clock_sync=self.clock_sync(),
+        )
+        forwarder.start()
+        self.streams[stream_name] = forwarder
+        get_supervisor().watch(self.pipeline_name(stream_name), forwarder)
+
+    def clock_sync(self):
+        """
+        Returns a `ClockSync` for a new stream to the NVR, injecting clock
+        syncs as often as the command line asks.
+        """
+        return ClockSync(self.args.clock_sync, self.args.clock_sync_interval)
+
+    def pipeline_name(self, stream_name):
+        return "{}/{}".format(self.args.name, stream_name)
@@ -1,18 +1,20 @@
 import logging
-import os
-import subprocess
-import sys
-import shutil
+import threading
+import time
 
-import tempfile
 import requests
 import xmltodict
 from requests.auth import HTTPDigestAuth
 from hikvisionapi import Client
 
+from unifi.auth import SharedDigestAuth
 from unifi.cams.base import UnifiCamBase
+from unifi.snapshot import SnapshotCache
 
-FNULL = open(os.devnull, "w")
+SNAPSHOT_TIMEOUT = 5
+# Slider drags are sent as a single move to the latest position
+PTZ_MOVE_DELAY = 0.25
+PTZ_STATUS_TTL = 5.0
 
 
 class HikvisionCam(UnifiCamBase):
@@ -20,44 +22,123 @@ class HikvisionCam(UnifiCamBase):
     def add_parser(self, parser):
         parser.add_argument("--username", "-u", required=True, help="Camera username")
         parser.add_argument("--password", "-p", required=True, help="Camera password")
+        parser.add_argument(
+            "--snapshot-ttl",
+            type=float,
+            default=0,
+            help="Seconds a snapshot may be reused for (default: always fetch)",
+        )
 
     def __init__(self, args, logger=None):
         self.logger = logger
         self.args = args
-        self.dir = tempfile.mkdtemp()
         self.streams = {}
         self.cam = Client(
             "http://{}".format(self.args.ip), self.args.username, self.args.password
         )
+        if isinstance(self.cam.req.auth, HTTPDigestAuth):
+            self.cam.req.auth = SharedDigestAuth(
+                self.args.username, self.args.password
+            )
+        self.snapshot_url = "http://{}/ISAPI/Streaming/channels/102/picture".format(
+            self.args.ip
+        )
+        # Snapshots are captured on demand, shared by concurrent requests
+        self.snapshots = SnapshotCache(
+            self.capture_snapshot, ttl=self.args.snapshot_ttl, logger=logger
+        )
+        self.ptz_lock = threading.Lock()
+        # Position waiting to be sent, and last known or requested position,
+        # both as ISP settings
+        self.ptz_target = None
+        self.ptz_settings = None
+        self.ptz_settings_at = 0.0
+        self.ptz_timer = None
+
+    def capture_snapshot(self):
+        # Goes through the client's kept-alive session
+        resp = self.cam.req.get(self.snapshot_url, timeout=SNAPSHOT_TIMEOUT)
+        resp.raise_for_status()
+        return resp.content
 
     def get_snapshot(self):
-        img_file = "{}/screen.jpg".format(self.dir)
-        resp = self.cam.Streaming.channels[102].picture(
-            method="get", type="opaque_data"
-        )
-        with open(img_file, "wb") as f:
-            for chunk in resp.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
-        return img_file
+        return self.snapshots.get()
 
     def get_video_settings(self):
+        """
+        Returns the PTZ position as ISP settings, from the cache while it's
+        fresh or a move is on its way.
+        """
+        with self.ptz_lock:
+            if self.ptz_settings is not None and (
+                self.ptz_target is not None
+                or time.monotonic() - self.ptz_settings_at < PTZ_STATUS_TTL
+            ):
+                return dict(self.ptz_settings)
+
         r = self.cam.PTZCtrl.channels[1].status(method="get")["PTZStatus"][
             "AbsoluteHigh"
         ]
-        return {
+        settings = {
             # Tilt/elevation
-            "brightness": int(100 * int(r["azimuth"]) / 3600),
+            "brightness": int(100 * int(r["elevation"]) / 900),
             # Pan/azimuth
             "contrast": int(100 * int(r["azimuth"]) / 3600),
             # Zoom
             "hue": int(100 * int(r["absoluteZoom"]) / 40),
         }
+        with self.ptz_lock:
+            # A move requested in the meantime takes precedence
+            if self.ptz_target is None:
+                self.ptz_settings = settings
+                self.ptz_settings_at = time.monotonic()
+            return dict(self.ptz_settings)
 
     def change_video_settings(self, options):
-        tilt = int((900 * int(options["brightness"])) / 100)
-        pan = int((3600 * int(options["contrast"])) / 100)
-        zoom = int((40 * int(options["hue"])) / 100)
+        """
+        Queues a move to the position set by the ISP sliders. Moves
+        requested within `PTZ_MOVE_DELAY` of each other, or while the
+        previous one is being sent, are coalesced into one to the latest
+        position.
+        """
+        settings = {
+            "brightness": int(options["brightness"]),
+            "contrast": int(options["contrast"]),
+            "hue": int(options["hue"]),
+        }
+        with self.ptz_lock:
+            self.ptz_target = settings
+            self.ptz_settings = settings
+            self.ptz_settings_at = time.monotonic()
+            if self.ptz_timer is None:
+                self.ptz_timer = threading.Timer(PTZ_MOVE_DELAY, self.move)
+                self.ptz_timer.daemon = True
+                self.ptz_timer.start()
+
+    def move(self):
+        while True:
+            with self.ptz_lock:
+                settings = self.ptz_target
+                self.ptz_target = None
+                if settings is None:
+                    self.ptz_timer = None
+                    return
+            try:
+                self.send_move(settings)
+            except requests.RequestException as e:
+                self.logger.warning("PTZ move failed: %s", e)
+                with self.ptz_lock:
+                    # Read back where the camera actually is next time
+                    self.ptz_settings_at = 0.0
+                continue
+            with self.ptz_lock:
+                # Keep reporting the target while the camera gets there
+                self.ptz_settings_at = time.monotonic()
+
+    def send_move(self, settings):
+        tilt = int((900 * settings["brightness"]) / 100)
+        pan = int((3600 * settings["contrast"]) / 100)
+        zoom = int((40 * settings["hue"]) / 100)
 
         self.logger.info("Moving to %s:%s:%s", pan, tilt, zoom)
         req = {
@@ -84,14 +165,7 @@ class HikvisionCam(UnifiCamBase):
             self.args.username, self.args.password, self.args.ip, channel
         )
 
-        cmd = 'ffmpeg -y -f lavfi -i aevalsrc=0 -i "{}" -vcodec copy -use_wallclock_as_timestamps 1 -strict -2 -c:a aac -metadata streamname={} -f flv - | {} -m unifi.clock_sync | nc {} 6666'.format(
-            vid_src, stream_name, sys.executable, self.args.host
+        cmd = 'ffmpeg -y -f lavfi -i aevalsrc=0 -i "{}" -vcodec copy -use_wallclock_as_timestamps 1 -strict -2 -c:a aac -metadata streamname={} -f flv -'.format(
+            vid_src, stream_name
         )
-        self.logger.info("Spawning ffmpeg: %s", cmd)
-        if (
-            stream_name not in self.streams
-            or self.streams[stream_name].poll() is not None
-        ):
-            self.streams[stream_name] = subprocess.Popen(
-                cmd, stdout=FNULL, stderr=subprocess.STDOUT, shell=True
-            )
+        self.start_forwarder(stream_name, cmd)
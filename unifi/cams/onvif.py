@@ -0,0 +1,409 @@
+"""
+Cameras speaking ONVIF (Profile S). The camera's own main and sub streams
+are forwarded as they are, so nothing is transcoded, and snapshots come
+from the camera's snapshot URI rather than from decoding a stream.
+"""
+
+import base64
+import datetime
+import hashlib
+import os
+import shlex
+import subprocess
+import threading
+import xml.etree.ElementTree as ET
+from urllib.parse import quote, urlsplit, urlunsplit
+
+import requests
+
+from unifi.auth import SharedDigestAuth
+from unifi.cams.base import UnifiCamBase
+from unifi.ingest import FNULL
+from unifi.snapshot import SnapshotCache
+from unifi.transcode import PROFILES
+
+SOAP_TIMEOUT = 10
+SNAPSHOT_TIMEOUT = 5
+
+NS_SOAP = "http://www.w3.org/2003/05/soap-envelope"
+NS_WSSE = (
+    "http://docs.oasis-open.org/wss/2004/01/"
+    "oasis-200401-wss-wssecurity-secext-1.0.xsd"
+)
+NS_WSU = (
+    "http://docs.oasis-open.org/wss/2004/01/"
+    "oasis-200401-wss-wssecurity-utility-1.0.xsd"
+)
+PASSWORD_DIGEST = (
+    "http://docs.oasis-open.org/wss/2004/01/"
+    "oasis-200401-wss-username-token-profile-1.0#PasswordDigest"
+)
+NS_DEVICE = "http://www.onvif.org/ver10/device/wsdl"
+NS_MEDIA = "http://www.onvif.org/ver10/media/wsdl"
+NS_SCHEMA = "http://www.onvif.org/ver10/schema"
+
+ENVELOPE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<s:Envelope xmlns:s="{soap}"><s:Header>{header}</s:Header>'
+    "<s:Body>{body}</s:Body></s:Envelope>"
+)
+SECURITY = (
+    '<Security s:mustUnderstand="1" xmlns="{wsse}"><UsernameToken>'
+    "<Username>{username}</Username>"
+    '<Password Type="{digest_type}">{digest}</Password>'
+    "<Nonce>{nonce}</Nonce>"
+    '<Created xmlns="{wsu}">{created}</Created>'
+    "</UsernameToken></Security>"
+)
+
+
+class OnvifError(Exception):
+    pass
+
+
+def _local(tag):
+    return tag.rpartition("}")[2]
+
+
+def _find(element, *path):
+    """
+    Finds the first descendant along `path`, by local names, whatever the
+    namespaces the camera uses. Returns None if there's none.
+    """
+    for name in path:
+        if element is None:
+            return None
+        element = next((e for e in element.iter() if _local(e.tag) == name), None)
+    return element
+
+
+def _text(element, *path, default=None):
+    element = _find(element, *path)
+    if element is None or element.text is None:
+        return default
+    return element.text.strip()
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def password_digest(password, nonce, created):
+    """
+    WS-Security UsernameToken digest: Base64(SHA1(nonce + created + password)).
+    """
+    sha = hashlib.sha1(nonce + created.encode("utf-8") + password.encode("utf-8"))
+    return base64.b64encode(sha.digest()).decode("ascii")
+
+
+def with_credentials(uri, username, password):
+    parts = urlsplit(uri)
+    if not parts.scheme.startswith("rtsp") or "@" in parts.netloc:
+        return uri
+    netloc = "{}:{}@{}".format(
+        quote(username, safe=""), quote(password, safe=""), parts.netloc
+    )
+    return urlunsplit(parts._replace(netloc=netloc))
+
+
+class OnvifClient(object):
+    """
+    Just enough SOAP to read a camera's media profiles and URIs, over one
+    kept-alive HTTP session, with WS-Security UsernameToken authentication.
+    """
+
+    def __init__(self, host, port, username, password):
+        self.username = username
+        self.password = password
+        self.device_url = "http://{}:{}/onvif/device_service".format(host, port)
+        self.media_url = None
+        # Camera clock minus ours, as tokens are only valid for a few minutes
+        # around the camera's time
+        self.clock_offset = datetime.timedelta(0)
+        self.session = requests.Session()
+        self.session.auth = SharedDigestAuth(username, password)
+
+    def security_header(self):
+        nonce = os.urandom(16)
+        created = (utcnow() + self.clock_offset).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        return SECURITY.format(
+            wsse=NS_WSSE,
+            wsu=NS_WSU,
+            username=self.username,
+            digest_type=PASSWORD_DIGEST,
+            digest=password_digest(self.password, nonce, created),
+            nonce=base64.b64encode(nonce).decode("ascii"),
+            created=created,
+        )
+
+    def call(self, url, body, authenticate=True):
+        """
+        Posts the SOAP `body` and returns the parsed response body.
+        """
+        envelope = ENVELOPE.format(
+            soap=NS_SOAP,
+            header=self.security_header() if authenticate else "",
+            body=body,
+        )
+        r = self.session.post(
+            url,
+            data=envelope.encode("utf-8"),
+            headers={"Content-Type": "application/soap+xml; charset=utf-8"},
+            timeout=SOAP_TIMEOUT,
+        )
+        try:
+            root = ET.fromstring(r.content)
+        except ET.ParseError:
+            r.raise_for_status()
+            raise OnvifError("Invalid SOAP response from {}".format(url))
+        fault = _find(root, "Fault")
+        if fault is not None:
+            raise OnvifError(
+                "SOAP fault from {}: {}".format(
+                    url, _text(fault, "Reason", "Text", default="unknown")
+                )
+            )
+        r.raise_for_status()
+        return _find(root, "Body")
+
+    def sync_clock(self):
+        body = self.call(
+            self.device_url,
+            '<GetSystemDateAndTime xmlns="{}"/>'.format(NS_DEVICE),
+            authenticate=False,
+        )
+        utc = _find(body, "UTCDateTime")
+        if utc is None:
+            return
+        camera = datetime.datetime(
+            *(
+                int(_text(utc, field))
+                for field in ("Year", "Month", "Day", "Hour", "Minute", "Second")
+            ),
+            tzinfo=datetime.timezone.utc,
+        )
+        self.clock_offset = camera - utcnow()
+
+    def connect(self):
+        """
+        Finds the media service. Has to be called before anything else.
+        """
+        try:
+            self.sync_clock()
+        except (OnvifError, requests.RequestException, TypeError, ValueError):
+            # Optional, and some cameras want it authenticated
+            pass
+        body = self.call(
+            self.device_url,
+            '<GetCapabilities xmlns="{}"><Category>Media</Category>'
+            "</GetCapabilities>".format(NS_DEVICE),
+        )
+        self.media_url = _text(body, "Media", "XAddr")
+        if not self.media_url:
+            raise OnvifError("Camera has no media service")
+
+    def get_profiles(self):
+        """
+        Returns the camera's H.264 profiles, as dicts with the profile
+        `token` and its encoder settings, largest first.
+        """
+        body = self.call(self.media_url, '<GetProfiles xmlns="{}"/>'.format(NS_MEDIA))
+        profiles = []
+        for element in body.iter():
+            if _local(element.tag) != "Profiles":
+                continue
+            encoder = _find(element, "VideoEncoderConfiguration")
+            if encoder is None or _text(encoder, "Encoding") != "H264":
+                continue
+            token = element.get("token")
+            width = _text(encoder, "Resolution", "Width")
+            height = _text(encoder, "Resolution", "Height")
+            if width is None or height is None:
+                raise OnvifError("Profile {} has no resolution".format(token))
+            profiles.append(
+                {
+                    "token": token,
+                    "name": _text(element, "Name"),
+                    "width": int(width),
+                    "height": int(height),
+                    "fps": int(_text(encoder, "FrameRateLimit", default="0")),
+                    "N": int(_text(encoder, "GovLength", default="0")),
+                    # In kbit/s
+                    "bitrate": int(_text(encoder, "BitrateLimit", default="0")),
+                }
+            )
+        profiles.sort(key=lambda p: p["width"] * p["height"], reverse=True)
+        return profiles
+
+    def get_stream_uri(self, token):
+        body = self.call(
+            self.media_url,
+            '<GetStreamUri xmlns="{}"><StreamSetup>'
+            '<Stream xmlns="{}">RTP-Unicast</Stream>'
+            '<Transport xmlns="{}"><Protocol>RTSP</Protocol></Transport>'
+            "</StreamSetup><ProfileToken>{}</ProfileToken>"
+            "</GetStreamUri>".format(NS_MEDIA, NS_SCHEMA, NS_SCHEMA, token),
+        )
+        uri = _text(body, "MediaUri", "Uri")
+        if not uri:
+            raise OnvifError("Profile {} has no stream URI".format(token))
+        return uri
+
+    def get_snapshot_uri(self, token):
+        body = self.call(
+            self.media_url,
+            '<GetSnapshotUri xmlns="{}"><ProfileToken>{}</ProfileToken>'
+            "</GetSnapshotUri>".format(NS_MEDIA, token),
+        )
+        return _text(body, "MediaUri", "Uri")
+
+
+class OnvifCam(UnifiCamBase):
+    @classmethod
+    def add_parser(self, parser):
+        parser.add_argument("--username", "-u", required=True, help="Camera username")
+        parser.add_argument("--password", "-p", required=True, help="Camera password")
+        parser.add_argument(
+            "--onvif-port", type=int, default=80, help="Camera's ONVIF HTTP port"
+        )
+        parser.add_argument(
+            "--ffmpeg-args",
+            "-f",
+            default="-vcodec copy -strict -2 -c:a aac",
+            help="Transcoding args for `ffmpeg -i <src> <args> <dst>`",
+        )
+        parser.add_argument(
+            "--rtsp-transport",
+            default="tcp",
+            choices=["tcp", "udp", "http", "udp_multicast"],
+            help="RTSP transport protocol used by stream",
+        )
+        parser.add_argument(
+            "--snapshot-ttl",
+            type=float,
+            default=0,
+            help="Seconds a snapshot may be reused for (default: always fetch)",
+        )
+
+    def __init__(self, args, logger=None):
+        super(OnvifCam, self).__init__(args, logger)
+        self.streams = {}
+        self.client = OnvifClient(
+            args.ip, args.onvif_port, args.username, args.password
+        )
+        self.lock = threading.Lock()
+        # Camera profile for each of video1, video2 and video3, with its
+        # stream URI, once known
+        self.profiles = None
+        self.snapshot_uri = None
+        self.snapshots = SnapshotCache(
+            self.capture_snapshot, ttl=self.args.snapshot_ttl, logger=self.logger
+        )
+        try:
+            self.get_profiles()
+        except (OnvifError, requests.RequestException) as e:
+            # Tried again when the NVR asks for them
+            self.logger.warning("Querying ONVIF profiles failed: %s", e)
+
+    def get_profiles(self):
+        """
+        Queries the camera's profiles and URIs the first time it's called,
+        and returns them from then on.
+        """
+        with self.lock:
+            if self.profiles is not None:
+                return self.profiles
+            self.client.connect()
+            available = self.client.get_profiles()
+            if not available:
+                raise OnvifError("Camera has no H.264 profile")
+            # Main stream, then sub streams, smallest last
+            chosen = {
+                "video1": available[0],
+                "video2": available[min(1, len(available) - 1)],
+                "video3": available[-1],
+            }
+            uris = {}
+            for profile in chosen.values():
+                if profile["token"] not in uris:
+                    uris[profile["token"]] = with_credentials(
+                        self.client.get_stream_uri(profile["token"]),
+                        self.args.username,
+                        self.args.password,
+                    )
+                profile["uri"] = uris[profile["token"]]
+            for name, profile in sorted(chosen.items()):
+                self.logger.info(
+                    "%s is profile %s (%sx%s)",
+                    name,
+                    profile["name"] or profile["token"],
+                    profile["width"],
+                    profile["height"],
+                )
+            try:
+                self.snapshot_uri = self.client.get_snapshot_uri(
+                    chosen["video1"]["token"]
+                )
+            except OnvifError as e:
+                self.logger.warning("No snapshot URI, decoding snapshots: %s", e)
+            self.profiles = chosen
+            return chosen
+
+    def get_video_profiles(self):
+        try:
+            profiles = self.get_profiles()
+        except (OnvifError, requests.RequestException) as e:
+            self.logger.warning("Querying ONVIF profiles failed: %s", e)
+            return PROFILES
+        video_profiles = {}
+        for name, profile in profiles.items():
+            video_profile = dict(PROFILES[name])
+            video_profile["width"] = profile["width"]
+            video_profile["height"] = profile["height"]
+            if profile["fps"]:
+                video_profile["fps"] = profile["fps"]
+            if profile["N"]:
+                video_profile["N"] = profile["N"]
+            if profile["bitrate"]:
+                video_profile["bitRateCbrAvg"] = 1000 * profile["bitrate"]
+                video_profile["bitRateVbrMax"] = 1000 * profile["bitrate"]
+            video_profiles[name] = video_profile
+        return video_profiles
+
+    def capture_snapshot(self):
+        profiles = self.get_profiles()
+        if self.snapshot_uri is None:
+            # Decodes a single frame of the smallest stream
+            return subprocess.run(
+                shlex.split(
+                    'ffmpeg -rtsp_transport {} -i "{}" -frames:v 1 -f image2 '
+                    "-c:v mjpeg pipe:1".format(
+                        self.args.rtsp_transport, profiles["video3"]["uri"]
+                    )
+                ),
+                stdin=FNULL,
+                stdout=subprocess.PIPE,
+                stderr=FNULL,
+                timeout=SNAPSHOT_TIMEOUT,
+                check=True,
+            ).stdout
+        # Goes through the client's kept-alive session
+        resp = self.client.session.get(self.snapshot_uri, timeout=SNAPSHOT_TIMEOUT)
+        resp.raise_for_status()
+        return resp.content
+
+    def get_snapshot(self):
+        return self.snapshots.get()
+
+    def start_video_stream(self, stream_name, video_mode):
+        profile = self.get_profiles()[video_mode]
+        cmd = (
+            'ffmpeg -y -f lavfi -i aevalsrc=0 -rtsp_transport {} -i "{}" {} '
+            "-metadata streamname={} -f flv -".format(
+                self.args.rtsp_transport,
+                profile["uri"],
+                self.args.ffmpeg_args,
+                stream_name,
+            )
+        )
+        self.start_forwarder(stream_name, cmd)
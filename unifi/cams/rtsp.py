@@ -1,12 +1,23 @@
+import argparse
 import logging
-import os
-import sys
-import subprocess
-import tempfile
 
 from unifi.cams.base import UnifiCamBase
+from unifi.ingest import Ingest, NvrOutput, SnapshotOutput
+from unifi.motion import FPS, THRESHOLD, MotionDetector, MotionOutput, parse_mask
+from unifi.snapshot import SnapshotCache
+from unifi.supervisor import get_supervisor
+from unifi.transcode import PROFILES, Transcoder
 
-FNULL = open(os.devnull, "w")
+# Snapshots are decoded once per second
+SNAPSHOT_TTL = 1.5
+
+
+def profile_list(value):
+    profiles = [p for p in value.split(",") if p]
+    for profile in profiles:
+        if profile not in PROFILES:
+            raise argparse.ArgumentTypeError("unknown profile {}".format(profile))
+    return profiles
 
 
 class RTSPCam(UnifiCamBase):
@@ -25,41 +36,137 @@ class RTSPCam(UnifiCamBase):
             choices=['tcp', 'udp', 'http', 'udp_multicast'],
             help="RTSP transport protocol used by stream",
         )
+        parser.add_argument(
+            "--transcode",
+            default="",
+            type=profile_list,
+            help="Comma separated profiles (video1,video2,video3) to encode at "
+            "their advertised resolution, fps and bitrate rather than pass "
+            "through, from a single decode of the source",
+        )
+        parser.add_argument(
+            "--warm-ingest",
+            action="store_true",
+            help="Keep the source's last GOP in memory, so new streams start "
+            "right away instead of at the next keyframe",
+        )
+        parser.add_argument(
+            "--motion",
+            action="store_true",
+            help="Detect motion (needs numpy)",
+        )
+        parser.add_argument(
+            "--motion-fps",
+            type=int,
+            default=FPS,
+            help="Frames per second to look for motion in",
+        )
+        parser.add_argument(
+            "--motion-threshold",
+            type=int,
+            default=THRESHOLD,
+            help="Change in a pixel's brightness, out of 255, counted as motion",
+        )
+        parser.add_argument(
+            "--motion-mask",
+            type=parse_mask,
+            action="append",
+            default=[],
+            help="Area to ignore motion in, as x,y,width,height in fractions of "
+            "the picture, e.g. 0,0,1,0.1 for the top tenth. Can be repeated",
+        )
 
     def __init__(self, args, logger=None):
         self.logger = logger
         self.args = args
-        self.dir = tempfile.mkdtemp()
-        self.logger.info(self.dir)
-        cmd = 'ffmpeg -y -re -rtsp_transport {} -i "{}" -vf fps=1 -update 1 {}/screen.jpg'.format(
+        cmd = 'ffmpeg -y -f lavfi -i aevalsrc=0 -rtsp_transport {} -i "{}" {} -f flv -'.format(
             self.args.rtsp_transport,
             self.args.source,
-            self.dir,
+            self.args.ffmpeg_args,
+        )
+        # Snapshots and every video profile share one connection to the source
+        self.ingest = Ingest(cmd, logger, preroll=self.args.warm_ingest)
+        self.streams = {}
+        self.snapshots = SnapshotCache(ttl=SNAPSHOT_TTL, logger=logger)
+        self.start_output("mjpg", SnapshotOutput(self.snapshots, logger))
+        get_supervisor().watch(self.pipeline_name("ingest"), self.ingest)
+        self.transcoder = Transcoder(logger, preroll=self.args.warm_ingest)
+        self.motion = None
+
+    def start_output(self, stream_name, output, source=None):
+        self.streams[stream_name] = output
+        if source is None:
+            source = self.ingest
+        source.add_output(output)
+        self.ingest.start()
+        # Outputs go quiet whenever the ingest does, which is watched on its
+        # own, so they're only restarted when they die
+        get_supervisor().watch(
+            self.pipeline_name(stream_name), output, stall_timeout=None
         )
-        self.logger.info(cmd)
-        self.streams = {
-            "mjpg": subprocess.Popen(
-                cmd, stdout=FNULL, stderr=subprocess.STDOUT, shell=True
-            )
-        }
+
+    def rendition(self, profile):
+        """
+        Returns the `TagSource` of `profile` transcoded, adding it to what
+        the transcoder encodes.
+        """
+        self.transcoder.set_profiles(self.transcoder.profiles + (profile,))
+        if self.transcoder.ingest is None:
+            self.start_output("transcoder", self.transcoder)
+        return self.transcoder.renditions[profile]
 
     def get_snapshot(self):
-        return "{}/screen.jpg".format(self.dir)
+        return self.snapshots.get()
+
+    def start_motion_detection(self, on_event):
+        if not self.args.motion:
+            return
+        self.motion = MotionDetector(
+            fps=self.args.motion_fps,
+            threshold=self.args.motion_threshold,
+            masks=self.args.motion_mask,
+        )
+        # The transcoded video3 is far cheaper to decode than the source
+        source = self.rendition("video3") if "video3" in self.args.transcode else None
+        self.start_output(
+            "motion",
+            MotionOutput(self.motion, on_event, self.args.motion_fps, self.logger),
+            source,
+        )
+
+    def get_motion_level(self):
+        return self.motion.level if self.motion is not None else 0
+
+    def get_video_profiles(self):
+        # Profiles passed through are whatever the source sends
+        metadata = self.ingest.metadata
+        profiles = {}
+        for name, profile in PROFILES.items():
+            profile = dict(profile)
+            if name not in self.args.transcode and metadata.get("width"):
+                profile["width"] = int(metadata["width"])
+                profile["height"] = int(metadata["height"])
+                if metadata.get("framerate"):
+                    profile["fps"] = int(round(metadata["framerate"]))
+            profiles[name] = profile
+        return profiles
 
     def start_video_stream(self, stream_name, options):
-        cmd = 'ffmpeg -y -f lavfi -i aevalsrc=0 -rtsp_transport {} -i "{}" {} -metadata streamname={} -f flv - | {} -m unifi.clock_sync | nc {} 6666'.format(
-            self.args.rtsp_transport,
-            self.args.source,
-            self.args.ffmpeg_args,
+        if stream_name in self.streams and self.streams[stream_name].poll() is None:
+            # Restarts the ingest if it has died
+            self.ingest.start()
+            return
+        self.logger.info("Adding stream output (%s)", stream_name)
+        source = None
+        if options in self.args.transcode:
+            source = self.rendition(options)
+        self.start_output(
             stream_name,
-            sys.executable,
-            self.args.host,
+            NvrOutput(
+                stream_name,
+                self.args.host,
+                logger=self.logger,
+                clock_sync=self.clock_sync(),
+            ),
+            source,
         )
-        self.logger.info("Spawning ffmpeg (%s): %s", stream_name, cmd)
-        if (
-            stream_name not in self.streams
-            or self.streams[stream_name].poll() is not None
-        ):
-            self.streams[stream_name] = subprocess.Popen(
-                cmd, stdout=FNULL, stderr=subprocess.STDOUT, shell=True
-            )
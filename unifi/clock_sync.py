@@ -2,99 +2,178 @@
 Helper program to inject absolute wall clock time into FLV stream for recordings
 """
 
-import time
+import argparse
+import functools
+import os
 import struct
 import sys
-from flvlib import astypes
-from flvlib import tags
-from flvlib import primitives
-
-
-def read_bytes(source, num_bytes):
-    read_bytes = 0
-    buf = b""
-    while read_bytes < num_bytes:
-        d_in = source.read(num_bytes - read_bytes)
-        if d_in:
-            read_bytes += len(d_in)
-            buf += d_in
-        else:
-            return buf
-    return buf
-
+import time
 
-def write(data):
-    sys.stdout.write(data)
+from unifi import flv
+
+
+_DOUBLE = struct.Struct(">d")
+# Timestamp bits as laid out in the tag header: upper 16 of the lower 24
+# bits, lower 16 bits, then the 8 bit extension
+_TIMESTAMP = struct.Struct(">BHB")
+
+# When to inject onClockSync tags: every `interval` ms of stream time, before
+# every video keyframe, or both
+POLICIES = ("interval", "keyframe", "both")
+DEFAULT_POLICY = "both"
+DEFAULT_INTERVAL = 1000
+
+# Wall clock times are counted from one time.time() / time.monotonic() pair,
+# so they don't jump when NTP steps the system clock
+_ANCHOR = (time.time(), time.monotonic())
+
+
+def wall_clock():
+    """
+    The current wall clock time in seconds, like `time.time()`.
+    """
+    wall, monotonic = _ANCHOR
+    return wall + (time.monotonic() - monotonic)
+
+
+class ClockSyncTag(object):
+    """
+    onClockSync script tag, AMF encoded once into a fixed layout buffer.
+    Each `render` only patches the timestamp and clock values in place, so
+    the returned view is valid until the next call.
+    """
+
+    def __init__(self):
+        tag = flv.make_script_tag(
+            "onClockSync",
+            {"streamClock": 0.0, "streamClockBase": 0, "wallClock": 0.0},
+        )
+        # Leave room for the previous tag size in front of the tag
+        self.buf = bytearray(4) + tag
+        self.view = memoryview(self.buf)
+        self.timestamp_offset = 4 + 4
+        self.stream_clock_offset = self._value_offset("streamClock")
+        self.wall_clock_offset = self._value_offset("wallClock")
+
+    def _value_offset(self, key):
+        name = key.encode("ascii")
+        prefix = struct.pack(">H", len(name)) + name + bytes((flv.AMF_NUMBER,))
+        return self.buf.index(prefix) + len(prefix)
+
+    def render(self, prev_tag_size, timestamp, wall_clock):
+        buf = self.buf
+        buf[0:4] = prev_tag_size
+        _TIMESTAMP.pack_into(
+            buf,
+            self.timestamp_offset,
+            (timestamp >> 16) & 0xFF,
+            timestamp & 0xFFFF,
+            (timestamp >> 24) & 0xFF,
+        )
+        _DOUBLE.pack_into(buf, self.stream_clock_offset, timestamp)
+        _DOUBLE.pack_into(buf, self.wall_clock_offset, wall_clock)
+        return self.view
+
+
+class ClockSync(object):
+    """
+    Rewrites a stream of FLV tags, injecting onClockSync script tags that map
+    the stream timestamp to wall clock time, as often as `policy` says. The
+    NVR works out the wall clock time of the tags in between from their
+    timestamps.
+
+    One `ClockSync` can rewrite one stream after another, as long as `reset`
+    is called in between.
+    """
+
+    def __init__(self, policy=DEFAULT_POLICY, interval=DEFAULT_INTERVAL):
+        if policy not in POLICIES:
+            raise ValueError("Unknown clock sync policy: {}".format(policy))
+        self.on_keyframe = policy != "interval"
+        self.interval = interval if policy != "keyframe" else None
+        self.injected = 0
+        # Timestamp of the last tag synced in the current stream
+        self.synced_at = None
+        self.template = ClockSyncTag()
+
+    def reset(self):
+        """
+        Starts a new stream, which opens with a clock sync.
+        """
+        self.synced_at = None
+
+    def due(self, tag):
+        synced_at = self.synced_at
+        # Timestamps only go backwards when the source restarts
+        if synced_at is None or tag.timestamp < synced_at:
+            return True
+        if self.on_keyframe and tag.is_keyframe:
+            return True
+        if self.interval is None:
+            return False
+        return tag.timestamp - synced_at >= self.interval
+
+    def rewrite(self, tag, received_at=None):
+        """
+        Returns the buffers to write out for `tag`, which was received at
+        wall clock time `received_at`, in seconds, or just now.
+        """
+        if not self.due(tag):
+            return [tag.header, tag.payload]
+        self.injected += 1
+        self.synced_at = tag.timestamp
+
+        # The clock sync tag goes between the previous tag size and the
+        # original tag, and carries its own trailing tag size
+        if received_at is None:
+            received_at = wall_clock()
+        script = self.template.render(
+            tag.header[:4], tag.timestamp, received_at * 1000
+        )
+        return [script, tag.header[4:], tag.payload]
+
+
+def sync(source, writev, stats=None, clock_sync=None):
+    """
+    Copy the FLV stream from `source` to `writev`, injecting onClockSync tags
+    with `clock_sync`, or a `ClockSync` with the default policy.
+
+    `writev` is called once per tag with a list of buffers. Every tag read is
+    recorded in `stats`, if given.
+    """
+    reader = flv.FlvReader(source)
+    writev([reader.read_header()])
+
+    if clock_sync is None:
+        clock_sync = ClockSync()
+    clock_sync.reset()
+    if stats is not None:
+        stats.clock_sync = clock_sync
+    for tag in reader:
+        writev(clock_sync.rewrite(tag))
+        if stats is not None:
+            stats.record(flv.TAG_HEADER_SIZE + tag.size, tag.is_keyframe)
 
 
 def main():
-    PY3K = sys.version_info >= (3, 0)
-
-    if PY3K:
-        source = sys.stdin.buffer
-    else:
-        if sys.platform == "win32":
-            import os, msvcrt
-
-            msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
-        source = sys.stdin
-
-    header = read_bytes(source, 3)
-
-    if header != "FLV":
-        print("Not a valid FLV file")
-        return
-    write(header)
-
-    # Skip rest of FLV header
-    write(read_bytes(source, 6))
-
-    i = 0
-    while True:
-        header = read_bytes(source, 15)
-        if len(header) != 15:
-            write(header)
-            return
-
-        # Packet structure from Wikipedia:
-        #
-        # Size of previous packet	uint32_be	0	For first packet set to NULL
-        # Packet Type	uint8	18	For first packet set to AMF Metadata
-        # Payload Size	uint24_be	varies	Size of packet data only
-        # Timestamp Lower	uint24_be	0	For first packet set to NULL
-        # Timestamp Upper	uint8	0	Extension to create a uint32_be value
-        # Stream ID	uint24_be	0	For first stream of same type set to NULL
-        # Payload Data	freeform	varies	Data as defined by packet type
-
-        # Get payload size to know how many bytes to read
-        high, low = struct.unpack(">BH", header[5:8])
-        payload_size = (high << 16) + low
-
-        # Get timestamp to inject into clock sync tag
-        low_high = header[8:12]
-        combined = low_high[3] + low_high[:3]
-        timestamp = struct.unpack(">i", combined)[0]
-
-        if i % 3:
-            data = astypes.FLVObject()
-            data["streamClock"] = int(timestamp)
-            data["streamClockBase"] = 0
-            data["wallClock"] = time.time() * 1000
-
-            # Inject clock sync packet
-            write(primitives.make_ui32(payload_size + 15))
-            write(tags.create_script_tag("onClockSync", data, timestamp))
-
-            # Write rest of original packet minus previous packet size
-            write(header[4:])
-            write(read_bytes(source, payload_size))
-        else:
-            # Write normal packet
-            write(header)
-            write(read_bytes(source, payload_size))
-
-        i += 1
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--policy", choices=POLICIES, default=DEFAULT_POLICY)
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=DEFAULT_INTERVAL,
+        help="Stream milliseconds between clock syncs",
+    )
+    args = parser.parse_args()
+
+    source = open(sys.stdin.fileno(), "rb", buffering=0, closefd=False)
+    writev = functools.partial(flv.write_all, functools.partial(os.writev, 1))
+    try:
+        sync(source, writev, clock_sync=ClockSync(args.policy, args.interval))
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -1,13 +1,90 @@
-# import asyncio
+import asyncio
+import collections
+import functools
 import json
 import ssl
 import time
-import requests
-import os
-import threading
-import websocket
-
-OPCODE_DATA = (websocket.ABNF.OPCODE_TEXT, websocket.ABNF.OPCODE_BINARY)
+import websockets
+
+from unifi import metrics
+from unifi.dispatch import HANDLERS, HandlerPool, handler
+from unifi.supervisor import HEALTHY_AFTER, backoff
+from unifi.templates import MessageTemplate, Slot, response
+
+PULSE = MessageTemplate(
+    {
+        "from": "ubnt_avclient",
+        "to": "UniFiVideo",
+        "responseExpected": False,
+        "functionName": "EventAnalytics",
+        "payload": {
+            "clockBestMonotonic": 0,
+            "clockBestWall": 0,
+            "clockMonotonic": Slot("clockMonotonic"),
+            "clockWall": Slot("clockWall"),
+            "edgeType": "unknown",
+            "eventId": 9223372036854775807,
+            "eventType": "pulse",
+            "levels": {"0": Slot("level")},
+            "motionHeatmap": "",
+            "motionSnapshot": "",
+        },
+        "messageId": Slot("messageId"),
+        "inResponseTo": 0,
+    }
+)
+
+MOTION = MessageTemplate(
+    {
+        "from": "ubnt_avclient",
+        "to": "UniFiVideo",
+        "responseExpected": False,
+        "functionName": "EventAnalytics",
+        "payload": {
+            "clockBestMonotonic": 0,
+            "clockBestWall": 0,
+            "clockMonotonic": Slot("clockMonotonic"),
+            "clockWall": Slot("clockWall"),
+            "edgeType": Slot("edgeType"),
+            "eventId": Slot("eventId"),
+            "eventType": "motion",
+            "levels": {"0": Slot("level")},
+            "motionHeatmap": Slot("motionHeatmap"),
+            "motionSnapshot": Slot("motionSnapshot"),
+        },
+        "messageId": Slot("messageId"),
+        "inResponseTo": 0,
+    }
+)
+# What motion events call their pictures, for the NVR to ask for them
+MOTION_SNAPSHOT = "motionsnap.jpg"
+MOTION_HEATMAP = "heatmap.png"
+
+
+def with_slots(payload, settings):
+    """
+    Replaces the values in `payload` reported by the camera with slots of
+    the same name.
+    """
+    for key in settings:
+        payload[key] = Slot(key)
+    return payload
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    Resumes `session`, when set, on every new connection, which saves the
+    full handshake on reconnects.
+    """
+
+    session = None
+
+    def wrap_bio(
+        self, incoming, outgoing, server_side=False, server_hostname=None, session=None
+    ):
+        return super(ResumingSSLContext, self).wrap_bio(
+            incoming, outgoing, server_side, server_hostname, session or self.session
+        )
 
 
 class Core(object):
@@ -23,37 +100,59 @@ class Core(object):
         self._msg_id = 0
         self.init_time = time.time()
         self.pulse_interval = 0
+        self.pulse_changed = None
+        self.pulse_task = None
+        self.outbox = None
+        self.ws = None
+        self.connections = 0
+        self.resumed_sessions = 0
+        self.pool = HandlerPool(
+            concurrent=[name for name, h in HANDLERS.items() if h.concurrent],
+            logger=logger,
+        )
+        self.templates = {}
         self.streams = {}
         self.version = "UVC.S2L.v4.14.14.67.037e886.190630.1017"
+        self.messages = collections.Counter()
+        self.snapshot_capture = metrics.Histogram()
+        self.snapshot_upload = metrics.Histogram()
+        self.pulse_lag = None
+        self.loop = None
+        self.motion_event_id = 0
+        self.motion_snapshot = None
+        self.motion_heatmap = None
+        metrics.REGISTRY.register(self.collect_metrics)
 
     def gen_msg_id(self):
         self._msg_id += 1
         return self._msg_id
 
-    def recv(self, ws):
-        try:
-            frame = ws.recv_frame()
-        except websocket.WebSocketException:
-            return websocket.ABNF.OPCODE_CLOSE, None
-        if not frame:
-            raise websocket.WebSocketException("Not a valid frame %s" % frame)
-        elif frame.opcode in OPCODE_DATA:
-            return frame.opcode, frame.data
-        elif frame.opcode == websocket.ABNF.OPCODE_CLOSE:
-            ws.send_close()
-            return frame.opcode, None
-        elif frame.opcode == websocket.ABNF.OPCODE_PING:
-            ws.pong(frame.data)
-            return frame.opcode, frame.data
-
-        return frame.opcode, frame.data
-
-    def init_adoption(self, ws):
+    def run_blocking(self, func, *args):
+        """
+        Runs a blocking camera or HTTP call without stalling the event loop.
+        """
+        return asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    def respond(self, msg, function_name, make_payload, **values):
+        """
+        Renders the reply to `msg`. The first reply of each kind is built
+        from `make_payload()` and kept as a template, so later replies only
+        serialize `values`.
+        """
+        key = (function_name,) + tuple(sorted(values))
+        template = self.templates.get(key)
+        if template is None:
+            template = MessageTemplate(response(function_name, make_payload()))
+            self.templates[key] = template
+        return template.render(
+            messageId=self.gen_msg_id(), inResponseTo=msg["messageId"], **values
+        )
+
+    def init_adoption(self):
         self.logger.info(
             "Initiating adoption with token [%s] and mac [%s]", self.token, self.mac
         )
         self.send(
-            ws,
             {
                 "from": "ubnt_avclient",
                 "to": "UniFiVideo",
@@ -82,88 +181,87 @@ class Core(object):
             },
         )
 
-    def process_param_agreement(self, msg):
-        return {
-            "from": "ubnt_avclient",
-            "functionName": "ubnt_avclient_paramAgreement",
-            "inResponseTo": msg["messageId"],
-            "messageId": self.gen_msg_id(),
-            "payload": {"authToken": self.token},
-            "responseExpected": False,
-            "to": "UniFiVideo",
-        }
+    @handler("ubnt_avclient_paramAgreement")
+    async def process_param_agreement(self, msg):
+        return self.respond(
+            msg, "ubnt_avclient_paramAgreement", lambda: {"authToken": self.token}
+        )
+
+    @handler("UpdateFirmwareRequest", slow=True)
+    async def process_upgrade(self, msg):
+        import requests
 
-    def process_upgrade(self, msg):
         url = msg["payload"]["uri"]
         headers = {"Range": "bytes=0-100"}
-        r = requests.get(url, headers=headers, verify=False)
+        r = await self.run_blocking(
+            lambda: requests.get(url, headers=headers, verify=False)
+        )
 
         # Parse the new version string from the upgrade binary
-        version = ""
-        for i in range(0, 50):
-            b = r.content[4 + i]
-            if b != b"\x00":
-                version += b
-        self.version = version
-        return
-
-    def process_isp_settings(self, msg):
-        payload = {
-            "aeMode": "auto",
-            "aeTargetPercent": 50,
-            "aggressiveAntiFlicker": 0,
-            "brightness": 50,
-            "contrast": 50,
-            "criticalTmpOfProtect": 40,
-            "darkAreaCompensateLevel": 0,
-            "denoise": 50,
-            "enable3dnr": 1,
-            "enableMicroTmpProtect": 1,
-            "enablePauseMotion": 0,
-            "flip": 0,
-            "focusMode": "ztrig",
-            "focusPosition": 0,
-            "forceFilterIrSwitchEvents": 0,
-            "hue": 50,
-            "icrLightSensorNightThd": 0,
-            "icrSensitivity": 0,
-            "irLedLevel": 215,
-            "irLedMode": "auto",
-            "irOnStsBrightness": 0,
-            "irOnStsContrast": 0,
-            "irOnStsDenoise": 0,
-            "irOnStsHue": 0,
-            "irOnStsSaturation": 0,
-            "irOnStsSharpness": 0,
-            "irOnStsWdr": 0,
-            "irOnValBrightness": 50,
-            "irOnValContrast": 50,
-            "irOnValDenoise": 50,
-            "irOnValHue": 50,
-            "irOnValSaturation": 50,
-            "irOnValSharpness": 50,
-            "irOnValWdr": 1,
-            "mirror": 0,
-            "queryIrLedStatus": 0,
-            "saturation": 50,
-            "sharpness": 50,
-            "touchFocusX": 1001,
-            "touchFocusY": 1001,
-            "wdr": 1,
-            "zoomPosition": 0,
-        }
-        payload.update(self.cam.get_video_settings())
-        return {
-            "from": "ubnt_avclient",
-            "to": "UniFiVideo",
-            "responseExpected": False,
-            "functionName": "ResetIspSettings",
-            "payload": payload,
-            "messageId": self.gen_msg_id(),
-            "inResponseTo": msg["messageId"],
-        }
+        version = bytes(b for b in r.content[4:54] if b != 0)
+        self.version = version.decode("ascii", "ignore")
+
+        self.logger.info("Reconnecting...")
+        asyncio.ensure_future(self.ws.close())
+
+    @handler("ResetIspSettings", slow=True)
+    async def process_isp_settings(self, msg):
+        settings = await self.run_blocking(self.cam.get_video_settings)
+        return self.respond(
+            msg,
+            "ResetIspSettings",
+            lambda: with_slots(
+                {
+                    "aeMode": "auto",
+                    "aeTargetPercent": 50,
+                    "aggressiveAntiFlicker": 0,
+                    "brightness": 50,
+                    "contrast": 50,
+                    "criticalTmpOfProtect": 40,
+                    "darkAreaCompensateLevel": 0,
+                    "denoise": 50,
+                    "enable3dnr": 1,
+                    "enableMicroTmpProtect": 1,
+                    "enablePauseMotion": 0,
+                    "flip": 0,
+                    "focusMode": "ztrig",
+                    "focusPosition": 0,
+                    "forceFilterIrSwitchEvents": 0,
+                    "hue": 50,
+                    "icrLightSensorNightThd": 0,
+                    "icrSensitivity": 0,
+                    "irLedLevel": 215,
+                    "irLedMode": "auto",
+                    "irOnStsBrightness": 0,
+                    "irOnStsContrast": 0,
+                    "irOnStsDenoise": 0,
+                    "irOnStsHue": 0,
+                    "irOnStsSaturation": 0,
+                    "irOnStsSharpness": 0,
+                    "irOnStsWdr": 0,
+                    "irOnValBrightness": 50,
+                    "irOnValContrast": 50,
+                    "irOnValDenoise": 50,
+                    "irOnValHue": 50,
+                    "irOnValSaturation": 50,
+                    "irOnValSharpness": 50,
+                    "irOnValWdr": 1,
+                    "mirror": 0,
+                    "queryIrLedStatus": 0,
+                    "saturation": 50,
+                    "sharpness": 50,
+                    "touchFocusX": 1001,
+                    "touchFocusY": 1001,
+                    "wdr": 1,
+                    "zoomPosition": 0,
+                },
+                settings,
+            ),
+            **settings
+        )
 
-    def process_video_settings(self, msg):
+    @handler("ChangeVideoSettings", slow=True)
+    async def process_video_settings(self, msg):
         # self.cam.set_video_settings(msg['payload'])
         vid_dst = {
             "video1": ["file:///dev/null"],
@@ -172,22 +270,49 @@ class Core(object):
         }
 
         if msg["payload"] is not None:
+            started = {}
             for k, v in msg["payload"]["video"].items():
                 if v:
                     if "avSerializer" in v:
                         vid_dst[k] = v["avSerializer"]["destinations"]
                         if "parameters" in v["avSerializer"]:
-                            self.streams[k] = stream = v["avSerializer"]["parameters"][
-                                "streamName"
-                            ]
-                            self.cam.start_video_stream(stream, k)
-
-        return {
-            "from": "ubnt_avclient",
-            "to": "UniFiVideo",
-            "responseExpected": False,
-            "functionName": "ChangeVideoSettings",
-            "payload": {
+                            stream = v["avSerializer"]["parameters"]["streamName"]
+                            # The NVR sends the same names again after every
+                            # reconnect, and the supervisor keeps running
+                            # streams up
+                            if self.streams.get(k) != stream:
+                                started[k] = stream
+            renamed = set(self.streams[k] for k in started if k in self.streams)
+            self.streams.update(started)
+            # Streams the NVR renamed would otherwise keep running, and being
+            # restarted, under their old names
+            for stream in renamed - set(self.streams.values()):
+                await self.run_blocking(self.cam.stop_video_stream, stream)
+            for k, stream in started.items():
+                await self.run_blocking(self.cam.start_video_stream, stream, k)
+
+        values = {}
+        for k, profile in self.cam.get_video_profiles().items():
+            for field, value in profile.items():
+                values["{}_{}".format(k, field)] = value
+        for k, destinations in vid_dst.items():
+            values[k + "_destinations"] = destinations
+            values[k + "_parameters"] = (
+                None
+                if k not in self.streams
+                else {
+                    "audioId": None,
+                    "streamName": self.streams[k],
+                    "suppressAudio": None,
+                    "suppressVideo": None,
+                    "videoId": None,
+                }
+            )
+
+        return self.respond(
+            msg,
+            "ChangeVideoSettings",
+            lambda: {
                 "audio": {
                     "bitRate": 32000,
                     "channels": 1,
@@ -244,28 +369,20 @@ class Core(object):
                     },
                     "video1": {
                         "M": 1,
-                        "N": 30,
+                        "N": Slot("video1_N"),
                         "avSerializer": {
-                            "destinations": vid_dst["video1"],
-                            "parameters": None
-                            if "video1" not in self.streams
-                            else {
-                                "audioId": None,
-                                "streamName": self.streams["video1"],
-                                "suppressAudio": None,
-                                "suppressVideo": None,
-                                "videoId": None,
-                            },
+                            "destinations": Slot("video1_destinations"),
+                            "parameters": Slot("video1_parameters"),
                             "type": "extendedFlv",
                         },
-                        "bitRateCbrAvg": 1400000,
-                        "bitRateVbrMax": 2800000,
+                        "bitRateCbrAvg": Slot("video1_bitRateCbrAvg"),
+                        "bitRateVbrMax": Slot("video1_bitRateVbrMax"),
                         "bitRateVbrMin": 48000,
                         "description": "Hi quality video track",
                         "enabled": True,
-                        "fps": 15,
+                        "fps": Slot("video1_fps"),
                         "gopModel": 0,
-                        "height": 720,
+                        "height": Slot("video1_height"),
                         "horizontalFlip": False,
                         "isCbr": False,
                         "maxFps": 30,
@@ -299,33 +416,25 @@ class Core(object):
                             30,
                         ],
                         "verticalFlip": False,
-                        "width": 1280,
+                        "width": Slot("video1_width"),
                     },
                     "video2": {
                         "M": 1,
-                        "N": 30,
+                        "N": Slot("video2_N"),
                         "avSerializer": {
-                            "destinations": vid_dst["video2"],
-                            "parameters": None
-                            if "video2" not in self.streams
-                            else {
-                                "audioId": None,
-                                "streamName": self.streams["video2"],
-                                "suppressAudio": None,
-                                "suppressVideo": None,
-                                "videoId": None,
-                            },
+                            "destinations": Slot("video2_destinations"),
+                            "parameters": Slot("video2_parameters"),
                             "type": "extendedFlv",
                         },
-                        "bitRateCbrAvg": 500000,
-                        "bitRateVbrMax": 1200000,
+                        "bitRateCbrAvg": Slot("video2_bitRateCbrAvg"),
+                        "bitRateVbrMax": Slot("video2_bitRateVbrMax"),
                         "bitRateVbrMin": 48000,
-                        "currentVbrBitrate": 1200000,
+                        "currentVbrBitrate": Slot("video2_bitRateVbrMax"),
                         "description": "Medium quality video track",
                         "enabled": True,
-                        "fps": 15,
+                        "fps": Slot("video2_fps"),
                         "gopModel": 0,
-                        "height": 400,
+                        "height": Slot("video2_height"),
                         "horizontalFlip": False,
                         "isCbr": False,
                         "maxFps": 30,
@@ -359,33 +468,25 @@ class Core(object):
                             30,
                         ],
                         "verticalFlip": False,
-                        "width": 720,
+                        "width": Slot("video2_width"),
                     },
                     "video3": {
                         "M": 1,
-                        "N": 30,
+                        "N": Slot("video3_N"),
                         "avSerializer": {
-                            "destinations": vid_dst["video3"],
-                            "parameters": None
-                            if "video3" not in self.streams
-                            else {
-                                "audioId": None,
-                                "streamName": self.streams["video3"],
-                                "suppressAudio": None,
-                                "suppressVideo": None,
-                                "videoId": None,
-                            },
+                            "destinations": Slot("video3_destinations"),
+                            "parameters": Slot("video3_parameters"),
                             "type": "extendedFlv",
                         },
-                        "bitRateCbrAvg": 300000,
-                        "bitRateVbrMax": 200000,
+                        "bitRateCbrAvg": Slot("video3_bitRateCbrAvg"),
+                        "bitRateVbrMax": Slot("video3_bitRateVbrMax"),
                         "bitRateVbrMin": 48000,
-                        "currentVbrBitrate": 200000,
+                        "currentVbrBitrate": Slot("video3_bitRateVbrMax"),
                         "description": "Low quality video track",
                         "enabled": True,
-                        "fps": 15,
+                        "fps": Slot("video3_fps"),
                         "gopModel": 0,
-                        "height": 360,
+                        "height": Slot("video3_height"),
                         "horizontalFlip": False,
                         "isCbr": False,
                         "maxFps": 30,
@@ -419,37 +520,33 @@ class Core(object):
                             30,
                         ],
                         "verticalFlip": False,
-                        "width": 640,
+                        "width": Slot("video3_width"),
                     },
                     "vinFps": 30,
                 },
             },
-            "messageId": self.gen_msg_id(),
-            "inResponseTo": msg["messageId"],
-        }
+            **values
+        )
 
-    def process_device_settings(self, msg):
-        return {
-            "from": "ubnt_avclient",
-            "to": "UniFiVideo",
-            "responseExpected": False,
-            "functionName": "ChangeDeviceSettings",
-            "payload": {
+    @handler("ChangeDeviceSettings")
+    async def process_device_settings(self, msg):
+        return self.respond(
+            msg,
+            "ChangeDeviceSettings",
+            lambda: {
                 "name": self.name,
-                "region": msg["payload"]["region"],
+                "region": Slot("region"),
                 "timezone": "PST8PDT,M3.2.0,M11.1.0",
             },
-            "messageId": self.gen_msg_id(),
-            "inResponseTo": msg["messageId"],
-        }
+            region=msg["payload"]["region"],
+        )
 
-    def process_osd_settings(self, msg):
-        return {
-            "from": "ubnt_avclient",
-            "to": "UniFiVideo",
-            "responseExpected": False,
-            "functionName": "ChangeOsdSettings",
-            "payload": {
+    @handler("ChangeOsdSettings")
+    async def process_osd_settings(self, msg):
+        return self.respond(
+            msg,
+            "ChangeOsdSettings",
+            lambda: {
                 "_1": {
                     "enableDate": 1,
                     "enableLogo": 1,
@@ -484,17 +581,14 @@ class Core(object):
                 "textScale": 50,
                 "useCustomLogo": 0,
             },
-            "messageId": self.gen_msg_id(),
-            "inResponseTo": msg["messageId"],
-        }
+        )
 
-    def process_network_status(self, msg):
-        return {
-            "from": "ubnt_avclient",
-            "to": "UniFiVideo",
-            "responseExpected": False,
-            "functionName": "NetworkStatus",
-            "payload": {
+    @handler("NetworkStatus")
+    async def process_network_status(self, msg):
+        return self.respond(
+            msg,
+            "NetworkStatus",
+            lambda: {
                 "connectionState": 2,
                 "connectionStateDescription": "CONNECTED",
                 "defaultInterface": "eth0",
@@ -507,17 +601,14 @@ class Core(object):
                 "mode": "dhcp",
                 "networkMask": "255.255.255.0",
             },
-            "messageId": self.gen_msg_id(),
-            "inResponseTo": msg["messageId"],
-        }
+        )
 
-    def process_sound_led_settings(self, msg):
-        return {
-            "from": "ubnt_avclient",
-            "to": "UniFiVideo",
-            "responseExpected": False,
-            "functionName": "ChangeSoundLedSettings",
-            "payload": {
+    @handler("ChangeSoundLedSettings")
+    async def process_sound_led_settings(self, msg):
+        return self.respond(
+            msg,
+            "ChangeSoundLedSettings",
+            lambda: {
                 "ledFaceAlwaysOnWhenManaged": 1,
                 "ledFaceEnabled": 1,
                 "speakerEnabled": 1,
@@ -527,139 +618,162 @@ class Core(object):
                 "userLedColorFg": "blue",
                 "userLedOnNoff": 1,
             },
-            "messageId": self.gen_msg_id(),
-            "inResponseTo": msg["messageId"],
-        }
-
-    def process_change_isp_settings(self, msg):
-        payload = {
-            "aeMode": "auto",
-            "aeTargetPercent": 50,
-            "aggressiveAntiFlicker": 0,
-            "brightness": 50,
-            "contrast": 50,
-            "criticalTmpOfProtect": 40,
-            "dZoomCenterX": 50,
-            "dZoomCenterY": 50,
-            "dZoomScale": 0,
-            "dZoomStreamId": 4,
-            "darkAreaCompensateLevel": 0,
-            "denoise": 50,
-            "enable3dnr": 1,
-            "enableExternalIr": 0,
-            "enableMicroTmpProtect": 1,
-            "enablePauseMotion": 0,
-            "flip": 0,
-            "focusMode": "ztrig",
-            "focusPosition": 0,
-            "forceFilterIrSwitchEvents": 0,
-            "hue": 50,
-            "icrLightSensorNightThd": 0,
-            "icrSensitivity": 0,
-            "irLedLevel": 215,
-            "irLedMode": "auto",
-            "irOnStsBrightness": 0,
-            "irOnStsContrast": 0,
-            "irOnStsDenoise": 0,
-            "irOnStsHue": 0,
-            "irOnStsSaturation": 0,
-            "irOnStsSharpness": 0,
-            "irOnStsWdr": 0,
-            "irOnValBrightness": 50,
-            "irOnValContrast": 50,
-            "irOnValDenoise": 50,
-            "irOnValHue": 50,
-            "irOnValSaturation": 50,
-            "irOnValSharpness": 50,
-            "irOnValWdr": 1,
-            "lensDistortionCorrection": 1,
-            "masks": None,
-            "mirror": 0,
-            "queryIrLedStatus": 0,
-            "saturation": 50,
-            "sharpness": 50,
-            "touchFocusX": 1001,
-            "touchFocusY": 1001,
-            "wdr": 1,
-            "zoomPosition": 0,
-        }
+        )
 
+    @handler("ChangeIspSettings", slow=True)
+    async def process_change_isp_settings(self, msg):
         if msg["payload"]:
-            self.cam.change_video_settings(msg["payload"])
-
-        payload.update(self.cam.get_video_settings())
-        return {
-            "from": "ubnt_avclient",
-            "to": "UniFiVideo",
-            "responseExpected": False,
-            "functionName": "ChangeIspSettings",
-            "payload": payload,
-            "messageId": self.gen_msg_id(),
-            "inResponseTo": msg["messageId"],
-        }
+            await self.run_blocking(self.cam.change_video_settings, msg["payload"])
+
+        settings = await self.run_blocking(self.cam.get_video_settings)
+        return self.respond(
+            msg,
+            "ChangeIspSettings",
+            lambda: with_slots(
+                {
+                    "aeMode": "auto",
+                    "aeTargetPercent": 50,
+                    "aggressiveAntiFlicker": 0,
+                    "brightness": 50,
+                    "contrast": 50,
+                    "criticalTmpOfProtect": 40,
+                    "dZoomCenterX": 50,
+                    "dZoomCenterY": 50,
+                    "dZoomScale": 0,
+                    "dZoomStreamId": 4,
+                    "darkAreaCompensateLevel": 0,
+                    "denoise": 50,
+                    "enable3dnr": 1,
+                    "enableExternalIr": 0,
+                    "enableMicroTmpProtect": 1,
+                    "enablePauseMotion": 0,
+                    "flip": 0,
+                    "focusMode": "ztrig",
+                    "focusPosition": 0,
+                    "forceFilterIrSwitchEvents": 0,
+                    "hue": 50,
+                    "icrLightSensorNightThd": 0,
+                    "icrSensitivity": 0,
+                    "irLedLevel": 215,
+                    "irLedMode": "auto",
+                    "irOnStsBrightness": 0,
+                    "irOnStsContrast": 0,
+                    "irOnStsDenoise": 0,
+                    "irOnStsHue": 0,
+                    "irOnStsSaturation": 0,
+                    "irOnStsSharpness": 0,
+                    "irOnStsWdr": 0,
+                    "irOnValBrightness": 50,
+                    "irOnValContrast": 50,
+                    "irOnValDenoise": 50,
+                    "irOnValHue": 50,
+                    "irOnValSaturation": 50,
+                    "irOnValSharpness": 50,
+                    "irOnValWdr": 1,
+                    "lensDistortionCorrection": 1,
+                    "masks": None,
+                    "mirror": 0,
+                    "queryIrLedStatus": 0,
+                    "saturation": 50,
+                    "sharpness": 50,
+                    "touchFocusX": 1001,
+                    "touchFocusY": 1001,
+                    "wdr": 1,
+                    "zoomPosition": 0,
+                },
+                settings,
+            ),
+            **settings
+        )
 
-    def process_analytics_settings(self, msg):
-        if msg["payload"]["sendPulse"] is 1:
+    @handler("ChangeAnalyticsSettings")
+    async def process_analytics_settings(self, msg):
+        if msg["payload"]["sendPulse"] == 1:
             self.pulse_interval = msg["payload"]["pulsePeriodSec"]
         else:
             self.pulse_interval = 0
-        return {
-            "from": "ubnt_avclient",
-            "to": "UniFiVideo",
-            "responseExpected": False,
-            "functionName": "ChangeAnalyticsSettings",
-            "payload": msg["payload"],
-            "messageId": self.gen_msg_id(),
-            "inResponseTo": msg["messageId"],
-        }
-
-    def process_snapshot_request(self, msg):
-        path = self.cam.get_snapshot()
-        while not os.path.isfile(path):
-            time.sleep(0.1)
-        files = {"payload": (msg["payload"]["filename"], open(path, "rb"))}
-        requests.post(
-            msg["payload"]["uri"],
-            files=files,
-            data=msg["payload"]["formFields"],
-            cert=self.cert,
-            verify=False,
+        self.pulse_changed.set()
+        return self.respond(
+            msg,
+            "ChangeAnalyticsSettings",
+            lambda: Slot("payload"),
+            payload=msg["payload"],
         )
 
-    def process_time(self, msg):
-        return {
-            "from": "ubnt_avclient",
-            "functionName": "ubnt_avclient_paramAgreement",
-            "inResponseTo": msg["messageId"],
-            "messageId": self.gen_msg_id(),
-            "payload": {
-                "monotonicMs": self.get_uptime(),
-                "wallMs": int(round(time.time() * 1000)),
-            },
-            "responseExpected": False,
-            "to": "UniFiVideo",
-        }
+    @handler("GetRequest", slow=True, concurrent=True)
+    async def process_snapshot_request(self, msg):
+        # requests takes a while to import, and isn't needed to adopt
+        import requests
 
-    def process_username_password(self, msg):
-        return {
-            "from": "ubnt_avclient",
-            "functionName": "UpdateUsernamePassword",
-            "inResponseTo": msg["messageId"],
-            "messageId": self.gen_msg_id(),
-            "payload": {},
-            "responseExpected": False,
-            "to": "UniFiVideo",
-        }
+        from unifi.upload import get_uploader
+
+        what = msg["payload"].get("what")
+        started = time.monotonic()
+        if what == "motionSnapshot":
+            snapshot = self.motion_snapshot
+        elif what == "motionHeatmap":
+            snapshot = self.motion_heatmap
+        else:
+            snapshot = await self.run_blocking(self.cam.get_snapshot)
+        captured = time.monotonic()
+        self.snapshot_capture.observe(captured - started)
+        if snapshot is None:
+            self.logger.warning("No snapshot available")
+            return
+        try:
+            await get_uploader(self.cert).upload(
+                msg["payload"]["uri"],
+                msg["payload"]["filename"],
+                snapshot,
+                msg["payload"]["formFields"],
+            )
+        except requests.RequestException as e:
+            self.logger.warning("Snapshot upload failed: %s", e)
+        finally:
+            self.snapshot_upload.observe(time.monotonic() - captured)
+
+    @handler("ubnt_avclient_time")
+    async def process_time(self, msg):
+        return self.respond(
+            msg,
+            "ubnt_avclient_paramAgreement",
+            lambda: {"monotonicMs": Slot("monotonicMs"), "wallMs": Slot("wallMs")},
+            monotonicMs=self.get_uptime(),
+            wallMs=int(round(time.time() * 1000)),
+        )
+
+    @handler("UpdateUsernamePassword")
+    async def process_username_password(self, msg):
+        return self.respond(msg, "UpdateUsernamePassword", lambda: {})
 
     def get_uptime(self):
         return time.time() - self.init_time
 
-    def send(self, ws, msg):
+    def send(self, msg):
+        """
+        Queues `msg`, a message or its JSON encoding, for the connection's
+        writer, which is the only task writing to the websocket. Messages
+        sent while disconnected are dropped.
+        """
+        if self.outbox is None:
+            self.logger.debug("Not connected, dropping: %s", msg)
+            return
         self.logger.debug("Sending: %s", msg)
-        ws.send_binary(json.dumps(msg))
+        if not isinstance(msg, str):
+            msg = json.dumps(msg)
+        self.outbox.put_nowait(msg.encode("utf-8"))
 
-    def process(self, ws, msg):
+    async def write_loop(self, ws):
+        try:
+            while True:
+                data = await self.outbox.get()
+                await ws.send(data)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def process(self, msg):
         m = json.loads(msg)
+        self.messages[m["functionName"]] += 1
         self.logger.info("Processing [%s] message", m["functionName"])
         self.logger.debug("Message contents: %s", m)
 
@@ -669,97 +783,208 @@ class Core(object):
         ]:
             return
 
-        res = None
-        if m["functionName"] == "ubnt_avclient_hello":
-            pass
-        elif m["functionName"] == "ubnt_avclient_timeSync":
-            pass
-        elif m["functionName"] == "ubnt_avclient_time":
-            res = self.process_time(m)
-        elif m["functionName"] == "ubnt_avclient_paramAgreement":
-            res = self.process_param_agreement(m)
-        elif m["functionName"] == "ResetIspSettings":
-            res = self.process_isp_settings(m)
-        elif m["functionName"] == "ChangeVideoSettings":
-            res = self.process_video_settings(m)
-        elif m["functionName"] == "ChangeDeviceSettings":
-            res = self.process_device_settings(m)
-        elif m["functionName"] == "ChangeOsdSettings":
-            res = self.process_osd_settings(m)
-        elif m["functionName"] == "NetworkStatus":
-            res = self.process_network_status(m)
-        elif m["functionName"] == "ChangeSoundLedSettings":
-            res = self.process_sound_led_settings(m)
-        elif m["functionName"] == "ChangeIspSettings":
-            res = self.process_change_isp_settings(m)
-        elif m["functionName"] == "ChangeAnalyticsSettings":
-            res = self.process_analytics_settings(m)
-        elif m["functionName"] == "GetRequest":
-            self.process_snapshot_request(m)
-        elif m["functionName"] == "UpdateUsernamePassword":
-            res = self.process_username_password(m)
-        elif m["functionName"] == "UpdateFirmwareRequest":
-            res = self.process_upgrade(m)
-            return True
+        entry = HANDLERS.get(m["functionName"])
+        if entry is None:
+            return
 
-        if res is not None:
-            self.send(ws, res)
+        handle = functools.partial(self.handle, entry)
+        if entry.slow:
+            await self.pool.submit(m["functionName"], handle, m)
+        else:
+            await self.pool.run(m["functionName"], handle, m)
 
-        return False
+    async def handle(self, entry, m):
+        res = await entry.func(self, m)
+        if res is not None:
+            self.send(res)
 
-    def send_pulse(self, ws):
+    def collect_metrics(self):
+        labels = {"camera": self.name}
+        received = metrics.Metric(
+            "unifi_ws_messages_total", "counter", "Websocket messages received"
+        )
+        for name, count in self.messages.items():
+            received.add(dict(labels, function=name), count)
+        latency = metrics.Metric(
+            "unifi_handler_latency_seconds", "histogram", "Message handling time"
+        )
+        queued = metrics.Metric(
+            "unifi_handler_queued", "gauge", "Messages waiting for a worker"
+        )
+        running = metrics.Metric(
+            "unifi_handler_running", "gauge", "Messages being handled"
+        )
+        for name, stats in self.pool.stats.items():
+            handler_labels = dict(labels, function=name)
+            latency.add(handler_labels, stats.latency)
+            queued.add(handler_labels, stats.queued)
+            running.add(handler_labels, stats.running)
+        capture = metrics.Metric(
+            "unifi_snapshot_capture_seconds", "histogram", "Snapshot capture time"
+        )
+        capture.add(labels, self.snapshot_capture)
+        upload = metrics.Metric(
+            "unifi_snapshot_upload_seconds", "histogram", "Snapshot upload time"
+        )
+        upload.add(labels, self.snapshot_upload)
+        pulse_lag = metrics.Metric(
+            "unifi_pulse_lag_seconds",
+            "gauge",
+            "How late the last analytics pulse was sent",
+        )
+        if self.pulse_lag is not None:
+            pulse_lag.add(labels, self.pulse_lag)
+        connections = metrics.Metric(
+            "unifi_ws_connections_total", "counter", "Websocket connections made"
+        )
+        connections.add(labels, self.connections)
+        resumed = metrics.Metric(
+            "unifi_ws_resumed_sessions_total",
+            "counter",
+            "Websocket connections that resumed a TLS session",
+        )
+        resumed.add(labels, self.resumed_sessions)
+        return [
+            received,
+            latency,
+            queued,
+            running,
+            capture,
+            upload,
+            pulse_lag,
+            connections,
+            resumed,
+        ]
+
+    async def send_pulse(self):
+        """
+        Sends analytics pulses for as long as the camera runs, whichever
+        connection is up.
+        """
         while True:
-            if self.pulse_interval is not 0:
-                time.sleep(self.pulse_interval)
-                res = {
-                    "from": "ubnt_avclient",
-                    "to": "UniFiVideo",
-                    "responseExpected": False,
-                    "functionName": "EventAnalytics",
-                    "payload": {
-                        "clockBestMonotonic": 0,
-                        "clockBestWall": 0,
-                        "clockMonotonic": int(round(self.get_uptime())),
-                        "clockWall": int(round(time.time() * 1000)),
-                        "edgeType": "unknown",
-                        "eventId": 9223372036854775807,
-                        "eventType": "pulse",
-                        "levels": {"0": 0},
-                        "motionHeatmap": "",
-                        "motionSnapshot": "",
-                    },
-                    "messageId": self.gen_msg_id(),
-                    "inResponseTo": 0,
-                }
-                self.logger.info("Sending pulse...")
-                self.send(ws, res)
-            time.sleep(0.1)
+            if not self.pulse_interval:
+                await self.pulse_changed.wait()
+                self.pulse_changed.clear()
+                continue
+
+            due = time.monotonic() + self.pulse_interval
+            try:
+                # Restart the timer whenever the interval changes
+                await asyncio.wait_for(self.pulse_changed.wait(), self.pulse_interval)
+                self.pulse_changed.clear()
+                continue
+            except asyncio.TimeoutError:
+                pass
+
+            self.pulse_lag = time.monotonic() - due
+            res = PULSE.render(
+                clockMonotonic=int(round(self.get_uptime())),
+                clockWall=int(round(time.time() * 1000)),
+                level=self.cam.get_motion_level(),
+                messageId=self.gen_msg_id(),
+            )
+            self.logger.info("Sending pulse...")
+            self.send(res)
+
+    def on_motion(self, event):
+        """
+        Called from the camera's motion detection thread with every
+        `MotionEvent`.
+        """
+        snapshot = self.cam.get_snapshot()
+        self.loop.call_soon_threadsafe(self.send_motion, event, snapshot)
+
+    def send_motion(self, event, snapshot):
+        if event.edge == "start":
+            self.motion_event_id += 1
+        if snapshot is not None:
+            self.motion_snapshot = snapshot
+        if event.heatmap is not None:
+            self.motion_heatmap = event.heatmap
+        self.logger.info("Motion %s (level %s)", event.edge, event.level)
+        self.send(
+            MOTION.render(
+                clockMonotonic=int(round(self.get_uptime())),
+                clockWall=int(round(time.time() * 1000)),
+                edgeType=event.edge,
+                eventId=self.motion_event_id,
+                level=event.level,
+                motionHeatmap=MOTION_HEATMAP if event.heatmap is not None else "",
+                motionSnapshot=MOTION_SNAPSHOT if snapshot is not None else "",
+                messageId=self.gen_msg_id(),
+            )
+        )
 
-    def run(self):
+    def ssl_context(self):
+        context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        context.load_cert_chain(self.cert)
+        return context
+
+    async def serve(self, ws):
+        """
+        Handles one websocket connection until it closes or the NVR asks
+        us to reconnect.
+        """
+        self.ws = ws
+        self.outbox = asyncio.Queue()
+        self.pool.start()
+        writer = asyncio.ensure_future(self.write_loop(ws))
+        self.init_adoption()
+        try:
+            async for msg in ws:
+                await self.process(msg)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.outbox = None
+            self.pool.stop()
+            writer.cancel()
+
+    async def run(self):
+        """
+        Keeps a connection to the NVR up, reconnecting with jittered
+        backoff. Video keeps streaming while the connection is down.
+        """
         uri = "wss://{}:7442/camera/1.0/ws?token={}".format(self.host, self.token)
-        ssl_opts = {"cert_reqs": ssl.CERT_NONE, "certfile": self.cert}
+        ssl_context = self.ssl_context()
         headers = {"camera-mac": self.mac}
-        self.logger.info("Creating ws connection to %s", uri)
+        if self.pulse_task is None:
+            self.loop = asyncio.get_event_loop()
+            self.pulse_changed = asyncio.Event()
+            self.pulse_task = asyncio.ensure_future(self.send_pulse())
+            self.cam.start_motion_detection(self.on_motion)
 
+        failures = 0
         while True:
-            ws = websocket.create_connection(uri, sslopt=ssl_opts, header=headers)
-            self.init_adoption(ws)
-
-            self.pulse_thread = threading.Thread(target=self.send_pulse, args=(ws,))
-            self.pulse_thread.daemon = True
-            self.pulse_thread.start()
-
-            while True:
-                opcode, data = self.recv(ws)
-                msg = None
-                if opcode in OPCODE_DATA:
-                    msg = data
-
-                if msg is not None:
-                    reconnect = self.process(ws, msg)
-                    if reconnect:
-                        self.logger.info("Reconnecting...")
-                        break
-
-                if opcode == websocket.ABNF.OPCODE_CLOSE:
-                    break
+            self.logger.info("Creating ws connection to %s", uri)
+            connected = None
+            try:
+                async with websockets.connect(
+                    uri, ssl=ssl_context, extra_headers=headers, compression=None
+                ) as ws:
+                    connected = time.monotonic()
+                    tls = ws.transport.get_extra_info("ssl_object")
+                    self.connections += 1
+                    if tls.session_reused:
+                        self.resumed_sessions += 1
+                    try:
+                        await self.serve(ws)
+                    finally:
+                        # TLS 1.3 session tickets arrive after the handshake
+                        ssl_context.session = tls.session
+            except (
+                OSError,
+                asyncio.TimeoutError,
+                websockets.InvalidHandshake,
+                websockets.ConnectionClosed,
+            ) as e:
+                self.logger.warning("Connection to %s failed: %s", self.host, e)
+
+            if connected is not None and time.monotonic() - connected > HEALTHY_AFTER:
+                failures = 0
+            delay = backoff(failures)
+            failures += 1
+            self.logger.info("Reconnecting in %.1fs", delay)
+            await asyncio.sleep(delay)
@@ -0,0 +1,158 @@
+import asyncio
+import collections
+import logging
+import time
+
+from unifi.metrics import Histogram
+
+POOL_WORKERS = 4
+POOL_QUEUE_SIZE = 64
+
+Handler = collections.namedtuple("Handler", ["func", "slow", "concurrent"])
+
+# functionName -> Handler
+HANDLERS = {}
+
+
+def handler(function_name, slow=False, concurrent=False):
+    """
+    Registers the decorated coroutine as the handler for `function_name`
+    messages. Slow handlers are run on a `HandlerPool`, in order unless
+    they're also marked concurrent.
+    """
+
+    def register(func):
+        HANDLERS[function_name] = Handler(func, slow, concurrent)
+        return func
+
+    return register
+
+
+class HandlerStats(object):
+    __slots__ = (
+        "queued",
+        "running",
+        "count",
+        "errors",
+        "total_time",
+        "max_time",
+        "total_wait",
+        "latency",
+    )
+
+    def __init__(self):
+        self.queued = 0
+        self.running = 0
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.total_wait = 0.0
+        self.latency = Histogram()
+
+    def record(self, elapsed, wait=0.0, error=False):
+        self.latency.observe(elapsed)
+        self.count += 1
+        self.errors += error
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.total_wait += wait
+
+    def as_dict(self):
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "count": self.count,
+            "errors": self.errors,
+            "avg_ms": 1000 * self.total_time / self.count if self.count else 0,
+            "max_ms": 1000 * self.max_time,
+            "avg_wait_ms": 1000 * self.total_wait / self.count if self.count else 0,
+        }
+
+
+class HandlerPool(object):
+    """
+    Runs slow message handlers on a bounded pool of worker tasks, so they
+    never hold up the websocket receive loop.
+
+    Handlers for the same message type run in the order they were received
+    unless the type is listed in `concurrent`.
+    """
+
+    def __init__(
+        self,
+        workers=POOL_WORKERS,
+        queue_size=POOL_QUEUE_SIZE,
+        concurrent=(),
+        logger=None,
+    ):
+        self.num_workers = workers
+        self.queue_size = queue_size
+        self.concurrent = frozenset(concurrent)
+        self.logger = logger or logging.getLogger(__name__)
+        self.stats = {}
+        self.queue = None
+        self.locks = {}
+        self.workers = []
+
+    def get_stats(self, name):
+        if name not in self.stats:
+            self.stats[name] = HandlerStats()
+        return self.stats[name]
+
+    def start(self):
+        self.queue = asyncio.Queue(self.queue_size)
+        self.locks = {}
+        self.workers = [
+            asyncio.ensure_future(self.work()) for _ in range(self.num_workers)
+        ]
+
+    def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+        # Whatever was still queued is dropped with the queue
+        for stats in self.stats.values():
+            stats.queued = 0
+
+    async def submit(self, name, handler, msg):
+        """
+        Queues `handler(msg)`, waiting for room only if the pool is
+        saturated.
+        """
+        self.get_stats(name).queued += 1
+        await self.queue.put((name, handler, msg, time.monotonic()))
+
+    async def run(self, name, handler, msg, queued_at=None):
+        stats = self.get_stats(name)
+        started = time.monotonic()
+        stats.running += 1
+        error = False
+        try:
+            await handler(msg)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            error = True
+            self.logger.exception("Handler for [%s] failed", name)
+        finally:
+            stats.running -= 1
+
+        elapsed = time.monotonic() - started
+        wait = started - queued_at if queued_at is not None else 0.0
+        stats.record(elapsed, wait, error)
+        self.logger.debug(
+            "Handled [%s] in %.1fms (queued %.1fms)", name, 1000 * elapsed, 1000 * wait
+        )
+
+    async def work(self):
+        while True:
+            name, handler, msg, queued_at = await self.queue.get()
+            self.get_stats(name).queued -= 1
+            if name in self.concurrent:
+                await self.run(name, handler, msg, queued_at)
+                continue
+            if name not in self.locks:
+                self.locks[name] = asyncio.Lock()
+            async with self.locks[name]:
+                await self.run(name, handler, msg, queued_at)
@@ -0,0 +1,224 @@
+"""
+Run many cameras per process, sharded across a pool of worker processes.
+Each worker runs all of its cameras on a single event loop.
+
+The config file sets the options shared by every camera at the top level
+and lists the cameras, each with its implementation (`type`) and that
+implementation's `options`:
+
+    host: 192.168.1.5
+    cert: client.pem
+    token: <Adoption token>
+    workers: 4
+    # Worker N serves its cameras' metrics on metrics_port + N
+    metrics_port: 9100
+    cameras:
+      - name: Driveway
+        mac: AA:BB:CC:00:11:22
+        ip: 192.168.1.20
+        type: rtsp
+        options:
+          source: rtsp://192.168.1.20/stream1
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+
+import yaml
+
+from unifi import main as cli
+
+FLEET_KEYS = ("workers", "cameras", "metrics_port")
+CAMERA_KEYS = ("type", "options")
+
+MAX_BACKOFF = 60
+
+logger = logging.getLogger("Fleet")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="unifi-cam-proxy fleet")
+    parser.add_argument(
+        "--config", "-c", required=True, help="Path to the cameras YAML file"
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        help="Number of worker processes (default: config value or CPU count)",
+    )
+    parser.add_argument(
+        "--verbose", "-v", action="store_true", help="increase output verbosity"
+    )
+    return parser.parse_args(argv)
+
+
+def to_argv(options):
+    argv = []
+    for key, value in options.items():
+        if value is None or value is False:
+            continue
+        flag = "--{}".format(key.replace("_", "-"))
+        if value is True:
+            argv.append(flag)
+        else:
+            argv.extend([flag, str(value)])
+    return argv
+
+
+def load_config(path):
+    """
+    Returns (config, argv) where argv holds the `unifi-cam-proxy` command
+    line for every camera in the fleet.
+    """
+    with open(path) as f:
+        config = yaml.safe_load(f) or {}
+
+    defaults = {k: v for k, v in config.items() if k not in FLEET_KEYS}
+    cameras = []
+    for camera in config.get("cameras") or []:
+        options = dict(defaults)
+        options.update({k: v for k, v in camera.items() if k not in CAMERA_KEYS})
+        cameras.append(
+            to_argv(options) + [camera["type"]] + to_argv(camera.get("options") or {})
+        )
+    return config, cameras
+
+
+async def run_camera(argv, verbose):
+    args = cli.parse_args(argv)
+    args.verbose = args.verbose or verbose
+    suffix = ".{}".format(args.name)
+    core = None
+
+    backoff = 1
+    while True:
+        started = time.time()
+        try:
+            # Cameras may talk to the camera, or fail to, while they're built,
+            # which mustn't hold up or take down the rest of the worker
+            if core is None:
+                core = await asyncio.get_event_loop().run_in_executor(
+                    None, cli.create_core, args, suffix
+                )
+            # Reconnects on its own, so this only returns if it crashed
+            await core.run()
+        except Exception:
+            logging.getLogger("Core" + suffix).exception(
+                "Camera failed, restarting in %ss", backoff
+            )
+        if time.time() - started > MAX_BACKOFF:
+            backoff = 1
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, MAX_BACKOFF)
+
+
+async def run_cameras(cameras, verbose):
+    await asyncio.gather(*(run_camera(argv, verbose) for argv in cameras))
+
+
+def run_worker(cameras, verbose, metrics_port=None):
+    # Workers that aren't forked start without the parent's logging setup
+    cli.setup_logging()
+    if metrics_port:
+        from unifi import metrics
+
+        metrics.start_server(metrics_port)
+    asyncio.run(run_cameras(cameras, verbose))
+
+
+class Supervisor(object):
+    def __init__(self, shards, verbose=False, metrics_port=None):
+        self.shards = shards
+        self.verbose = verbose
+        self.metrics_port = metrics_port
+        self.workers = [None] * len(shards)
+        self.restarts = [0] * len(shards)
+        self.failures = [0] * len(shards)
+        self.started = [0.0] * len(shards)
+        self.next_start = [0.0] * len(shards)
+
+    def start(self, i):
+        worker = multiprocessing.Process(
+            target=run_worker,
+            args=(
+                self.shards[i],
+                self.verbose,
+                self.metrics_port + i if self.metrics_port else None,
+            ),
+            name="fleet-worker-{}".format(i),
+        )
+        worker.daemon = True
+        worker.start()
+        self.workers[i] = worker
+        self.started[i] = time.time()
+        logger.info(
+            "Started worker %s (pid %s) with %s cameras",
+            i,
+            worker.pid,
+            len(self.shards[i]),
+        )
+
+    def check(self):
+        now = time.time()
+        for i, worker in enumerate(self.workers):
+            if worker is not None and worker.is_alive():
+                continue
+            if worker is not None:
+                self.restarts[i] += 1
+                if now - self.started[i] > MAX_BACKOFF:
+                    self.failures[i] = 0
+                self.failures[i] += 1
+                backoff = min(2 ** self.failures[i], MAX_BACKOFF)
+                logger.warning(
+                    "Worker %s exited with code %s, restarting in %ss",
+                    i,
+                    worker.exitcode,
+                    backoff,
+                )
+                self.workers[i] = None
+                self.next_start[i] = now + backoff
+            if now >= self.next_start[i]:
+                self.start(i)
+
+    def stop(self):
+        for worker in self.workers:
+            if worker is not None and worker.is_alive():
+                worker.terminate()
+        for worker in self.workers:
+            if worker is not None:
+                worker.join()
+
+    def run(self):
+        try:
+            while True:
+                self.check()
+                time.sleep(1)
+        finally:
+            self.stop()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config, cameras = load_config(args.config)
+    if not cameras:
+        logger.error("No cameras configured in %s", args.config)
+        return 1
+
+    # Surface configuration errors here rather than in a worker
+    for argv in cameras:
+        cli.parse_args(argv)
+
+    workers = args.workers or config.get("workers") or os.cpu_count() or 1
+    workers = min(workers, len(cameras))
+    shards = [cameras[i::workers] for i in range(workers)]
+    logger.info("Running %s cameras across %s workers", len(cameras), workers)
+
+    try:
+        Supervisor(shards, args.verbose, config.get("metrics_port")).run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,322 @@
+"""
+Minimal FLV tag codec used on the streaming hot path.
+
+Tags are parsed in place out of a reusable read buffer, so the `header`
+and `payload` views of a `Tag` are only valid until the next tag is read.
+"""
+
+import struct
+
+FLV_SIGNATURE = b"FLV"
+FLV_HEADER_SIZE = 9
+# Version 1, audio and video present, 9 byte header
+FLV_HEADER = FLV_SIGNATURE + b"\x01\x05\x00\x00\x00\x09"
+# Previous tag size (uint32) followed by the 11 byte tag header
+TAG_HEADER_SIZE = 15
+
+TAG_TYPE_AUDIO = 8
+TAG_TYPE_VIDEO = 9
+TAG_TYPE_SCRIPT = 18
+
+CHUNK_SIZE = 256 * 1024
+
+# prev tag size, type, size (24 bits), timestamp (24 bits + 8 bit extension),
+# stream id (always 0)
+_TAG_HEADER = struct.Struct(">IBBHBHB3x")
+_UI32 = struct.Struct(">I")
+_UI16 = struct.Struct(">H")
+_DOUBLE = struct.Struct(">d")
+
+AMF_NUMBER = 0x00
+AMF_BOOLEAN = 0x01
+AMF_STRING = 0x02
+AMF_OBJECT = 0x03
+AMF_NULL = 0x05
+AMF_UNDEFINED = 0x06
+AMF_ECMA_ARRAY = 0x08
+AMF_OBJECT_END = 0x09
+AMF_STRICT_ARRAY = 0x0A
+AMF_DATE = 0x0B
+AMF_LONG_STRING = 0x0C
+
+SOUND_FORMAT_AAC = 10
+VIDEO_CODEC_AVC = 7
+
+
+class Tag(object):
+    __slots__ = ("type", "size", "timestamp", "header", "payload")
+
+    def __init__(self, type, size, timestamp, header, payload):
+        self.type = type
+        self.size = size
+        self.timestamp = timestamp
+        self.header = header
+        self.payload = payload
+
+    @property
+    def is_keyframe(self):
+        return self.type == TAG_TYPE_VIDEO and self.size > 0 and self.payload[0] >> 4 == 1
+
+    @property
+    def is_sequence_header(self):
+        """
+        AVC decoder configuration or AAC audio specific config, which a
+        decoder needs before any other tag of that type.
+        """
+        if self.size < 2 or self.payload[1] != 0:
+            return False
+        if self.type == TAG_TYPE_VIDEO:
+            return self.payload[0] & 0x0F == VIDEO_CODEC_AVC
+        if self.type == TAG_TYPE_AUDIO:
+            return self.payload[0] >> 4 == SOUND_FORMAT_AAC
+        return False
+
+
+class FlvReader(object):
+    def __init__(self, source, chunk_size=CHUNK_SIZE):
+        self._readinto = source.readinto
+        self._buf = bytearray(chunk_size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def _fill(self, num_bytes):
+        """
+        Make sure at least `num_bytes` are buffered past the read position.
+        Returns False on EOF.
+        """
+        if self._start + num_bytes > len(self._buf):
+            avail = self._end - self._start
+            if num_bytes > len(self._buf):
+                buf = bytearray(max(num_bytes, 2 * len(self._buf)))
+                buf[:avail] = self._view[self._start : self._end]
+                self._buf = buf
+                self._view = memoryview(buf)
+            else:
+                self._buf[:avail] = self._buf[self._start : self._end]
+            self._start = 0
+            self._end = avail
+
+        while self._end - self._start < num_bytes:
+            read = self._readinto(self._view[self._end :])
+            if not read:
+                return False
+            self._end += read
+        return True
+
+    def _take(self, num_bytes):
+        start = self._start
+        self._start += num_bytes
+        return self._view[start : self._start]
+
+    def read_header(self):
+        if not self._fill(FLV_HEADER_SIZE):
+            raise EOFError("Truncated FLV header")
+        if self._view[:3] != FLV_SIGNATURE:
+            raise ValueError("Not a valid FLV file")
+        return self._take(FLV_HEADER_SIZE)
+
+    def read_tag(self):
+        """
+        Returns the next tag, or None once the stream ends.
+        """
+        if not self._fill(TAG_HEADER_SIZE):
+            return None
+        _, type, size_high, size_low, ts_high, ts_low, ts_ext = _TAG_HEADER.unpack_from(
+            self._buf, self._start
+        )
+        size = (size_high << 16) | size_low
+        if not self._fill(TAG_HEADER_SIZE + size):
+            return None
+        return Tag(
+            type,
+            size,
+            (ts_ext << 24) | (ts_high << 16) | ts_low,
+            self._take(TAG_HEADER_SIZE),
+            self._take(size),
+        )
+
+    def __iter__(self):
+        tag = self.read_tag()
+        while tag is not None:
+            yield tag
+            tag = self.read_tag()
+
+
+def pack_header(prev_tag_size, type, size, timestamp):
+    """
+    Packs the previous tag size followed by the 11 byte tag header.
+    """
+    return _TAG_HEADER.pack(
+        prev_tag_size,
+        type,
+        size >> 16,
+        size & 0xFFFF,
+        (timestamp >> 16) & 0xFF,
+        timestamp & 0xFFFF,
+        (timestamp >> 24) & 0xFF,
+    )
+
+
+def unpack_header(buf, offset=0):
+    """
+    Unpacks what `pack_header` packs, returning
+    (prev_tag_size, type, size, timestamp).
+    """
+    prev_tag_size, type, size_high, size_low, ts_high, ts_low, ts_ext = (
+        _TAG_HEADER.unpack_from(buf, offset)
+    )
+    return (
+        prev_tag_size,
+        type,
+        (size_high << 16) | size_low,
+        (ts_ext << 24) | (ts_high << 16) | ts_low,
+    )
+
+
+def pack_tag_header(type, size, timestamp):
+    """
+    Packs the 11 byte tag header, without the previous tag size.
+    """
+    return pack_header(0, type, size, timestamp)[4:]
+
+
+class EcmaArray(dict):
+    pass
+
+
+def amf_encode(value):
+    if isinstance(value, bool):
+        return bytes((AMF_BOOLEAN, value))
+    if isinstance(value, (int, float)):
+        return bytes((AMF_NUMBER,)) + _DOUBLE.pack(value)
+    if isinstance(value, str):
+        data = value.encode("utf-8")
+        if len(data) > 0xFFFF:
+            return bytes((AMF_LONG_STRING,)) + _UI32.pack(len(data)) + data
+        return bytes((AMF_STRING,)) + _UI16.pack(len(data)) + data
+    if value is None:
+        return bytes((AMF_NULL,))
+    if isinstance(value, EcmaArray):
+        return (
+            bytes((AMF_ECMA_ARRAY,))
+            + _UI32.pack(len(value))
+            + _amf_encode_properties(value)
+        )
+    if isinstance(value, dict):
+        return bytes((AMF_OBJECT,)) + _amf_encode_properties(value)
+    if isinstance(value, (list, tuple)):
+        return (
+            bytes((AMF_STRICT_ARRAY,))
+            + _UI32.pack(len(value))
+            + b"".join(amf_encode(v) for v in value)
+        )
+    raise TypeError("Cannot AMF encode {!r}".format(value))
+
+
+def _amf_encode_properties(value):
+    parts = []
+    for k, v in value.items():
+        key = k.encode("utf-8")
+        parts.append(_UI16.pack(len(key)) + key + amf_encode(v))
+    parts.append(b"\x00\x00" + bytes((AMF_OBJECT_END,)))
+    return b"".join(parts)
+
+
+def amf_decode(buf, offset=0):
+    """
+    Decodes the AMF0 value at `offset`, returning it with the offset just
+    past it.
+    """
+    marker = buf[offset]
+    offset += 1
+    if marker == AMF_NUMBER:
+        return _DOUBLE.unpack_from(buf, offset)[0], offset + 8
+    if marker == AMF_BOOLEAN:
+        return bool(buf[offset]), offset + 1
+    if marker in (AMF_STRING, AMF_LONG_STRING):
+        if marker == AMF_STRING:
+            length = _UI16.unpack_from(buf, offset)[0]
+            offset += 2
+        else:
+            length = _UI32.unpack_from(buf, offset)[0]
+            offset += 4
+        return bytes(buf[offset : offset + length]).decode("utf-8", "replace"), (
+            offset + length
+        )
+    if marker in (AMF_NULL, AMF_UNDEFINED):
+        return None, offset
+    if marker == AMF_OBJECT:
+        return _amf_decode_properties(buf, offset, {})
+    if marker == AMF_ECMA_ARRAY:
+        return _amf_decode_properties(buf, offset + 4, EcmaArray())
+    if marker == AMF_STRICT_ARRAY:
+        count = _UI32.unpack_from(buf, offset)[0]
+        offset += 4
+        values = []
+        for _ in range(count):
+            value, offset = amf_decode(buf, offset)
+            values.append(value)
+        return values, offset
+    if marker == AMF_DATE:
+        # Milliseconds since the epoch followed by an unused timezone
+        return _DOUBLE.unpack_from(buf, offset)[0], offset + 10
+    raise ValueError("Unsupported AMF type 0x{:02x}".format(marker))
+
+
+def _amf_decode_properties(buf, offset, value):
+    while offset + 3 <= len(buf):
+        length = _UI16.unpack_from(buf, offset)[0]
+        offset += 2
+        if length == 0 and buf[offset] == AMF_OBJECT_END:
+            return value, offset + 1
+        key = bytes(buf[offset : offset + length]).decode("utf-8", "replace")
+        value[key], offset = amf_decode(buf, offset + length)
+    return value, len(buf)
+
+
+def encode_script_data(name, value):
+    return amf_encode(name) + amf_encode(value)
+
+
+def parse_script_data(payload):
+    """
+    Returns the (name, value) pair carried by a script tag's payload.
+    """
+    name, offset = amf_decode(payload)
+    value = None
+    if offset < len(payload):
+        value, _ = amf_decode(payload, offset)
+    return name, value
+
+
+def make_script_tag(name, value, timestamp=0):
+    """
+    Builds a complete script tag, including the trailing tag size but not
+    the leading previous tag size, as flvlib's `create_script_tag` did.
+    """
+    data = encode_script_data(name, value)
+    header = pack_tag_header(TAG_TYPE_SCRIPT, len(data), timestamp)
+    return header + data + _UI32.pack(len(header) + len(data))
+
+
+def write_all(writev, buffers):
+    """
+    Vectored write of `buffers` through `writev` (e.g. `sock.sendmsg` or
+    `functools.partial(os.writev, fd)`), retrying partial writes.
+    """
+    remaining = sum(map(len, buffers))
+    while True:
+        written = writev(buffers)
+        remaining -= written
+        if not remaining:
+            return
+        buffers = _advance(buffers, written)
+
+
+def _advance(buffers, num_bytes):
+    for i, buf in enumerate(buffers):
+        if num_bytes < len(buf):
+            return [memoryview(buf)[num_bytes:]] + list(buffers[i + 1 :])
+        num_bytes -= len(buf)
+    return []
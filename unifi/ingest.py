@@ -0,0 +1,547 @@
+import functools
+import logging
+import os
+import queue
+import shlex
+import socket
+import subprocess
+import threading
+
+from unifi import flv
+from unifi.clock_sync import ClockSync, wall_clock
+from unifi.snapshot import JpegSplitter
+from unifi.supervisor import PipelineStats
+
+NVR_STREAM_PORT = 6666
+SEND_BUFFER_SIZE = 1024 * 1024
+
+FNULL = open(os.devnull, "w")
+
+# Queue markers: the next tag starts a new segment at a keyframe, and the
+# output should shut down
+_SYNC = object()
+_STOP = object()
+# Largest GOP kept for outputs to start from, in bytes of payload
+PREROLL_LIMIT = 16 * 1024 * 1024
+# Payload an output may have queued before it drops video, several seconds
+# even at 4K
+SEND_QUEUE_LIMIT = 32 * 1024 * 1024
+
+
+def connect_nvr(host, port=NVR_STREAM_PORT, timeout=10):
+    sock = socket.create_connection((host, port), timeout=timeout)
+    sock.settimeout(None)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 10)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+    return sock
+
+
+class TagSource(object):
+    """
+    Fans the tags of an FLV stream out to every attached output, keeping the
+    metadata and sequence headers outputs need to start their own streams.
+
+    With `preroll` set, the tags since the last keyframe are kept too, up to
+    `PREROLL_LIMIT` bytes, and outputs attached later start with them rather
+    than waiting for the next keyframe.
+    """
+
+    def __init__(self, logger=None, preroll=False):
+        self.logger = logger or logging.getLogger(__name__)
+        self.preroll = preroll
+        # Queue items since the last keyframe, or None when there's nothing
+        # to start from
+        self.gop = None
+        self.gop_bytes = 0
+        self.lock = threading.Lock()
+        # Replaced rather than mutated so the reader thread can iterate it
+        # without holding the lock
+        self.outputs = ()
+        self.metadata = flv.EcmaArray()
+        self.video_config = None
+        self.audio_config = None
+        self.stats = PipelineStats()
+
+    def add_output(self, output):
+        output.ingest = self
+        output.start()
+
+    def attach(self, output):
+        with self.lock:
+            if self.gop:
+                output.preroll(self.gop)
+            self.outputs += (output,)
+
+    def remove_output(self, output):
+        with self.lock:
+            self.outputs = tuple(o for o in self.outputs if o is not output)
+
+    def resync(self):
+        # Outputs pick up again from the next keyframe of the new session
+        with self.lock:
+            self.gop = None
+        for output in self.outputs:
+            output.resync()
+
+    def keep(self, tag, item):
+        """
+        Adds a tag to the GOP buffer. Called with the lock held.
+        """
+        if tag.is_keyframe:
+            self.gop = [item]
+            self.gop_bytes = tag.size
+        elif self.gop is not None:
+            self.gop_bytes += tag.size
+            if self.gop_bytes > PREROLL_LIMIT:
+                self.gop = None
+            else:
+                self.gop.append(item)
+
+    def dispatch(self, stream):
+        """
+        Reads FLV from `stream` until it ends, feeding every tag to the
+        outputs.
+        """
+        reader = flv.FlvReader(stream)
+        reader.read_header()
+        for tag in reader:
+            self.stats.record(flv.TAG_HEADER_SIZE + tag.size, tag.is_keyframe)
+            if tag.type == flv.TAG_TYPE_SCRIPT:
+                # Outputs write their own metadata
+                name, value = flv.parse_script_data(tag.payload)
+                if name == "onMetaData" and isinstance(value, dict):
+                    self.metadata = flv.EcmaArray(value)
+                continue
+            if tag.is_sequence_header:
+                if tag.type == flv.TAG_TYPE_VIDEO:
+                    self.video_config = bytes(tag.payload)
+                else:
+                    self.audio_config = bytes(tag.payload)
+            # What outputs queue, copied out of the read buffer once for all
+            # of them
+            item = (tag.type, tag.timestamp, bytes(tag.payload), wall_clock())
+            if self.preroll:
+                with self.lock:
+                    self.keep(tag, item)
+                    outputs = self.outputs
+            else:
+                outputs = self.outputs
+            for output in outputs:
+                output.feed(tag, item)
+
+
+class Ingest(TagSource):
+    """
+    Pulls a source once with an ffmpeg command producing FLV on stdout and
+    fans its tags out to every output, so adding an output never opens
+    another connection to the camera.
+    """
+
+    def __init__(self, cmd, logger=None, preroll=False):
+        super(Ingest, self).__init__(logger, preroll)
+        self.cmd = cmd
+        self.proc = None
+        self.thread = None
+
+    def start(self):
+        """
+        Starts the ingest, or restarts it if it has died.
+        """
+        if self.poll() is None:
+            return
+        self.logger.info("Spawning ingest: %s", self.cmd)
+        self.stats.start()
+        self.proc = subprocess.Popen(
+            shlex.split(self.cmd),
+            stdin=FNULL,
+            stdout=subprocess.PIPE,
+            stderr=FNULL,
+            bufsize=0,
+        )
+        self.resync()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.dispatch(self.proc.stdout)
+        except (OSError, ValueError, EOFError) as e:
+            self.logger.warning("Ingest failed: %s", e)
+        finally:
+            self.stop()
+
+    def poll(self):
+        if self.thread is not None and self.thread.is_alive():
+            return None
+        if self.proc is None or self.proc.returncode is None:
+            return -1
+        return self.proc.returncode
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc.stdout.close()
+
+
+class FlvOutput(object):
+    """
+    Turns the tags fanned out by an `Ingest` into a standalone FLV stream
+    that starts at a keyframe, written out from the output's own thread.
+
+    Outputs can be restarted once they've stopped, picking up from the next
+    keyframe.
+
+    An output that can't keep up never holds up the ingest. Once it has
+    `queue_limit` bytes queued, it drops video until the next keyframe that
+    fits, and audio that doesn't fit. The tags it keeps keep their
+    timestamps, so the gap shows as a short freeze rather than the stream
+    falling behind.
+    """
+
+    def __init__(self, logger=None, queue_limit=SEND_QUEUE_LIMIT):
+        self.logger = logger or logging.getLogger(__name__)
+        self.ingest = None
+        self.thread = None
+        self.queue = None
+        self.queue_limit = queue_limit
+        self.queue_lock = threading.Lock()
+        self.synced = False
+        # Dropping video until the next keyframe
+        self.dropping = False
+        self.offset = None
+        self.prev_tag_size = 0
+        self.last_timestamp = -1
+        self.stats = PipelineStats()
+
+    def start(self):
+        self.stats.start()
+        self.queue = queue.Queue()
+        self.stats.queued_bytes = 0
+        self.synced = False
+        self.dropping = False
+        self.offset = None
+        self.prev_tag_size = 0
+        self.last_timestamp = -1
+        self.ingest.attach(self)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def resync(self):
+        self.synced = False
+
+    def preroll(self, items):
+        """
+        Starts the stream with the source's buffered GOP. Called when the
+        output attaches, before it's fed any tag.
+        """
+        self.synced = True
+        self.queue.put(_SYNC)
+        with self.queue_lock:
+            self.stats.queued_bytes += sum(len(item[2]) for item in items)
+        for item in items:
+            self.queue.put(item)
+
+    def feed(self, tag, item):
+        """
+        Called from the ingest thread for every tag, with the item to queue
+        for it: (type, timestamp, payload, wall clock time received).
+        """
+        if not self.synced:
+            if not tag.is_keyframe or tag.is_sequence_header:
+                return
+            self.synced = True
+            self.queue.put(_SYNC)
+        size = len(item[2])
+        stats = self.stats
+        with self.queue_lock:
+            room = stats.queued_bytes + size <= self.queue_limit
+            was_dropping = self.dropping
+            if tag.is_sequence_header:
+                # Tiny, and nothing decodes without them
+                keep = True
+            elif tag.type == flv.TAG_TYPE_VIDEO:
+                # Frames after a dropped one can't be decoded until the next
+                # keyframe
+                if tag.is_keyframe or not room:
+                    self.dropping = not room
+                keep = not self.dropping
+            else:
+                keep = room
+            if keep:
+                stats.queued_bytes += size
+            else:
+                stats.dropped_tags += 1
+                stats.dropped_bytes += size
+        if self.dropping != was_dropping:
+            if self.dropping:
+                self.logger.warning(
+                    "Output %s is falling behind, dropping video", self
+                )
+            else:
+                self.logger.info("Output %s caught up", self)
+        if keep:
+            self.queue.put(item)
+
+    def run(self):
+        try:
+            self.open()
+            self.write([flv.FLV_HEADER])
+            while True:
+                item = self.queue.get()
+                if item is _STOP:
+                    return
+                if item is _SYNC:
+                    self.offset = None
+                    continue
+                type, timestamp, payload, received_at = item
+                with self.queue_lock:
+                    self.stats.queued_bytes -= len(payload)
+                if self.offset is None:
+                    # A new segment, which may start with tags received a
+                    # while ago
+                    self.write_preamble(received_at)
+                    # Rebase so timestamps continue from where we left off
+                    self.offset = timestamp - (self.last_timestamp + 1)
+                self.write_tag(
+                    type, max(0, timestamp - self.offset), payload, received_at
+                )
+        except (OSError, ValueError) as e:
+            self.logger.warning("Output %s failed: %s", self, e)
+        finally:
+            self.close()
+            self.ingest.remove_output(self)
+
+    def metadata(self):
+        return self.ingest.metadata
+
+    def write_preamble(self, received_at):
+        timestamp = self.last_timestamp + 1
+        self.write_tag(
+            flv.TAG_TYPE_SCRIPT,
+            timestamp,
+            flv.encode_script_data("onMetaData", self.metadata()),
+            received_at,
+        )
+        if self.ingest.video_config is not None:
+            self.write_tag(
+                flv.TAG_TYPE_VIDEO, timestamp, self.ingest.video_config, received_at
+            )
+        if self.ingest.audio_config is not None:
+            self.write_tag(
+                flv.TAG_TYPE_AUDIO, timestamp, self.ingest.audio_config, received_at
+            )
+
+    def write_tag(self, type, timestamp, payload, received_at=None):
+        size = len(payload)
+        header = flv.pack_header(self.prev_tag_size, type, size, timestamp)
+        self.prev_tag_size = flv.TAG_HEADER_SIZE - 4 + size
+        self.last_timestamp = timestamp
+        tag = flv.Tag(type, size, timestamp, header, payload)
+        self.stats.record(flv.TAG_HEADER_SIZE + size, tag.is_keyframe)
+        self.emit(tag, received_at)
+
+    def emit(self, tag, received_at):
+        self.write([tag.header, tag.payload])
+
+    def poll(self):
+        if self.thread is not None and self.thread.is_alive():
+            return None
+        return 0
+
+    def stop(self):
+        self.queue.put(_STOP)
+
+    def open(self):
+        pass
+
+    def write(self, buffers):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class NvrOutput(FlvOutput):
+    """
+    Sends one of the camera's streams to the NVR, with clock sync tags.
+    """
+
+    def __init__(
+        self, stream_name, host, port=NVR_STREAM_PORT, logger=None, clock_sync=None
+    ):
+        super(NvrOutput, self).__init__(logger)
+        self.stream_name = stream_name
+        self.host = host
+        self.port = port
+        self.sock = None
+        self.clock_sync = clock_sync or ClockSync()
+        self.stats.clock_sync = self.clock_sync
+
+    def __str__(self):
+        return self.stream_name
+
+    def metadata(self):
+        metadata = flv.EcmaArray(self.ingest.metadata)
+        metadata["streamname"] = self.stream_name
+        return metadata
+
+    def open(self):
+        self.clock_sync.reset()
+        self.sock = connect_nvr(self.host, self.port)
+
+    def emit(self, tag, received_at):
+        # Tags started from the GOP buffer were received a while ago
+        self.write(self.clock_sync.rewrite(tag, received_at))
+
+    def write(self, buffers):
+        flv.write_all(self.sock.sendmsg, buffers)
+
+    def stop(self):
+        """
+        Disconnects from the NVR, which wakes up the sending thread if it's
+        blocked. Safe to call from any thread.
+        """
+        super(NvrOutput, self).stop()
+        # Only shut down, as the sending thread closes it once it's done
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class FlvForwarder(NvrOutput):
+    """
+    Runs an ffmpeg command producing FLV on stdout and sends it to the NVR as
+    `stream_name`, for cameras that hand each stream to its own ffmpeg
+    rather than an `Ingest`. ffmpeg is read on one thread and the NVR written
+    on another, through the same bounded queue as any output, so an NVR that
+    can't keep up drops video rather than backing up into ffmpeg and the
+    camera.
+
+    Mirrors the subset of the `subprocess.Popen` API the cameras rely on
+    (`poll`), so it can live in the same `streams` dict as plain processes.
+    """
+
+    def __init__(
+        self,
+        stream_name,
+        cmd,
+        host,
+        port=NVR_STREAM_PORT,
+        logger=None,
+        clock_sync=None,
+    ):
+        super(FlvForwarder, self).__init__(
+            stream_name, host, port, logger, clock_sync
+        )
+        self.cmd = cmd
+        self.proc = None
+        self.reader = None
+
+    def start(self):
+        # A new source every time, as ffmpeg starts its stream over
+        self.ingest = TagSource(self.logger)
+        super(FlvForwarder, self).start()
+        self.proc = subprocess.Popen(
+            shlex.split(self.cmd),
+            stdin=FNULL,
+            stdout=subprocess.PIPE,
+            stderr=FNULL,
+            bufsize=0,
+        )
+        self.reader = threading.Thread(target=self.read, args=(self.proc,))
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read(self, proc):
+        try:
+            self.ingest.dispatch(proc.stdout)
+        except (OSError, ValueError, EOFError) as e:
+            self.logger.warning("Reading %s failed: %s", self, e)
+        finally:
+            # What's already queued still goes out, so without disconnecting
+            FlvOutput.stop(self)
+            # Only this thread reads the pipe, so it's only closed here
+            proc.stdout.close()
+
+    def poll(self):
+        if self.reader is not None and self.reader.is_alive():
+            return None
+        return super(FlvForwarder, self).poll()
+
+    def kill(self):
+        proc = self.proc
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    def stop(self):
+        """
+        Kills ffmpeg and disconnects from the NVR. Safe to call from any
+        thread.
+        """
+        self.kill()
+        super(FlvForwarder, self).stop()
+
+    def close(self):
+        super(FlvForwarder, self).close()
+        # Nothing more can be sent, so don't leave ffmpeg running
+        self.kill()
+
+
+class SnapshotOutput(FlvOutput):
+    """
+    Decodes the stream into one JPEG per second, pushed into a
+    `SnapshotCache`.
+    """
+
+    def __init__(self, cache, logger=None):
+        super(SnapshotOutput, self).__init__(logger)
+        self.cache = cache
+        self.proc = None
+
+    def __str__(self):
+        return "snapshot"
+
+    def open(self):
+        self.proc = subprocess.Popen(
+            shlex.split(
+                "ffmpeg -f flv -i pipe:0 -vf fps=1 -f image2pipe -c:v mjpeg pipe:1"
+            ),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=FNULL,
+            bufsize=0,
+        )
+        reader = threading.Thread(target=self.read_frames, args=(self.proc.stdout,))
+        reader.daemon = True
+        reader.start()
+
+    def read_frames(self, stdout):
+        splitter = JpegSplitter()
+        for chunk in iter(functools.partial(stdout.read, 65536), b""):
+            for frame in splitter.feed(chunk):
+                self.cache.update(frame)
+
+    def write(self, buffers):
+        flv.write_all(functools.partial(os.writev, self.proc.stdin.fileno()), buffers)
+
+    def close(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
@@ -1,20 +1,38 @@
 import argparse
+import asyncio
 import os
 import logging
+import sys
 
-import coloredlogs
-
-from unifi.cams.hikvision import HikvisionCam
-from unifi.cams.rtsp import RTSPCam
+from unifi import cams, clock_sync
 from unifi.core import Core
 
-CAMS = {"hikvision": HikvisionCam, "rtsp": RTSPCam}
 
-logging.basicConfig()
-coloredlogs.install(level="DEBUG")
+class CamParser(argparse.ArgumentParser):
+    """
+    The parser for one camera implementation, which only imports it, and
+    adds its arguments, once it's selected.
+    """
+
+    def __init__(self, impl=None, **kwargs):
+        super(CamParser, self).__init__(**kwargs)
+        self.impl = impl
+
+    def parse_known_args(self, args=None, namespace=None):
+        if self.impl is not None:
+            cams.load(self.impl).add_parser(self)
+            self.impl = None
+        return super(CamParser, self).parse_known_args(args, namespace)
+
+
+def setup_logging():
+    import coloredlogs
+
+    logging.basicConfig()
+    coloredlogs.install(level="DEBUG")
 
 
-def parse_args():
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", "-H", required=True, help="NVR ip address and port")
     parser.add_argument(
@@ -35,27 +53,64 @@ def parse_args():
     parser.add_argument(
         "--verbose", "-v", action="store_true", help="increase output verbosity"
     )
+    parser.add_argument(
+        "--clock-sync",
+        choices=clock_sync.POLICIES,
+        default=clock_sync.DEFAULT_POLICY,
+        help="When to send the NVR the wall clock time: every "
+        "--clock-sync-interval, on every keyframe, or both (default: both)",
+    )
+    parser.add_argument(
+        "--clock-sync-interval",
+        type=int,
+        default=clock_sync.DEFAULT_INTERVAL,
+        help="Stream milliseconds between clock syncs (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve Prometheus metrics on this port (default: disabled)",
+    )
 
-    sp = parser.add_subparsers(help="Camera implementations", dest="impl")
-    for (name, impl) in CAMS.items():
-        subparser = sp.add_parser(name)
-        impl.add_parser(subparser)
-    return parser.parse_args()
+    sp = parser.add_subparsers(
+        help="Camera implementations", dest="impl", parser_class=CamParser
+    )
+    for name in cams.available():
+        sp.add_parser(name, impl=name)
+    return parser
 
 
-def main():
-    args = parse_args()
-    klass = CAMS[args.impl]
+def parse_args(argv=None):
+    return build_parser().parse_args(argv)
 
-    core_logger = logging.getLogger("Core")
-    logger = logging.getLogger(klass.__name__)
+
+def create_core(args, logger_suffix=""):
+    klass = cams.load(args.impl)
+
+    core_logger = logging.getLogger("Core" + logger_suffix)
+    logger = logging.getLogger(klass.__name__ + logger_suffix)
     if args.verbose:
         logger.setLevel(logging.DEBUG)
         core_logger.setLevel(logging.DEBUG)
 
     cam = klass(args, logger)
-    c = Core(args, cam, core_logger)
-    c.run()
+    return Core(args, cam, core_logger)
+
+
+def main():
+    setup_logging()
+    if sys.argv[1:2] == ["fleet"]:
+        from unifi import fleet
+
+        return fleet.main(sys.argv[2:])
+
+    args = parse_args()
+    if args.metrics_port:
+        from unifi import metrics
+
+        metrics.start_server(args.metrics_port)
+    c = create_core(args)
+    asyncio.run(c.run())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,209 @@
+"""
+Optional HTTP endpoint exposing the proxy's metrics in the Prometheus text
+format.
+
+Metrics aren't stored here: collectors registered with a `Registry` read
+them from the counters the pipelines, handlers and cores already keep,
+whenever the endpoint is scraped.
+"""
+
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+
+
+class Metric(object):
+    """
+    A metric family. Samples are (labels, value) pairs, where the value of
+    a histogram is a `Histogram`.
+    """
+
+    def __init__(self, name, type, help):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.samples = []
+
+    def add(self, labels, value):
+        self.samples.append((labels, value))
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.collectors = []
+
+    def register(self, collector):
+        """
+        `collector` is called on every scrape and returns `Metric`s. Metrics
+        of the same name from different collectors are merged.
+        """
+        with self.lock:
+            self.collectors.append(collector)
+
+    def collect(self):
+        with self.lock:
+            collectors = list(self.collectors)
+        families = {}
+        for collector in collectors:
+            try:
+                metrics = list(collector())
+            except Exception:
+                logger.exception("Collecting metrics failed")
+                continue
+            for metric in metrics:
+                if metric.name in families:
+                    families[metric.name].samples.extend(metric.samples)
+                else:
+                    families[metric.name] = metric
+        return families.values()
+
+    def render(self):
+        lines = []
+        for metric in self.collect():
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for labels, value in metric.samples:
+                if metric.type == "histogram":
+                    lines.extend(_render_histogram(metric.name, labels, value))
+                else:
+                    lines.append(_sample(metric.name, labels, value))
+        lines.append("")
+        return "\n".join(lines)
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += "{{{}}}".format(
+            ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels.items())
+        )
+    return "{} {}".format(name, float(value))
+
+
+def _render_histogram(name, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        yield _sample(name + "_bucket", dict(labels, le=bound), cumulative)
+    yield _sample(name + "_bucket", dict(labels, le="+Inf"), histogram.count)
+    yield _sample(name + "_sum", labels, histogram.sum)
+    yield _sample(name + "_count", labels, histogram.count)
+
+
+REGISTRY = Registry()
+
+
+def collect_pipelines():
+    """
+    Per stream metrics for every pipeline watched by the supervisor.
+    """
+    from unifi.supervisor import get_supervisor
+
+    metrics = {
+        "bytes": Metric(
+            "unifi_stream_bytes_total", "counter", "Bytes of FLV tags moved"
+        ),
+        "tags": Metric("unifi_stream_tags_total", "counter", "FLV tags moved"),
+        "clock_syncs": Metric(
+            "unifi_stream_clock_sync_tags_total",
+            "counter",
+            "onClockSync tags injected",
+        ),
+        "restarts": Metric(
+            "unifi_stream_restarts_total", "counter", "Pipeline restarts"
+        ),
+        "queued_bytes": Metric(
+            "unifi_stream_queued_bytes",
+            "gauge",
+            "Bytes of tags waiting to be sent",
+        ),
+        "dropped_tags": Metric(
+            "unifi_stream_dropped_tags_total",
+            "counter",
+            "FLV tags dropped because the output fell behind",
+        ),
+        "dropped_bytes": Metric(
+            "unifi_stream_dropped_bytes_total",
+            "counter",
+            "Bytes of FLV tags dropped because the output fell behind",
+        ),
+        "since_keyframe": Metric(
+            "unifi_stream_seconds_since_keyframe",
+            "gauge",
+            "Seconds since the last video keyframe",
+        ),
+        "time_to_first_byte": Metric(
+            "unifi_stream_time_to_first_byte_seconds",
+            "gauge",
+            "Seconds from the last (re)start to the first tag",
+        ),
+    }
+    for name, stats in get_supervisor().stats().items():
+        camera, _, stream = name.rpartition("/")
+        labels = {"camera": camera, "stream": stream}
+        for key, metric in metrics.items():
+            if stats[key] is not None:
+                metric.add(labels, stats[key])
+    return metrics.values()
+
+
+REGISTRY.register(collect_pipelines)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port, host=""):
+    """
+    Serves the metrics on http://`host`:`port`/metrics from a background
+    thread.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics on port %s", port)
+    return server
@@ -0,0 +1,259 @@
+"""
+Motion detection on small grayscale frames decoded from a camera's stream.
+
+Each frame is compared to a running average of the previous ones, and
+motion starts once enough of the unmasked pixels differ from it, for long
+enough. Needs NumPy, which is an optional dependency, imported once a
+detector is created.
+"""
+
+import collections
+import functools
+import os
+import shlex
+import struct
+import subprocess
+import threading
+import zlib
+
+from unifi import flv
+from unifi.ingest import FNULL, FlvOutput
+
+np = None
+
+WIDTH = 320
+HEIGHT = 180
+FPS = 5
+# Difference from the background, out of 255, for a pixel to count as moving
+THRESHOLD = 25
+# Share of the unmasked pixels moving, in percent, for motion to start
+START_LEVEL = 1
+START_FRAMES = 2
+STOP_AFTER = 2.0
+# How quickly the background takes in changes, per frame
+LEARNING_RATE = 0.05
+
+MotionEvent = collections.namedtuple("MotionEvent", ["edge", "level", "heatmap"])
+
+
+def _import_numpy():
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            raise RuntimeError("Motion detection needs numpy")
+        np = numpy
+
+
+def parse_mask(value):
+    """
+    Parses an `x,y,width,height` rectangle, in fractions of the frame.
+    """
+    rect = tuple(float(v) for v in value.split(","))
+    if len(rect) != 4 or not all(0 <= v <= 1 for v in rect):
+        raise ValueError("Masks are x,y,width,height between 0 and 1")
+    return rect
+
+
+def encode_png(gray):
+    """
+    Encodes a 2D uint8 array as a grayscale PNG.
+    """
+
+    def chunk(type, data):
+        return (
+            struct.pack(">I", len(data))
+            + type
+            + data
+            + struct.pack(">I", zlib.crc32(type + data))
+        )
+
+    height, width = gray.shape
+    # Every row starts with filter type 0
+    rows = np.zeros((height, width + 1), dtype=np.uint8)
+    rows[:, 1:] = gray
+    return b"".join(
+        (
+            b"\x89PNG\r\n\x1a\n",
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)),
+            chunk(b"IDAT", zlib.compress(rows.tobytes(), 1)),
+            chunk(b"IEND", b""),
+        )
+    )
+
+
+class MotionDetector(object):
+    """
+    Turns frames into motion start and stop events. `feed` is cheap enough to
+    run on every frame: it works in place on buffers allocated up front.
+
+    `masks` are rectangles, as returned by `parse_mask`, where motion is
+    ignored.
+    """
+
+    def __init__(
+        self,
+        width=WIDTH,
+        height=HEIGHT,
+        fps=FPS,
+        threshold=THRESHOLD,
+        start_level=START_LEVEL,
+        start_frames=START_FRAMES,
+        stop_after=STOP_AFTER,
+        learning_rate=LEARNING_RATE,
+        masks=(),
+    ):
+        _import_numpy()
+        self.width = width
+        self.height = height
+        self.threshold = threshold
+        self.start_level = start_level
+        self.start_frames = start_frames
+        self.stop_frames = max(1, int(stop_after * fps))
+        self.learning_rate = learning_rate
+
+        shape = (height, width)
+        self.background = None
+        self.diff = np.empty(shape, dtype=np.float32)
+        self.scratch = np.empty(shape, dtype=np.float32)
+        self.moving = np.empty(shape, dtype=bool)
+        self.heat = np.zeros(shape, dtype=np.uint32)
+        self.mask = np.ones(shape, dtype=bool)
+        for x, y, w, h in masks:
+            self.mask[
+                int(y * height) : int(round((y + h) * height)),
+                int(x * width) : int(round((x + w) * width)),
+            ] = False
+        self.active_pixels = max(1, int(np.count_nonzero(self.mask)))
+
+        self.level = 0
+        self.in_motion = False
+        self.peak_level = 0
+        # Consecutive frames above the start level, or below it while in
+        # motion
+        self.streak = 0
+
+    def feed(self, frame):
+        """
+        Takes a frame as `width * height` bytes of 8 bit luma and returns a
+        `MotionEvent` when motion starts or stops, otherwise None.
+        """
+        frame = np.frombuffer(frame, dtype=np.uint8).reshape(self.height, self.width)
+        if self.background is None:
+            self.background = frame.astype(np.float32)
+            return None
+
+        diff = self.diff
+        np.subtract(frame, self.background, out=diff)
+        np.multiply(diff, self.learning_rate, out=self.scratch)
+        self.background += self.scratch
+        np.abs(diff, out=diff)
+        np.greater(diff, self.threshold, out=self.moving)
+        self.moving &= self.mask
+        moving = int(np.count_nonzero(self.moving))
+        self.level = min(100, 100 * moving // self.active_pixels)
+
+        if not self.in_motion:
+            if self.level >= self.start_level:
+                self.streak += 1
+            else:
+                self.streak = 0
+            if self.streak < self.start_frames:
+                return None
+            self.in_motion = True
+            self.streak = 0
+            self.peak_level = self.level
+            self.heat.fill(0)
+            self.heat += self.moving
+            return MotionEvent("start", self.level, None)
+
+        self.heat += self.moving
+        self.peak_level = max(self.peak_level, self.level)
+        if self.level >= self.start_level:
+            self.streak = 0
+            return None
+        self.streak += 1
+        if self.streak < self.stop_frames:
+            return None
+        self.in_motion = False
+        self.streak = 0
+        return MotionEvent("stop", self.peak_level, encode_png(self.heatmap()))
+
+    def heatmap(self):
+        """
+        Where there was motion during the current or last event, scaled to
+        0-255.
+        """
+        peak = int(self.heat.max())
+        if peak == 0:
+            return np.zeros(self.heat.shape, dtype=np.uint8)
+        return (self.heat * 255 // peak).astype(np.uint8)
+
+
+def decoder_cmd(fps=FPS, width=WIDTH, height=HEIGHT):
+    """
+    ffmpeg decoding FLV from stdin into `width`x`height` grayscale frames, at
+    `fps`, on stdout.
+    """
+    return (
+        "ffmpeg -f flv -i pipe:0 -vf fps={},scale={}:{},format=gray "
+        "-f rawvideo pipe:1".format(fps, width, height)
+    )
+
+
+class MotionOutput(FlvOutput):
+    """
+    Decodes the stream into small grayscale frames at a fixed rate and runs
+    them through a `MotionDetector`, calling `on_event` with every event from
+    the decoder's reader thread.
+    """
+
+    def __init__(self, detector, on_event, fps=FPS, logger=None):
+        super(MotionOutput, self).__init__(logger)
+        self.detector = detector
+        self.on_event = on_event
+        self.fps = fps
+        self.proc = None
+
+    def __str__(self):
+        return "motion"
+
+    def open(self):
+        self.proc = subprocess.Popen(
+            shlex.split(
+                decoder_cmd(self.fps, self.detector.width, self.detector.height)
+            ),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=FNULL,
+            bufsize=0,
+        )
+        reader = threading.Thread(target=self.read_frames, args=(self.proc.stdout,))
+        reader.daemon = True
+        reader.start()
+
+    def read_frames(self, stdout):
+        frame = bytearray(self.detector.width * self.detector.height)
+        view = memoryview(frame)
+        while True:
+            filled = 0
+            while filled < len(frame):
+                n = stdout.readinto(view[filled:])
+                if not n:
+                    return
+                filled += n
+            event = self.detector.feed(frame)
+            if event is not None:
+                try:
+                    self.on_event(event)
+                except Exception:
+                    self.logger.exception("Handling motion event failed")
+
+    def write(self, buffers):
+        flv.write_all(functools.partial(os.writev, self.proc.stdin.fileno()), buffers)
+
+    def close(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
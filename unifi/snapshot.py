@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+
+DEFAULT_TIMEOUT = 5.0
+
+JPEG_START = b"\xff\xd8"
+JPEG_END = b"\xff\xd9"
+
+
+class SnapshotCache(object):
+    """
+    Holds a camera's latest JPEG in memory.
+
+    Frames are either pushed with `update` by a continuously running
+    decoder, or pulled on demand through `capture`, in which case
+    concurrent requests share a single in-flight capture.
+    """
+
+    def __init__(self, capture=None, ttl=1.0, logger=None):
+        self.capture = capture
+        self.ttl = ttl
+        self.logger = logger or logging.getLogger(__name__)
+        self.cond = threading.Condition()
+        self.data = None
+        self.captured_at = 0.0
+        self.generation = 0
+        self.capturing = False
+
+    def _store(self, data):
+        self.data = data
+        self.captured_at = time.monotonic()
+        self.generation += 1
+        self.cond.notify_all()
+
+    def update(self, data):
+        with self.cond:
+            self._store(data)
+
+    def is_fresh(self):
+        return self.data is not None and time.monotonic() - self.captured_at <= self.ttl
+
+    def get(self, timeout=DEFAULT_TIMEOUT):
+        """
+        Returns a JPEG no older than the TTL, waiting up to `timeout` for a
+        new one. Falls back to the last known JPEG (or None) on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            if self.is_fresh():
+                return self.data
+            generation = self.generation
+            while self.generation == generation:
+                if self.capture is not None and not self.capturing:
+                    self.capturing = True
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return self.data
+                self.cond.wait(remaining)
+            else:
+                return self.data
+
+        data = None
+        try:
+            data = self.capture()
+        except Exception as e:
+            self.logger.warning("Snapshot capture failed: %s", e)
+        finally:
+            with self.cond:
+                self.capturing = False
+                if data is not None:
+                    self._store(data)
+                else:
+                    # Let a waiting request retry the capture
+                    self.cond.notify_all()
+        return self.data
+
+
+class JpegSplitter(object):
+    """
+    Splits the output of ffmpeg's image2pipe muxer into individual JPEGs.
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data):
+        self.buf += data
+        frames = []
+        while True:
+            start = self.buf.find(JPEG_START)
+            if start < 0:
+                del self.buf[:]
+                return frames
+            end = self.buf.find(JPEG_END, start + 2)
+            if end < 0:
+                del self.buf[:start]
+                return frames
+            end += len(JPEG_END)
+            frames.append(bytes(self.buf[start:end]))
+            del self.buf[:end]
@@ -0,0 +1,227 @@
+"""
+Watches every media pipeline in the process and restarts the ones that
+die or stop producing data.
+
+A pipeline is anything with `start`, `stop`, `poll` (None while running,
+like `subprocess.Popen.poll`) and a `stats` attribute holding the
+`PipelineStats` it updates for every tag it moves.
+"""
+
+import logging
+import random
+import threading
+import time
+
+CHECK_INTERVAL = 1.0
+# Restart a pipeline that hasn't moved a tag for this long
+STALL_TIMEOUT = 10.0
+MIN_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+# A pipeline that has stayed up this long starts over at the minimum backoff
+HEALTHY_AFTER = 60.0
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+
+class PipelineStats(object):
+    __slots__ = (
+        "bytes",
+        "tags",
+        "restarts",
+        "started_at",
+        "first_byte_at",
+        "last_byte_at",
+        "keyframe_at",
+        "time_to_first_byte",
+        "clock_sync",
+        "bytes_per_sec",
+        "tags_per_sec",
+        "queued_bytes",
+        "dropped_tags",
+        "dropped_bytes",
+        "_sampled_at",
+        "_sampled_bytes",
+        "_sampled_tags",
+    )
+
+    def __init__(self):
+        self.bytes = 0
+        self.tags = 0
+        self.restarts = 0
+        self.keyframe_at = None
+        self.time_to_first_byte = None
+        # The pipeline's `ClockSync`, if it injects clock sync tags
+        self.clock_sync = None
+        self.bytes_per_sec = 0.0
+        self.tags_per_sec = 0.0
+        # Payload waiting to be sent, and given up on, by outputs that queue
+        self.queued_bytes = 0
+        self.dropped_tags = 0
+        self.dropped_bytes = 0
+        self.start()
+
+    def start(self):
+        now = time.monotonic()
+        self.started_at = now
+        self.first_byte_at = None
+        self.last_byte_at = now
+        self._sampled_at = now
+        self._sampled_bytes = self.bytes
+        self._sampled_tags = self.tags
+
+    def record(self, nbytes, keyframe=False):
+        """
+        Called from the pipeline's thread for every tag.
+        """
+        now = time.monotonic()
+        self.bytes += nbytes
+        self.tags += 1
+        self.last_byte_at = now
+        if keyframe:
+            self.keyframe_at = now
+        if self.first_byte_at is None:
+            self.first_byte_at = now
+            self.time_to_first_byte = now - self.started_at
+
+    def sample(self, now):
+        elapsed = now - self._sampled_at
+        if elapsed <= 0:
+            return
+        self.bytes_per_sec = (self.bytes - self._sampled_bytes) / elapsed
+        self.tags_per_sec = (self.tags - self._sampled_tags) / elapsed
+        self._sampled_at = now
+        self._sampled_bytes = self.bytes
+        self._sampled_tags = self.tags
+
+    def as_dict(self):
+        now = time.monotonic()
+        return {
+            "bytes": self.bytes,
+            "tags": self.tags,
+            "clock_syncs": self.clock_sync.injected if self.clock_sync else 0,
+            "restarts": self.restarts,
+            "bytes_per_sec": self.bytes_per_sec,
+            "tags_per_sec": self.tags_per_sec,
+            "queued_bytes": self.queued_bytes,
+            "dropped_tags": self.dropped_tags,
+            "dropped_bytes": self.dropped_bytes,
+            "time_to_first_byte": self.time_to_first_byte,
+            "idle": now - self.last_byte_at,
+            "since_keyframe": (
+                now - self.keyframe_at if self.keyframe_at is not None else None
+            ),
+        }
+
+
+class _Watch(object):
+    __slots__ = ("pipeline", "stall_timeout", "failures", "failed_at", "restart_at")
+
+    def __init__(self, pipeline, stall_timeout):
+        self.pipeline = pipeline
+        self.stall_timeout = stall_timeout
+        self.failures = 0
+        self.failed_at = None
+        self.restart_at = None
+
+
+def backoff(failures):
+    """
+    Exponential backoff with jitter, so pipelines that failed together
+    (say, because the camera rebooted) don't all retry at the same moment.
+    """
+    delay = min(MIN_BACKOFF * 2 ** failures, MAX_BACKOFF)
+    return random.uniform(delay / 2, delay)
+
+
+class StreamSupervisor(object):
+    def __init__(self, check_interval=CHECK_INTERVAL, logger=None):
+        self.check_interval = check_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.watches = {}
+        self.thread = None
+
+    def watch(self, name, pipeline, stall_timeout=STALL_TIMEOUT):
+        """
+        Supervises `pipeline`, which must already be started, replacing
+        whatever was watched as `name` before. With no `stall_timeout`,
+        it's only restarted once it dies.
+        """
+        with self.lock:
+            self.watches[name] = _Watch(pipeline, stall_timeout)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="supervisor")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def unwatch(self, name):
+        with self.lock:
+            self.watches.pop(name, None)
+
+    def run(self):
+        while True:
+            time.sleep(self.check_interval)
+            with self.lock:
+                watches = list(self.watches.items())
+            for name, watch in watches:
+                try:
+                    self.check(name, watch, time.monotonic())
+                except Exception:
+                    self.logger.exception("Supervising %s failed", name)
+
+    def check(self, name, watch, now):
+        pipeline = watch.pipeline
+        stats = pipeline.stats
+
+        if watch.restart_at is not None:
+            if pipeline.poll() is None:
+                if stats.started_at > watch.failed_at:
+                    # The camera restarted it in the meantime
+                    watch.restart_at = None
+                # Otherwise wait for it to wind down after being stopped
+                return
+            if now < watch.restart_at:
+                return
+            watch.restart_at = None
+            stats.restarts += 1
+            self.logger.info("Restarting %s (restart #%s)", name, stats.restarts)
+            pipeline.start()
+            return
+
+        if pipeline.poll() is None:
+            stats.sample(now)
+            if watch.stall_timeout is None or (
+                now - stats.last_byte_at < watch.stall_timeout
+            ):
+                if watch.failures and now - stats.started_at >= HEALTHY_AFTER:
+                    watch.failures = 0
+                return
+            self.logger.warning(
+                "%s stalled, no data for %.1fs", name, now - stats.last_byte_at
+            )
+            pipeline.stop()
+        else:
+            self.logger.warning("%s died", name)
+
+        delay = backoff(watch.failures)
+        watch.failures += 1
+        watch.failed_at = now
+        watch.restart_at = now + delay
+        self.logger.info("Restarting %s in %.1fs", name, delay)
+
+    def stats(self):
+        with self.lock:
+            watches = list(self.watches.items())
+        return {name: watch.pipeline.stats.as_dict() for name, watch in watches}
+
+
+def get_supervisor():
+    """
+    Returns the supervisor shared by every camera in the process.
+    """
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = StreamSupervisor()
+        return _supervisor
@@ -0,0 +1,67 @@
+"""
+Messages serialized to JSON once, with placeholders for the few fields that
+change from one message to the next.
+"""
+
+import json
+import re
+
+_SLOT_PREFIX = "$slot:"
+_SLOT_PATTERN = re.compile(r'"\$slot:(\w+)"')
+
+
+class Slot(object):
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+
+def _mark_slot(value):
+    if isinstance(value, Slot):
+        return _SLOT_PREFIX + value.name
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def _encode(value):
+    # Message ids and clocks are by far the most common values
+    if type(value) is int:
+        return str(value)
+    return json.dumps(value)
+
+
+class MessageTemplate(object):
+    """
+    Serializes `message` once. Every `Slot` in it is filled in by `render`
+    with the JSON encoding of the matching keyword argument.
+    """
+
+    __slots__ = ("parts", "names")
+
+    def __init__(self, message):
+        pieces = _SLOT_PATTERN.split(json.dumps(message, default=_mark_slot))
+        self.parts = pieces[0::2]
+        self.names = pieces[1::2]
+
+    def render(self, **values):
+        parts = self.parts
+        out = [parts[0]]
+        for i, name in enumerate(self.names):
+            out.append(_encode(values[name]))
+            out.append(parts[i + 1])
+        return "".join(out)
+
+
+def response(function_name, payload):
+    """
+    The envelope shared by every reply to the NVR.
+    """
+    return {
+        "from": "ubnt_avclient",
+        "to": "UniFiVideo",
+        "responseExpected": False,
+        "functionName": function_name,
+        "payload": payload,
+        "messageId": Slot("messageId"),
+        "inResponseTo": Slot("inResponseTo"),
+    }
@@ -0,0 +1,153 @@
+import functools
+import os
+import shlex
+import subprocess
+import threading
+
+from unifi import flv
+from unifi.ingest import FNULL, FlvOutput, TagSource
+
+# The video profiles advertised to the NVR, with the field names it uses
+PROFILES = {
+    "video1": {
+        "width": 1280,
+        "height": 720,
+        "fps": 15,
+        "N": 30,
+        "bitRateCbrAvg": 1400000,
+        "bitRateVbrMax": 2800000,
+    },
+    "video2": {
+        "width": 720,
+        "height": 400,
+        "fps": 15,
+        "N": 30,
+        "bitRateCbrAvg": 500000,
+        "bitRateVbrMax": 1200000,
+    },
+    "video3": {
+        "width": 640,
+        "height": 360,
+        "fps": 15,
+        "N": 30,
+        "bitRateCbrAvg": 300000,
+        "bitRateVbrMax": 200000,
+    },
+}
+
+
+def encoder_args(profile):
+    # No B-frames (M=1) and a keyframe every N frames, like the cameras
+    maxrate = max(profile["bitRateCbrAvg"], profile["bitRateVbrMax"])
+    return (
+        "-c:v libx264 -preset veryfast -tune zerolatency -bf 0 -g {} "
+        "-b:v {} -maxrate {} -bufsize {}".format(
+            profile["N"], profile["bitRateCbrAvg"], maxrate, 2 * maxrate
+        )
+    )
+
+
+def transcode_cmd(profiles, fds):
+    """
+    One ffmpeg decoding FLV from stdin once and writing each of `profiles`
+    as FLV to the matching pipe in `fds`.
+    """
+    labels = ["[s{}]".format(i) for i in range(len(profiles))]
+    filters = ["[0:v]split={}{}".format(len(profiles), "".join(labels))]
+    outputs = []
+    for i, name in enumerate(profiles):
+        profile = PROFILES[name]
+        filters.append(
+            "{}fps={},scale={}:{},setsar=1[v{}]".format(
+                labels[i], profile["fps"], profile["width"], profile["height"], i
+            )
+        )
+        outputs.append(
+            "-map [v{}] -map 0:a? {} -c:a copy -f flv pipe:{}".format(
+                i, encoder_args(profile), fds[i]
+            )
+        )
+    return 'ffmpeg -f flv -i pipe:0 -filter_complex "{}" {}'.format(
+        ";".join(filters), " ".join(outputs)
+    )
+
+
+class Transcoder(FlvOutput):
+    """
+    Decodes the ingest's stream once and encodes it again for every active
+    profile. Each profile has a `TagSource` the NVR outputs attach to, which
+    outlives restarts of the encoder.
+    """
+
+    def __init__(self, logger=None, preroll=False):
+        super(Transcoder, self).__init__(logger)
+        self.renditions = {name: TagSource(logger, preroll) for name in PROFILES}
+        self.profiles = ()
+        self.proc = None
+
+    def __str__(self):
+        return "transcoder"
+
+    def set_profiles(self, profiles):
+        """
+        Encodes `profiles` from now on, restarting the encoder if they've
+        changed and it's running.
+        """
+        profiles = tuple(name for name in PROFILES if name in profiles)
+        if profiles == self.profiles:
+            return
+        self.profiles = profiles
+        if self.poll() is None:
+            self.logger.info("Transcoding %s", ", ".join(profiles))
+            self.stop()
+            self.thread.join()
+            self.start()
+
+    def open(self):
+        pipes = [os.pipe() for _ in self.profiles]
+        write_fds = [w for _, w in pipes]
+        try:
+            self.proc = subprocess.Popen(
+                shlex.split(transcode_cmd(self.profiles, write_fds)),
+                stdin=subprocess.PIPE,
+                stdout=FNULL,
+                stderr=FNULL,
+                bufsize=0,
+                pass_fds=write_fds,
+            )
+        except OSError:
+            for r, _ in pipes:
+                os.close(r)
+            raise
+        finally:
+            # The encoder holds the only write ends, so readers see EOF when
+            # it exits
+            for fd in write_fds:
+                os.close(fd)
+        for name, (r, _) in zip(self.profiles, pipes):
+            reader = threading.Thread(
+                target=self.read_rendition,
+                args=(name, os.fdopen(r, "rb", 0), self.proc),
+            )
+            reader.daemon = True
+            reader.start()
+
+    def read_rendition(self, name, pipe, proc):
+        rendition = self.renditions[name]
+        rendition.stats.start()
+        rendition.resync()
+        try:
+            with pipe:
+                rendition.dispatch(pipe)
+        except (OSError, ValueError, EOFError) as e:
+            # Otherwise the encoder was stopped, which the output reports
+            if proc.poll() is None:
+                self.logger.warning("Rendition %s failed: %s", name, e)
+
+    def write(self, buffers):
+        flv.write_all(functools.partial(os.writev, self.proc.stdin.fileno()), buffers)
+
+    def close(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
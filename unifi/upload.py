@@ -0,0 +1,79 @@
+import asyncio
+import ssl
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+MAX_CONCURRENT_UPLOADS = 4
+UPLOAD_TIMEOUT = 10
+
+_uploaders = {}
+_uploaders_lock = threading.Lock()
+
+
+class ClientCertAdapter(HTTPAdapter):
+    """
+    Hands every pooled connection the same SSL context, so the client
+    certificate is loaded once rather than on every handshake.
+    """
+
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        super(ClientCertAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self.ssl_context
+        return super(ClientCertAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+class SnapshotUploader(object):
+    """
+    Uploads snapshots to the NVR over a pool of kept-alive connections,
+    from a bounded pool of threads.
+    """
+
+    def __init__(
+        self, cert, max_concurrent=MAX_CONCURRENT_UPLOADS, timeout=UPLOAD_TIMEOUT
+    ):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        context.load_cert_chain(cert)
+
+        self.session = requests.Session()
+        self.session.mount(
+            "https://", ClientCertAdapter(context, pool_maxsize=max_concurrent)
+        )
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent)
+        self.timeout = timeout
+
+    def post(self, uri, filename, data, form_fields):
+        r = self.session.post(
+            uri,
+            files={"payload": (filename, data)},
+            data=form_fields,
+            verify=False,
+            timeout=self.timeout,
+        )
+        r.raise_for_status()
+        return r
+
+    def upload(self, uri, filename, data, form_fields):
+        """
+        Returns a future for the upload, to be awaited from the event loop.
+        """
+        return asyncio.get_event_loop().run_in_executor(
+            self.executor, self.post, uri, filename, data, form_fields
+        )
+
+
+def get_uploader(cert):
+    """
+    Returns the uploader for `cert`, shared by every camera in the process.
+    """
+    with _uploaders_lock:
+        if cert not in _uploaders:
+            _uploaders[cert] = SnapshotUploader(cert)
+        return _uploaders[cert]